@@ -0,0 +1,6 @@
+"""
+Benchmarks for the links plugin, on a generated corpus.
+
+See benchmark.run for how to run them and benchmark.corpus for the
+shape of the corpus.
+"""
@@ -0,0 +1,124 @@
+"""
+Generate a synthetic wiki for benchmarks.
+
+A corpus is made from a seed, so the same parameters always give the
+same tiddlers. Text is filler words with links scattered through it:
+'density' is the fraction of words which are links, 'mix' the
+relative weights of each kind of link, and 'hub_skew' how strongly
+links favour a few popular targets. With a skew of 0 every tiddler
+is as likely a target as any other; at 1 and above targets follow a
+Zipf distribution, so the first few tiddlers become hubs with many
+backlinks.
+"""
+
+import random
+
+from bisect import bisect_right
+
+from tiddlyweb.model.tiddler import Tiddler
+
+
+LINK_KINDS = ('wikiword', 'bracket', 'space', 'url')
+
+DEFAULTS = {
+        'count': 1000,
+        'size': 200,
+        'density': 0.05,
+        'mix': {'wikiword': 4, 'bracket': 3, 'space': 2, 'url': 1},
+        'hub_skew': 1.0,
+        'bags': 1,
+        'spaces': 20,
+        'seed': 1,
+        }
+
+WORDS = ('the', 'quick', 'brown', 'fox', 'jumps', 'over', 'lazy', 'dog',
+        'and', 'then', 'some', 'more', 'words', 'about', 'nothing', 'much',
+        'lorem', 'ipsum', 'dolor', 'sit', 'amet', 'wiki', 'page', 'notes')
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def title_for(index):
+    """
+    Return the title of the tiddler at index, which is a WikiWord.
+    """
+    letters = u''
+    while True:
+        index, remainder = divmod(index, len(LETTERS))
+        letters = LETTERS[remainder] + letters
+        if not index:
+            break
+    return u'Topic' + letters.capitalize()
+
+
+def bag_for(index, bags):
+    """
+    Return the name of the bag of the tiddler at index.
+    """
+    return u'bench%d' % (index % bags)
+
+
+def make_corpus(**parameters):
+    """
+    Return a list of tiddlers made from the given parameters, any
+    not given taking their value from DEFAULTS.
+    """
+    return list(generate_corpus(**parameters))
+
+
+def generate_corpus(**parameters):
+    """
+    Yield the tiddlers of a corpus, one at a time.
+    """
+    settings = dict(DEFAULTS)
+    settings.update(parameters)
+    chooser = random.Random(settings['seed'])
+    count = settings['count']
+
+    weights = [1.0 / (rank + 1) ** settings['hub_skew']
+            for rank in xrange(count)]
+    targets = _cumulative(weights)
+    mix = settings['mix']
+    kinds = [kind for kind in LINK_KINDS if mix.get(kind)]
+    kind_weights = _cumulative([mix[kind] for kind in kinds])
+
+    for index in xrange(count):
+        words = []
+        for _ in xrange(settings['size']):
+            if kinds and chooser.random() < settings['density']:
+                kind = kinds[_choose(chooser, kind_weights)]
+                words.append(_link(chooser, kind,
+                    _choose(chooser, targets), settings))
+            else:
+                words.append(chooser.choice(WORDS))
+        tiddler = Tiddler(title_for(index), bag_for(index, settings['bags']))
+        tiddler.text = u' '.join(words)
+        yield tiddler
+
+
+def _link(chooser, kind, target, settings):
+    title = title_for(target)
+    if kind == 'wikiword':
+        return title
+    if kind == 'bracket':
+        return '[[%s]]' % title
+    if kind == 'space':
+        space = 'space%d' % chooser.randrange(settings['spaces'])
+        if chooser.random() < 0.5:
+            return '@%s' % space
+        return '[[%s]]@%s' % (title, space)
+    return 'http://example.com/%s' % title
+
+
+def _cumulative(weights):
+    total = 0.0
+    cumulative = []
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return cumulative
+
+
+def _choose(chooser, cumulative):
+    return min(bisect_right(cumulative, chooser.random() * cumulative[-1]),
+            len(cumulative) - 1)
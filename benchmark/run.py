@@ -0,0 +1,353 @@
+"""
+Run the benchmarks and write the results as JSON.
+
+From the top of the repository:
+
+    python -m benchmark.run [options] > results.json
+
+Everything is built in a temporary directory: a text store holding
+the generated corpus and the links database. The benchmarks are
+
+* parser: process_data over every tiddler, for each engine
+* refresh: refresh_links, full and then incremental
+* put_hook: tiddler_put_hook for tiddlers whose text has changed
+* backlinks, frontlinks: GET requests through the WSGI app
+
+Latencies are given in milliseconds, with percentiles, and rates per
+second. The parameters of the run are included with the results so
+that runs can be compared.
+"""
+
+import os
+import platform
+import random
+import shutil
+import simplejson
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+from StringIO import StringIO
+
+from tiddlyweb.config import config
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.web import serve
+
+from tiddlywebplugins.utils import get_store
+
+from tiddlywebplugins.links import linksmanager, tiddler_put_hook
+from tiddlywebplugins.links.parser import process_data, DEFAULT_ENGINE
+from tiddlywebplugins.links.refresh import refresh_links
+
+from benchmark.corpus import DEFAULTS, LINK_KINDS, make_corpus, title_for
+
+
+BENCHMARKS = ('parser', 'refresh', 'put_hook', 'backlinks', 'frontlinks')
+SAMPLES = 200
+HUBS = 10
+
+
+def main(args=None):
+    """
+    Parse the command line, run the benchmarks and write the
+    results.
+    """
+    parser = OptionParser(prog='python -m benchmark.run')
+    parser.add_option('--count', type='int', default=DEFAULTS['count'],
+            help='tiddlers in the corpus')
+    parser.add_option('--size', type='int', default=DEFAULTS['size'],
+            help='words in each tiddler')
+    parser.add_option('--density', type='float',
+            default=DEFAULTS['density'],
+            help='fraction of words which are links')
+    parser.add_option('--mix', default=','.join('%s=%s' % (kind,
+        DEFAULTS['mix'][kind]) for kind in LINK_KINDS),
+        help='relative weights of the kinds of link')
+    parser.add_option('--hub-skew', type='float', dest='hub_skew',
+            default=DEFAULTS['hub_skew'],
+            help='how strongly links favour popular targets')
+    parser.add_option('--bags', type='int', default=DEFAULTS['bags'],
+            help='bags the corpus is spread across')
+    parser.add_option('--seed', type='int', default=DEFAULTS['seed'])
+    parser.add_option('--samples', type='int', default=SAMPLES,
+            help='hook calls and requests timed for each benchmark')
+    parser.add_option('--engines', default=DEFAULT_ENGINE,
+            help='parser engines to time, such as scanner,pyparsing')
+    parser.add_option('--backend', default='sql',
+            help='links backend to use')
+    parser.add_option('--workers', type='int', default=1,
+            help='refresh worker processes')
+    parser.add_option('--only', default=','.join(BENCHMARKS),
+            help='benchmarks to run')
+    parser.add_option('--output', help='file to write, default stdout')
+    options, _ = parser.parse_args(args)
+
+    corpus_parameters = {
+            'count': options.count,
+            'size': options.size,
+            'density': options.density,
+            'mix': _parse_mix(options.mix),
+            'hub_skew': options.hub_skew,
+            'bags': options.bags,
+            'seed': options.seed,
+            }
+    results = run(corpus_parameters, samples=options.samples,
+            engines=options.engines.split(','), backend=options.backend,
+            workers=options.workers, only=options.only.split(','))
+
+    output = simplejson.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        output_file = open(options.output, 'w')
+        try:
+            output_file.write(output + '\n')
+        finally:
+            output_file.close()
+    else:
+        sys.stdout.write(output + '\n')
+
+
+def run(corpus_parameters, samples=SAMPLES, engines=None, backend='sql',
+        workers=1, only=BENCHMARKS):
+    """
+    Run the benchmarks named in only on a corpus made from
+    corpus_parameters, returning a dict of parameters and results.
+    """
+    if engines is None:
+        engines = [DEFAULT_ENGINE]
+    chooser = random.Random(corpus_parameters.get('seed'))
+    corpus = make_corpus(**corpus_parameters)
+    results = {}
+
+    saved_config = dict(config)
+    directory = tempfile.mkdtemp(prefix='links-benchmark-')
+    try:
+        _release_engine()
+        _configure(directory, backend)
+        if 'parser' in only:
+            results['parser'] = bench_parser(corpus, engines)
+        store = get_store(config)
+        _populate(store, corpus)
+        # links are needed for the later benchmarks whichever run
+        results['refresh'] = bench_refresh(store, workers)
+        if 'put_hook' in only:
+            results['put_hook'] = bench_put_hook(store, corpus, samples,
+                    chooser)
+        app = None
+        for linktype in ('backlinks', 'frontlinks'):
+            if linktype in only:
+                if app is None:
+                    app = serve.load_app()
+                results[linktype] = bench_endpoint(app, corpus, linktype,
+                        samples, chooser)
+    finally:
+        _release_engine()
+        config.clear()
+        config.update(saved_config)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if 'refresh' not in only:
+        del results['refresh']
+    return {
+            'parameters': dict(corpus_parameters, samples=samples,
+                engines=engines, backend=backend, workers=workers),
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                },
+            'results': results,
+            }
+
+
+def bench_parser(corpus, engines):
+    """
+    Time each engine parsing the text of every tiddler.
+    """
+    size = sum(len(tiddler.text) for tiddler in corpus)
+    results = {}
+    for engine in engines:
+        links = 0
+        start = time.time()
+        for tiddler in corpus:
+            links += len(process_data(tiddler.text, engine))
+        elapsed = time.time() - start
+        results[engine] = {
+                'seconds': elapsed,
+                'links': links,
+                'tiddlers_per_second': _rate(len(corpus), elapsed),
+                'megabytes_per_second': _rate(size / 1048576.0, elapsed),
+                }
+    return results
+
+
+def bench_refresh(store, workers):
+    """
+    Time a full refresh of the links database, then an incremental
+    one with nothing changed.
+    """
+    total = len(store_tiddlers(store))
+    results = {}
+    for name, incremental in (('full', False), ('incremental', True)):
+        start = time.time()
+        count = refresh_links(store, workers=workers,
+                incremental=incremental)
+        elapsed = time.time() - start
+        results[name] = {
+                'seconds': elapsed,
+                'refreshed': count,
+                'tiddlers_per_second': _rate(total, elapsed),
+                }
+    return results
+
+
+def bench_put_hook(store, corpus, samples, chooser):
+    """
+    Time tiddler_put_hook for tiddlers given a new link.
+    """
+    latencies = []
+    for tiddler in chooser.sample(corpus, min(samples, len(corpus))):
+        tiddler.text += ' [[%s]]' % title_for(chooser.randrange(len(corpus)))
+        start = time.time()
+        tiddler_put_hook(store, tiddler)
+        latencies.append(time.time() - start)
+    return _summary(latencies)
+
+
+def bench_endpoint(app, corpus, linktype, samples, chooser):
+    """
+    Time GET requests for the linktype of tiddlers through app,
+    half of them for the most linked to tiddlers.
+    """
+    hubs = corpus[:HUBS]
+    latencies = []
+    for index in xrange(samples):
+        if index % 2:
+            tiddler = chooser.choice(hubs)
+        else:
+            tiddler = chooser.choice(corpus)
+        path = '/bags/%s/tiddlers/%s/%s.json' % (tiddler.bag, tiddler.title,
+                linktype)
+        start = time.time()
+        status = _get(app, path)
+        latencies.append(time.time() - start)
+        if not status.startswith('200'):
+            raise RuntimeError('%s gave %s' % (path, status))
+    return _summary(latencies)
+
+
+def store_tiddlers(store):
+    """
+    Return every tiddler in store, without text.
+    """
+    tiddlers = []
+    for bag in store.list_bags():
+        tiddlers.extend(store.list_bag_tiddlers(bag))
+    return tiddlers
+
+
+def _configure(directory, backend):
+    config.update({
+        'server_store': ['text', {'store_root': os.path.join(directory,
+            'store')}],
+        'linkdb_backend': backend,
+        'linkdb_config': 'sqlite:///%s' % os.path.join(directory, 'links.db'),
+        'links.sqlite_path': os.path.join(directory, 'links.sqlite'),
+        'links.memory_path': os.path.join(directory, 'links.graph'),
+        'log_file': os.path.join(directory, 'tiddlyweb.log'),
+        'log_level': 'ERROR',
+        })
+    if 'tiddlywebplugins.links' not in config['system_plugins']:
+        config['system_plugins'] = config['system_plugins'] + [
+                'tiddlywebplugins.links']
+
+
+def _release_engine():
+    """
+    Drop the engine of the sql backend, so that the next one is
+    made for the database now configured.
+    """
+    if linksmanager.ENGINE is not None:
+        linksmanager.SESSION.remove()
+        linksmanager.ENGINE.dispose()
+        linksmanager.ENGINE = None
+        linksmanager.MAPPED = False
+
+
+def _populate(store, corpus):
+    for bag_name in set(tiddler.bag for tiddler in corpus):
+        store.put(Bag(bag_name))
+    for tiddler in corpus:
+        store.put(tiddler)
+
+
+def _get(app, path):
+    environ = {
+            'REQUEST_METHOD': 'GET',
+            'SCRIPT_NAME': '',
+            'PATH_INFO': path,
+            'QUERY_STRING': '',
+            'SERVER_NAME': '0.0.0.0',
+            'SERVER_PORT': '8080',
+            'HTTP_HOST': '0.0.0.0:8080',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': StringIO(''),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            }
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+
+    output = app(environ, start_response)
+    try:
+        for _ in output:
+            pass
+    finally:
+        if hasattr(output, 'close'):
+            output.close()
+    return response['status']
+
+
+def _parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        kind, weight = part.split('=')
+        if kind not in LINK_KINDS:
+            raise ValueError('unknown kind of link: %s' % kind)
+        weights[kind] = float(weight)
+    return weights
+
+
+def _summary(latencies):
+    if not latencies:
+        return {'count': 0}
+    ordered = sorted(latencies)
+    total = sum(ordered)
+    return {
+            'count': len(ordered),
+            'mean_ms': total / len(ordered) * 1000,
+            'p50_ms': _percentile(ordered, 50) * 1000,
+            'p90_ms': _percentile(ordered, 90) * 1000,
+            'p99_ms': _percentile(ordered, 99) * 1000,
+            'max_ms': ordered[-1] * 1000,
+            'per_second': _rate(len(ordered), total),
+            }
+
+
+def _percentile(ordered, percent):
+    index = int(round(percent / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def _rate(amount, elapsed):
+    if not elapsed:
+        return None
+    return amount / elapsed
+
+
+if __name__ == '__main__':
+    main()
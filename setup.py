@@ -20,11 +20,11 @@ setup(
     author_email = AUTHOR_EMAIL,
     url = 'http://pypi.python.org/pypi/%s' % NAME,
     platforms = 'Posix; MacOS X; Windows',
-    packages = find_packages(exclude=['test']),
+    packages = find_packages(exclude=['test', 'benchmark']),
     install_requires = ['setuptools',
         'tiddlyweb>=1.4.2',
         'httpexceptor',
-        'sqlalchemy',
+        'sqlalchemy>=1.2,<2.0',
         'pyparsing<2.0.0'],
     zip_safe = False
     )
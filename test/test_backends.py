@@ -0,0 +1,257 @@
+"""
+Tests every links backend must pass.
+"""
+
+import os
+import sqlite3
+
+import pytest
+
+from tiddlyweb.config import config
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.links import memory
+from tiddlywebplugins.links.backends import (get_links_manager,
+        register_backend, get_backend)
+from tiddlywebplugins.links.base import LinksBackend
+
+
+FILES = ['test_backends.graph.snapshot', 'test_backends.graph.log',
+        'test_backends.sqlite', 'test_backends.sqlite-wal',
+        'test_backends.sqlite-shm', 'test_backends.tuned',
+        'test_backends.tuned-wal', 'test_backends.tuned-shm',
+        'test_backends.old', 'test_backends.old-wal',
+        'test_backends.old-shm']
+
+
+def setup_module(module):
+    teardown_module(module)
+
+
+def teardown_module(module):
+    for filename in FILES:
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+    memory.GRAPHS.clear()
+
+
+@pytest.fixture(params=['sql', 'sqlite3', 'memory'])
+def backend(request):
+    backend_config = dict(config)
+    backend_config.update({'linkdb_backend': request.param,
+        'links.memory_path': 'test_backends.graph',
+        'links.sqlite_path': 'test_backends.sqlite'})
+    links_manager = get_links_manager({'tiddlyweb.config': backend_config})
+    # a bag of its own for each test keeps backends which share a
+    # database apart
+    return links_manager, request.node.name.replace('[', '_').rstrip(']')
+
+
+def _tiddler(title, bag, text):
+    tiddler = Tiddler(title, bag)
+    tiddler.text = text
+    return tiddler
+
+
+def test_is_backend(backend):
+    links_manager, _ = backend
+    assert isinstance(links_manager, LinksBackend)
+
+
+def test_replace_and_read(backend):
+    links_manager, bag = backend
+    tiddler = _tiddler('source', bag,
+            'Some OneLink, [[two]], @cdent and http://example.com/')
+    links_manager.replace_links(tiddler)
+    assert sorted(links_manager.read_frontlinks(tiddler)) == sorted([
+        '@cdent:', '%s:OneLink' % bag, '%s:two' % bag,
+        'http://example.com/'])
+    assert links_manager.read_backlinks(Tiddler('two', bag)) == [
+            '%s:source' % bag]
+
+    tiddler.text = 'Some OneLink and [[three]]'
+    links_manager.replace_links(tiddler)
+    assert sorted(links_manager.read_frontlinks(tiddler)) == [
+            '%s:OneLink' % bag, '%s:three' % bag]
+    assert links_manager.read_backlinks(Tiddler('two', bag)) == []
+    assert links_manager.read_backlinks(Tiddler('three', bag)) == [
+            '%s:source' % bag]
+
+
+def test_replace_many(backend):
+    links_manager, bag = backend
+    links_manager.replace_links_many([
+        (_tiddler('one', bag, ''), [('Hub', None)]),
+        (_tiddler('two', bag, ''), [('Hub', None), ('one', None)])])
+    assert sorted(links_manager.read_backlinks(Tiddler('Hub', bag))) == [
+            '%s:one' % bag, '%s:two' % bag]
+    assert links_manager.count_backlinks_many([Tiddler('Hub', bag),
+        Tiddler('one', bag), Tiddler('two', bag)]) == {
+            '%s:Hub' % bag: 2, '%s:one' % bag: 1, '%s:two' % bag: 0}
+    # more than one batch of keys
+    counts = links_manager.count_backlinks_many([Tiddler('Hub', bag)]
+            + [Tiddler('missing%s' % i, bag) for i in range(1200)])
+    assert len(counts) == 1201
+    assert counts['%s:Hub' % bag] == 2
+    assert sum(counts.values()) == 2
+
+
+def test_update_database_adds(backend):
+    links_manager, bag = backend
+    tiddler = _tiddler('added', bag, '[[first]]')
+    links_manager.update_database(tiddler)
+    tiddler.text = '[[second]]'
+    links_manager.update_database(tiddler)
+    assert sorted(links_manager.read_frontlinks(tiddler)) == [
+            '%s:first' % bag, '%s:second' % bag]
+
+
+def test_delete(backend):
+    links_manager, bag = backend
+    tiddler = _tiddler('doomed', bag, '[[target]]')
+    links_manager.replace_links(tiddler)
+    assert '%s:doomed' % bag in links_manager.list_sources()
+
+    links_manager.delete_links(tiddler)
+    assert links_manager.read_frontlinks(tiddler) == []
+    assert links_manager.read_backlinks(Tiddler('target', bag)) == []
+    assert '%s:doomed' % bag not in links_manager.list_sources()
+
+
+def test_paging(backend):
+    links_manager, bag = backend
+    links_manager.replace_links_many([(_tiddler('page%s' % index, bag, ''),
+        [('Hub', None)]) for index in range(5)])
+    hub = Tiddler('Hub', bag)
+    keys = ['%s:page%s' % (bag, index) for index in range(5)]
+    assert links_manager.read_backlinks(hub, limit=2) == keys[:2]
+    assert links_manager.read_backlinks(hub, limit=2,
+            after=keys[1]) == keys[2:4]
+    assert links_manager.read_backlinks(hub, after=keys[3]) == keys[4:]
+
+
+def test_export_and_import(backend):
+    links_manager, bag = backend
+    links_manager.replace_links_many([
+        (_tiddler('one', bag, ''), [('two', None), ('http://example.com/', None)]),
+        (_tiddler('two', bag, ''), [('one', None), (None, 'space')]),
+        (_tiddler('three', bag + 'x', ''), [('one', None)])])
+
+    exported = sorted(links_manager.export_links(bag))
+    assert exported == sorted([('%s:one' % bag, '%s:two' % bag),
+            ('%s:one' % bag, 'http://example.com/'),
+            ('%s:two' % bag, '%s:one' % bag),
+            ('%s:two' % bag, '@space:')])
+    assert set(exported) < set(links_manager.export_links())
+
+    copy = bag + 'copy'
+    rows = [(source.replace(bag, copy, 1), target)
+            for source, target in exported]
+    assert links_manager.import_links(iter(rows), batch_size=3) == 4
+    assert sorted(links_manager.export_links(copy)) == sorted(rows)
+    assert links_manager.read_backlinks(Tiddler('one', bag)) == [
+            '%s:two' % bag, '%s:two' % copy]
+    # importing again changes nothing
+    links_manager.import_links(rows)
+    assert sorted(links_manager.export_links(copy)) == sorted(rows)
+
+
+def test_kinds(backend):
+    links_manager, bag = backend
+    tiddler = _tiddler('kinds', bag,
+            'Some OneLink, [[two]]@cdent, @cdent and http://example.com/')
+    links_manager.replace_links(tiddler)
+    imported = bag + 'imported'
+    links_manager.import_links([('%s:kinds' % imported, 'https://x.org/'),
+        ('%s:kinds' % imported, '%s:Other' % imported)])
+
+    assert sorted(links_manager.read_frontlinks(tiddler,
+        kinds=['tiddler'])) == ['cdent_public:two', '%s:OneLink' % bag]
+    assert links_manager.read_frontlinks(tiddler, kinds=['space']) == [
+            '@cdent:']
+    assert sorted(links_manager.read_frontlinks(tiddler,
+        kinds=['external', 'space'])) == ['@cdent:', 'http://example.com/']
+    assert links_manager.read_frontlinks(tiddler, kinds=['tiddler'],
+            limit=1, after='cdent_public:two') == ['%s:OneLink' % bag]
+    assert links_manager.read_frontlinks(Tiddler('kinds', imported),
+            kinds=['external']) == ['https://x.org/']
+    assert links_manager.read_backlinks(Tiddler('OneLink', bag),
+            kinds=['tiddler']) == ['%s:kinds' % bag]
+    assert links_manager.read_backlinks(Tiddler('OneLink', bag),
+            kinds=['external']) == []
+    assert list(links_manager.export_links(bag, kinds=['external'])) == [
+            ('%s:kinds' % bag, 'http://example.com/')]
+
+
+def test_registry():
+    class Custom(LinksBackend):
+        pass
+
+    register_backend('custom', Custom)
+    assert get_backend('custom') is Custom
+    assert get_backend('tiddlywebplugins.links.base:LinksBackend') is (
+            LinksBackend)
+    with pytest.raises(ValueError):
+        get_backend('nosuchbackend')
+
+
+def test_sqlite_setup():
+    from tiddlywebplugins.links import linksmanager, sqlite
+    from tiddlywebplugins.links.linksmanager import LinksManager
+
+    sqlite_config = dict(config)
+    sqlite_config.update({'links.sqlite_cache_size': -4000})
+    connection = sqlite._connect('test_backends.tuned', sqlite_config)
+    assert connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    assert connection.execute('PRAGMA cache_size').fetchone()[0] == -4000
+
+    LinksManager({'tiddlyweb.config': config})
+    engine = linksmanager.ENGINE
+    assert engine.execute('PRAGMA journal_mode').scalar() == 'wal'
+    assert engine.execute('PRAGMA busy_timeout').scalar() == 30000
+
+    # as if forked since the engine was made
+    linksmanager.ENGINE_PID = -1
+    LinksManager({'tiddlyweb.config': config})
+    assert linksmanager.ENGINE is not engine
+    assert linksmanager.ENGINE_PID == os.getpid()
+    assert engine in linksmanager.INHERITED_ENGINES
+
+
+def test_sqlite_upgrade_adds_kinds():
+    from tiddlywebplugins.links.sqlite import SQLiteLinksManager
+
+    connection = sqlite3.connect('test_backends.old')
+    with connection:
+        connection.executescript("""
+            CREATE TABLE link_node (id INTEGER PRIMARY KEY,
+                key TEXT NOT NULL UNIQUE);
+            CREATE TABLE link_edge (source_id INTEGER NOT NULL,
+                target_id INTEGER NOT NULL,
+                PRIMARY KEY (source_id, target_id));
+            INSERT INTO link_node VALUES (1, 'old:source');
+            INSERT INTO link_node VALUES (2, 'old:target');
+            INSERT INTO link_node VALUES (3, 'http://example.com/');
+            INSERT INTO link_node VALUES (4, '@space:');
+            INSERT INTO link_edge VALUES (1, 2);
+            INSERT INTO link_edge VALUES (1, 3);
+            INSERT INTO link_edge VALUES (1, 4);
+            """)
+    connection.close()
+
+    old_config = dict(config)
+    old_config['links.sqlite_path'] = 'test_backends.old'
+    links_manager = SQLiteLinksManager({'tiddlyweb.config': old_config})
+    source = Tiddler('source', 'old')
+    assert links_manager.read_frontlinks(source, kinds=['tiddler']) == [
+            'old:target']
+    assert links_manager.read_frontlinks(source, kinds=['external']) == [
+            'http://example.com/']
+    assert links_manager.read_frontlinks(source, kinds=['space']) == [
+            '@space:']
+    plan = ' '.join(str(row) for row in links_manager.connection.execute(
+        'EXPLAIN QUERY PLAN SELECT target_id FROM link_edge '
+        "WHERE source_id = 1 AND kind = 'space'"))
+    assert 'link_edge_kind' in plan
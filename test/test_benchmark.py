@@ -0,0 +1,56 @@
+"""
+Test the benchmark corpus and a small run of the benchmarks.
+"""
+
+import simplejson
+
+from tiddlywebplugins.links.parser import process_data
+
+from benchmark.corpus import make_corpus, title_for
+from benchmark.run import run
+
+
+def test_title_for():
+    assert title_for(0) == 'TopicA'
+    assert title_for(27) == 'TopicBb'
+    assert len(set(title_for(index) for index in range(1000))) == 1000
+
+
+def test_corpus_repeats():
+    first = make_corpus(count=20, size=50, seed=3)
+    second = make_corpus(count=20, size=50, seed=3)
+    assert [tiddler.text for tiddler in first] == [
+            tiddler.text for tiddler in second]
+    assert first[0].text != make_corpus(count=20, size=50, seed=4)[0].text
+
+
+def test_corpus_mix():
+    corpus = make_corpus(count=20, size=50, density=0.5,
+            mix={'url': 1})
+    for tiddler in corpus:
+        links = process_data(tiddler.text)
+        assert links
+        for link, space in links:
+            assert link.startswith('http://example.com/')
+
+    assert not process_data(make_corpus(count=1, density=0)[0].text)
+
+
+def test_corpus_hubs():
+    corpus = make_corpus(count=200, size=100, density=0.2,
+            mix={'wikiword': 1}, hub_skew=2)
+    counts = {}
+    for tiddler in corpus:
+        for link, _ in process_data(tiddler.text):
+            counts[link] = counts.get(link, 0) + 1
+    assert max(counts, key=counts.get) == title_for(0)
+
+
+def test_run():
+    results = run({'count': 30, 'size': 40}, samples=5)
+    simplejson.dumps(results)
+    assert results['parameters']['count'] == 30
+    assert results['results']['refresh']['full']['refreshed'] == 30
+    for name in ('put_hook', 'backlinks', 'frontlinks'):
+        assert results['results'][name]['count'] == 5
+    assert results['results']['parser']['scanner']['links']
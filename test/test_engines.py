@@ -0,0 +1,73 @@
+"""
+Check that the scanner finds the same links as the pyparsing
+grammar.
+"""
+
+import random
+
+from tiddlywebplugins.links.parser import process_data
+
+
+CORPUS = [
+    '',
+    'I had a WikiLink once',
+    'aWikiLink inside a word, FooBar9x@cow and FooBarBaz',
+    'You should not use [[free links]]',
+    'You should not use [[free links|FreeLinks]]@cdent-mt, okay?',
+    'You should not use [[ spaced  |  piped ]] or [[\tdangling',
+    '[[]] and [[ ]] and [[|]] and [[a|b|c]]',
+    '[[free links|http://cdent-mt.tiddlyspace.com/Collaboration%20Requires%20Goals]]',
+    'I link to http://burningchrome.com/too?q=pie#this, all the time',
+    'mailto:cdent@peermore.com and xhttp://example.com/a|b',
+    "data:text/plain,hello 'ftp://example.com/' \"irc://host\"",
+    'Stop by, say hi to @cdent, yes? @ cdent @-x @[[a space]] @[[]]',
+    'I had not know that this@cdent-mt ought to work, nor this @ that',
+    'abc@-def and abc@[[def]] and WikiWord@[[bag name]]',
+    '[[you know]]@cart? [[you know]] @cart',
+    'oh hi\n{{some tiddler}}\nand other stuff',
+    '{{some tiddler}}\nand other stuff',
+    ' {{some tiddler}}\nand other stuff',
+    '{{some tiddler}} a\nand other stuff',
+    'oh hi\n{{some tiddler}}@cow\nand other stuff',
+    'oh hi\n{{some tiddler}}@cow bar\nand other stuff',
+    '{{ one }}  \t\r\n{{two}}@[[three]]\n{{four}}',
+    '{{multi\nline}}\n{{unclosed\n',
+    'tabs\tin\t[[the\tmiddle]] of\tWikiWords',
+    u'unicode \xe9l\xe9phant [[caf\xe9]] WikiWord@caf\xe9',
+]
+
+PIECES = ['[[', ']]', '{{', '}}', '@', ' ', '\n', '\t', '|', 'a', 'Z',
+        'Foo', 'BarBaz', 'http://', 'x.com/', 'mailto:', "'", '"', '-', '9',
+        '\r', ':', '/', 'cdent', '[', ']', '{', '}']
+
+
+def _random_corpus(count, seed=1):
+    rand = random.Random(seed)
+    for _ in range(count):
+        yield ''.join(rand.choice(PIECES)
+                for _ in range(rand.randint(0, 30)))
+
+
+def test_corpus():
+    for text in CORPUS:
+        assert (process_data(text, 'scanner')
+                == process_data(text, 'pyparsing')), repr(text)
+
+
+def test_random_corpus():
+    for text in _random_corpus(2000):
+        assert (process_data(text, 'scanner')
+                == process_data(text, 'pyparsing')), repr(text)
+
+
+def test_default_engine():
+    assert process_data('[[one]] TwoThree', 'scanner') == process_data(
+            '[[one]] TwoThree')
+
+
+def test_unknown_engine():
+    try:
+        process_data('WikiWord', 'regexp')
+        assert False, 'unknown engine accepted'
+    except ValueError:
+        pass
@@ -0,0 +1,109 @@
+
+import os
+
+from tiddlyweb.config import config
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.links.indexer import LinksIndexer, get_indexer
+from tiddlywebplugins.links import linksmanager
+from tiddlywebplugins.links.linksmanager import LinksManager
+
+
+def setup_module(module):
+    try:
+        os.unlink('links.db')
+    except OSError:
+        pass
+    linksmanager.MAPPED = False  # recreate the tables
+    module.environ = {'tiddlyweb.config': config}
+    module.links_manager = LinksManager(module.environ)
+
+
+def test_queue_and_flush():
+    indexer = LinksIndexer(environ)
+    indexer.start()
+    tiddler = Tiddler('queued', 'bagq')
+    tiddler.text = 'QueuedLink and [[another]]'
+    indexer.put(tiddler)
+    indexer.flush()
+
+    assert sorted(links_manager.read_frontlinks(tiddler)) == [
+            'bagq:QueuedLink', 'bagq:another']
+
+    indexer.delete(tiddler)
+    indexer.stop()
+    assert links_manager.read_frontlinks(tiddler) == []
+    assert indexer.stats()['indexed'] == 1
+    assert indexer.stats()['deleted'] == 1
+
+
+def test_coalesce():
+    indexer = LinksIndexer(environ)
+    tiddler = Tiddler('coalesced', 'bagq')
+    for text in ['FirstLink', 'SecondLink', 'ThirdLink']:
+        tiddler.text = text
+        indexer.put(tiddler)
+    indexer.flush()
+    indexer.stop()
+
+    assert links_manager.read_frontlinks(tiddler) == ['bagq:ThirdLink']
+    assert indexer.coalesced == 2
+    assert indexer.indexed == 1
+
+
+def test_skip_unchanged():
+    indexer = LinksIndexer(environ)
+    tiddler = Tiddler('skipped', 'bagq')
+    tiddler.text = 'SkippedLink'
+    indexer.put(tiddler)
+    indexer.flush()
+    tiddler.tags = ['retagged']
+    indexer.put(tiddler)
+    indexer.flush()
+    indexer.stop()
+
+    assert links_manager.read_frontlinks(tiddler) == ['bagq:SkippedLink']
+    assert indexer.indexed == 1
+    assert indexer.skipped == 1
+
+
+def test_backpressure():
+    indexer = LinksIndexer(environ, size=1, timeout=0.01)
+    first = Tiddler('first', 'bagq')
+    first.text = 'FirstOverflow'
+    second = Tiddler('second', 'bagq')
+    second.text = 'SecondOverflow'
+    indexer.put(first)
+    indexer.put(second)
+
+    # the queue was full, so the second was applied by the caller
+    assert indexer.overflowed == 1
+    assert links_manager.read_frontlinks(second) == ['bagq:SecondOverflow']
+    assert links_manager.read_frontlinks(first) == []
+
+    indexer.flush()
+    indexer.stop()
+    assert links_manager.read_frontlinks(first) == ['bagq:FirstOverflow']
+
+
+def test_backpressure_same_tiddler():
+    indexer = LinksIndexer(environ, size=1, timeout=0.01)
+    tiddler = Tiddler('overtaken', 'bagq')
+    tiddler.text = '[[old]]'
+    indexer.put(tiddler)
+    tiddler.text = '[[new]]'
+    indexer.put(tiddler)
+
+    assert indexer.overflowed == 1
+    assert links_manager.read_frontlinks(tiddler) == ['bagq:new']
+
+    # the older update still queued is dropped
+    indexer.flush()
+    indexer.stop()
+    assert links_manager.read_frontlinks(tiddler) == ['bagq:new']
+    assert indexer.coalesced == 1
+    assert indexer._pending == {}
+
+
+def test_get_indexer_off():
+    assert get_indexer(environ) is None
@@ -0,0 +1,87 @@
+import os
+
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.links import memory
+from tiddlywebplugins.links.backends import get_links_manager
+from tiddlywebplugins.links.memory import LinkGraph, MemoryLinksManager
+
+
+PATH = 'test_links.graph'
+
+
+def setup_module(module):
+    teardown_module(module)
+    module.config = {'linkdb_backend': 'memory', 'links.memory_path': PATH,
+            'links.memory_compact_after': 5}
+    module.environ = {'tiddlyweb.config': module.config}
+
+
+def teardown_module(module):
+    for suffix in ['.snapshot', '.log']:
+        try:
+            os.unlink(PATH + suffix)
+        except OSError:
+            pass
+    memory.GRAPHS.clear()
+
+
+def test_read_and_write():
+    links_manager = get_links_manager(environ)
+    assert isinstance(links_manager, MemoryLinksManager)
+
+    tiddler = Tiddler('source', 'bag')
+    tiddler.text = 'Some OneLink and [[two]] and @cdent'
+    links_manager.replace_links(tiddler)
+    assert links_manager.read_frontlinks(tiddler) == ['@cdent:',
+            'bag:OneLink', 'bag:two']
+    assert links_manager.read_backlinks(Tiddler('two', 'bag')) == [
+            'bag:source']
+
+    tiddler.text = 'Some OneLink and [[three]]'
+    links_manager.replace_links(tiddler)
+    assert links_manager.read_frontlinks(tiddler) == ['bag:OneLink',
+            'bag:three']
+    assert links_manager.read_backlinks(Tiddler('two', 'bag')) == []
+
+    links_manager.delete_links(tiddler)
+    assert links_manager.read_frontlinks(tiddler) == []
+    assert links_manager.read_backlinks(Tiddler('three', 'bag')) == []
+
+
+def test_snapshot_and_log():
+    links_manager = get_links_manager(environ)
+    for index in range(8):
+        tiddler = Tiddler('page%s' % index, 'bag')
+        tiddler.text = '[[Hub]] [[page%s]]' % (index + 1)
+        links_manager.replace_links(tiddler)
+
+    # the log has been compacted once, the rest is still in the log
+    assert os.path.getsize(PATH + '.snapshot') > 0
+    assert 0 < len(open(PATH + '.log').read().splitlines()) < 5
+
+    hub = Tiddler('Hub', 'bag')
+    expected = ['bag:page%s' % index for index in range(8)]
+    assert links_manager.read_backlinks(hub) == expected
+    assert links_manager.read_backlinks(hub, limit=3,
+            after='bag:page2') == expected[3:6]
+    assert links_manager.count_backlinks_many([hub]) == {'bag:Hub': 8}
+
+    # another process sees the same graph, from snapshot and log
+    other = LinkGraph(PATH)
+    assert other.backlinks(u'bag:Hub') == expected
+    assert other.frontlinks(u'bag:page7') == [u'bag:Hub', u'bag:page8']
+
+    # and catches up with changes, and compactions, made here
+    links_manager.delete_sources(['bag:page0', 'bag:page1'])
+    assert other.backlinks(u'bag:Hub') == expected[2:]
+    links_manager.graph.compact()
+    assert open(PATH + '.log').read() == ''
+    assert other.backlinks(u'bag:Hub') == expected[2:]
+    assert other.sources() == set(expected[2:])
+
+
+def test_no_environ():
+    links_manager = MemoryLinksManager()
+    assert links_manager.graph is memory.get_graph({})
+    assert links_manager.read_frontlinks(Tiddler('nothing', 'here')) == []
@@ -0,0 +1,89 @@
+
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.links import parser
+from tiddlywebplugins.links.parser import (process_tiddler, ParseCache,
+        get_parse_cache)
+
+
+def setup_module(module):
+    parser.PARSE_CACHE = None
+
+
+def test_cache_hits():
+    config = {'links.parse_cache_size': 10}
+    tiddler = Tiddler('one', 'bag')
+    tiddler.text = 'I am NotYou, you [[are|you]]!'
+
+    links = process_tiddler(tiddler, config)
+    cache = get_parse_cache(config)
+    assert cache.misses == 1
+    assert cache.hits == 0
+
+    tiddler.tags = ['changed']
+    assert process_tiddler(tiddler, config) == links
+    assert cache.hits == 1
+
+    other = Tiddler('two', 'bag')
+    other.text = tiddler.text
+    assert process_tiddler(other, config) == links
+    assert cache.hits == 2
+
+    other.type = 'text/x-markdown'
+    process_tiddler(other, config)
+    assert cache.misses == 2
+
+    config['links.at_means_bag'] = True
+    process_tiddler(other, config)
+    assert cache.misses == 3
+
+
+def test_cache_disabled():
+    parser.PARSE_CACHE = None
+    config = {'links.parse_cache_size': 0}
+    tiddler = Tiddler('one', 'bag')
+    tiddler.text = 'WikiWord'
+    assert process_tiddler(tiddler, config) == [('WikiWord', None)]
+    assert get_parse_cache(config) is None
+    assert parser.PARSE_CACHE is None
+
+
+def test_eviction():
+    cache = ParseCache(2)
+    cache.put('a', [('A', None)])
+    cache.put('b', [('B', None)])
+    assert cache.get('a') == (('A', None),)
+    cache.put('c', [('C', None)])
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert len(cache) == 2
+    assert cache.stats() == {'size': 2, 'max_size': 2, 'hits': 2,
+            'misses': 1, 'evictions': 1}
+
+
+def test_threads():
+    import threading
+
+    cache = ParseCache(50)
+    errors = []
+
+    def work(offset):
+        try:
+            for index in range(2000):
+                key = (index + offset) % 80
+                if cache.get(key) is None:
+                    cache.put(key, [(str(key), None)])
+        except Exception, exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=work, args=(offset,))
+            for offset in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(cache) == 50
+    stats = cache.stats()
+    assert stats['hits'] + stats['misses'] == 8 * 2000
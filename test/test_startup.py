@@ -0,0 +1,143 @@
+"""
+Test that importing the plugin is cheap, and that the schema is made
+once per database and upgraded in place.
+"""
+
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.links import linksmanager
+from tiddlywebplugins.links.linksmanager import LinksManager
+
+
+FILES = ['test_startup.db', 'test_startup.db-wal', 'test_startup.db-shm',
+        'test_startup.old', 'test_startup.old-wal', 'test_startup.old-shm']
+
+IMPORT_SCRIPT = '''
+import sys, time
+start = time.time()
+import tiddlywebplugins.links
+print time.time() - start
+print ' '.join(name for name in ('sqlalchemy', 'pyparsing')
+        if name in sys.modules)
+'''
+
+
+def setup_module(module):
+    teardown_module(module)
+    module.environ = {'tiddlyweb.config': {
+        'linkdb_config': 'sqlite:///test_startup.db'}}
+
+
+def teardown_module(module):
+    _release_engine()
+    for filename in FILES:
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+
+
+def _release_engine():
+    if linksmanager.ENGINE is not None:
+        linksmanager.SESSION.remove()
+        linksmanager.ENGINE.dispose()
+        linksmanager.ENGINE = None
+    linksmanager.MAPPED = False
+
+
+def test_import_is_light():
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    elapsed, loaded = (output.splitlines() + [''])[:2]
+    print 'import took %.1fms' % (float(elapsed) * 1000)
+    assert loaded.strip() == ''
+
+
+def test_schema_checked_once():
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(Engine, 'before_cursor_execute', record)
+    try:
+        _release_engine()
+        start = time.time()
+        links_manager = LinksManager(environ)
+        links_manager.read_backlinks(Tiddler('start', 'bag'))
+        cold = time.time() - start
+        created = len(statements)
+
+        # as a new process would find it
+        _release_engine()
+        del statements[:]
+        start = time.time()
+        links_manager = LinksManager(environ)
+        schema_statements = list(statements)
+        links_manager.read_backlinks(Tiddler('start', 'bag'))
+        warm = time.time() - start
+    finally:
+        event.remove(Engine, 'before_cursor_execute', record)
+
+    print 'first request took %.1fms, then %.1fms' % (cold * 1000,
+            warm * 1000)
+    assert created > 1
+    assert len(schema_statements) == 1
+    assert 'link_schema' in schema_statements[0]
+
+
+def test_newer_schema_left_alone():
+    _release_engine()
+    LinksManager(environ)
+    linksmanager.ENGINE.execute(linksmanager.SCHEMA_TABLE.update().values(
+        version=linksmanager.SCHEMA_VERSION + 1))
+
+    assert not linksmanager.ensure_schema(linksmanager.ENGINE)
+    assert linksmanager.ENGINE.execute(
+            linksmanager.SCHEMA_TABLE.select()).fetchall() == [
+                    (linksmanager.SCHEMA_VERSION + 1,)]
+
+
+def test_upgrade_adds_kinds():
+    connection = sqlite3.connect('test_startup.old')
+    with connection:
+        connection.executescript("""
+            CREATE TABLE link_node (id INTEGER PRIMARY KEY,
+                key VARCHAR(333) NOT NULL UNIQUE);
+            CREATE TABLE link_edge (source_id INTEGER NOT NULL,
+                target_id INTEGER NOT NULL,
+                PRIMARY KEY (source_id, target_id));
+            CREATE TABLE link_schema (version INTEGER NOT NULL);
+            INSERT INTO link_schema VALUES (1);
+            INSERT INTO link_node VALUES (1, 'old:source');
+            INSERT INTO link_node VALUES (2, 'old:target');
+            INSERT INTO link_node VALUES (3, 'http://example.com/');
+            INSERT INTO link_node VALUES (4, '@space:');
+            INSERT INTO link_edge VALUES (1, 2);
+            INSERT INTO link_edge VALUES (1, 3);
+            INSERT INTO link_edge VALUES (1, 4);
+            """)
+    connection.close()
+
+    _release_engine()
+    links_manager = LinksManager({'tiddlyweb.config': {
+        'linkdb_config': 'sqlite:///test_startup.old'}})
+    source = Tiddler('source', 'old')
+    assert links_manager.read_frontlinks(source, kinds=['tiddler']) == [
+            'old:target']
+    assert links_manager.read_frontlinks(source, kinds=['external']) == [
+            'http://example.com/']
+    assert links_manager.read_frontlinks(source, kinds=['space']) == [
+            '@space:']
+    assert linksmanager.ENGINE.execute(
+            linksmanager.SCHEMA_TABLE.select()).fetchall() == [
+                    (linksmanager.SCHEMA_VERSION,)]
@@ -0,0 +1,114 @@
+"""
+Test the timings, counters and profiling of the stats module.
+"""
+
+import os
+import shutil
+import tempfile
+
+from tiddlywebplugins.links import stats
+
+
+PROFILE_DIR = 'test_stats.profiles'
+
+
+def setup_module(module):
+    shutil.rmtree(PROFILE_DIR, ignore_errors=True)
+    os.mkdir(PROFILE_DIR)
+
+
+def teardown_module(module):
+    shutil.rmtree(PROFILE_DIR, ignore_errors=True)
+    stats.configure_stats({})
+
+
+def test_memory_sink():
+    sink = stats.MemorySink({'links.stats_samples': 10})
+    for milliseconds in range(1, 21):
+        sink.record('thing', milliseconds / 1000.0)
+    sink.count('things')
+    sink.count('things', 2)
+
+    report = sink.stats()
+    assert report['counters'] == {'things': 3}
+    timing = report['timings']['thing']
+    assert timing['count'] == 20
+    assert round(timing['total_ms']) == 210
+    assert round(timing['max_ms']) == 20
+    # percentiles are of the most recent samples
+    assert round(timing['p50_ms']) == 16
+    assert round(timing['p99_ms']) == 20
+
+
+def test_timed():
+    sink = stats.configure_stats({'links.stats_sink': 'memory'})
+    sink.reset()
+
+    @stats.instrumented('function')
+    def function(value):
+        return value * 2
+
+    assert function(2) == 4
+    assert function.__name__ == 'function'
+    with stats.timed('block'):
+        pass
+    assert list(stats.timed_output('output', iter(['a', 'b']))) == ['a', 'b']
+    timings = sink.stats()['timings']
+    assert timings['function']['count'] == 1
+    assert timings['block']['count'] == 1
+    assert timings['output']['count'] == 1
+
+
+def test_memory_backend_timed():
+    from tiddlyweb.model.tiddler import Tiddler
+    from tiddlywebplugins.links.memory import MemoryLinksManager
+
+    sink = stats.configure_stats({'links.stats_sink': 'memory'})
+    sink.reset()
+    directory = tempfile.mkdtemp()
+    try:
+        links_manager = MemoryLinksManager({'tiddlyweb.config': {
+            'links.memory_path': os.path.join(directory, 'links.graph')}})
+        tiddler = Tiddler('timed', 'bag')
+        tiddler.text = '[[target]]'
+        links_manager.update_database(tiddler)
+        list(links_manager.export_links())
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    timings = sink.stats()['timings']
+    assert timings['db.update_links']['count'] == 1
+    assert links_manager.read_frontlinks(tiddler) == ['bag:target']
+
+
+def test_no_sink():
+    assert stats.configure_stats({'links.stats_sink': 'none'}) is None
+    assert stats.timed('block') is stats.NOT_TIMED
+    output = ['a']
+    assert stats.timed_output('output', output) is output
+    stats.count('nothing')
+    stats.configure_stats({})
+    assert isinstance(stats.get_sink(), stats.MemorySink)
+    stats.get_sink().count('something')
+    assert stats.get_sink().stats()['counters'] == {'something': 1}
+
+
+def test_profile_slow():
+    @stats.profiled
+    def handler(environ, start_response):
+        start_response('200 OK', [])
+        return ['done']
+
+    started = []
+    environ = {'PATH_INFO': '/bags/x/tiddlers/y/backlinks',
+            'tiddlyweb.config': {}}
+    assert handler(environ, lambda *args: started.append(args)) == ['done']
+    assert not os.listdir(PROFILE_DIR)
+
+    environ['tiddlyweb.config'] = {'links.profile_slow': 0,
+            'links.profile_dir': PROFILE_DIR}
+    assert handler(environ, lambda *args: started.append(args)) == ['done']
+    assert len(started) == 2
+    profiles = os.listdir(PROFILE_DIR)
+    assert len(profiles) == 1
+    assert profiles[0].endswith('bags_x_tiddlers_y_backlinks.prof')
@@ -1,7 +1,9 @@
 
 from tiddlywebplugins.links import init
 from tiddlywebplugins.links.parser import process_tiddler
+from tiddlywebplugins.links import linksmanager
 from tiddlywebplugins.links.linksmanager import LinksManager
+from tiddlywebplugins.links.base import _tiddler_key
 
 from tiddlyweb.model.bag import Bag
 from tiddlyweb.model.recipe import Recipe
@@ -11,6 +13,10 @@ from tiddlyweb.config import config
 from tiddlyweb.web import serve
 
 import os
+import json
+import shutil
+
+import pytest
 
 from wsgi_intercept import httplib2_intercept
 import wsgi_intercept
@@ -18,6 +24,10 @@ import httplib2
 
 def setup_module(module):
 
+    try:
+        shutil.rmtree('store')
+    except:
+        pass
     module.store = get_store(config)
 
     # cascade to deal with differently named files depending on 
@@ -26,14 +36,10 @@ def setup_module(module):
         os.unlink('links.db')
     except OSError:
         pass  # not there
+    linksmanager.MAPPED = False  # recreate the tables
     environ = {'tiddlyweb.config': config}
     module.links_manager = LinksManager(environ=environ)
 
-    try:
-        shutil.rmtree('store')
-    except:
-        pass
-    
     def app():
         return serve.load_app()
     httplib2_intercept.install()
@@ -177,3 +183,691 @@ def test_markdown():
     assert 'href="/bags/barney/tiddlers/WikiWord">WikiWord</a>' in content
     assert 'href="/bags/barney/tiddlers/freelink">freelink</a>' in content
     assert 'href="/recipes/cdent_public/tiddlers/BigOne">BigOne</a>' in content
+
+
+def test_unchanged_put_writes_nothing():
+    from sqlalchemy import event
+    from tiddlywebplugins.links import linksmanager
+
+    tiddler = Tiddler('diffed', 'barney')
+    tiddler.text = 'Some OneLink and [[two]] and @cdent'
+    store.put(tiddler)
+
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append((statement.split()[0].upper(), statement))
+
+    event.listen(linksmanager.ENGINE, 'before_cursor_execute', count)
+    try:
+        tiddler.tags = ['retagged']
+        store.put(tiddler)
+        # only the version stamps change
+        link_writes = [verb for verb, statement in statements
+                if verb != 'SELECT' and 'link_version' not in statement]
+        assert link_writes == [], statements
+
+        del statements[:]
+        tiddler.text = 'Some OneLink and [[three]] and @cdent'
+        store.put(tiddler)
+        link_writes = [verb for verb, statement in statements
+                if 'link_edge' in statement and verb != 'SELECT']
+        assert link_writes == ['DELETE', 'INSERT'], statements
+    finally:
+        event.remove(linksmanager.ENGINE, 'before_cursor_execute', count)
+
+    frontlinks = links_manager.read_frontlinks(tiddler)
+    assert sorted(frontlinks) == ['@cdent:', 'barney:OneLink',
+            'barney:three']
+
+
+def test_unchanged_put_not_parsed():
+    from tiddlywebplugins.links import stats
+
+    tiddler = Tiddler('reparsed', 'barney')
+    tiddler.text = 'A LinkOnce here'
+    store.put(tiddler)
+    version = links_manager.read_version(tiddler)[0]
+
+    def skipped():
+        counters = stats.get_sink().stats()['counters']
+        return counters.get('hook.put_unchanged', 0)
+
+    before = skipped()
+    parse = stats.get_sink().stats()['timings'].get(
+            'parser.process_data', {}).get('count', 0)
+    tiddler.fields['note'] = 'changed'
+    tiddler.modifier = 'someone'
+    store.put(tiddler)
+    assert skipped() == before + 1
+    assert stats.get_sink().stats()['timings'].get(
+            'parser.process_data', {}).get('count', 0) == parse
+    assert links_manager.read_version(tiddler)[0] == version + 1
+
+    tiddler.type = 'text/plain'
+    store.put(tiddler)
+    assert skipped() == before + 1
+    assert links_manager.read_frontlinks(tiddler) == []
+
+
+def test_put_stamps_only_changed():
+    store.put(Bag('stamped'))
+    hub = Tiddler('hub', 'stamped')
+    hub.text = 'a [[spoke 0]]'
+    store.put(hub)
+    spokes = []
+    for i in range(20):
+        spoke = Tiddler('spoke %s' % i, 'stamped')
+        spoke.text = 'back to [[hub]]'
+        store.put(spoke)
+        spokes.append(spoke)
+    versions = [links_manager.read_version(spoke) for spoke in spokes]
+    hub_version = links_manager.read_version(hub)[0]
+    stamp = links_manager.read_links_version(hub, 'back')
+
+    hub.tags = ['retagged']
+    store.put(hub)
+    assert links_manager.read_version(hub)[0] == hub_version + 1
+    assert [links_manager.read_version(spoke)
+            for spoke in spokes] == versions
+    assert links_manager.read_links_version(hub, 'back') != stamp
+
+    stamp = links_manager.read_links_version(hub, 'back')
+    spokes[5].tags = ['retagged']
+    store.put(spokes[5])
+    assert links_manager.read_version(hub)[0] == hub_version + 1
+    assert links_manager.read_links_version(hub, 'back') != stamp
+
+    # a new link bumps its target
+    hub.text = 'a [[spoke 0]] and [[spoke 1]]'
+    store.put(hub)
+    assert links_manager.read_version(spokes[1])[0] == versions[1][0] + 1
+    assert links_manager.read_version(spokes[2]) == versions[2]
+
+
+def test_bulk_insert_single_commit():
+    from sqlalchemy import event
+    from tiddlywebplugins.links import linksmanager
+
+    tiddler = Tiddler('many', 'barney')
+    tiddler.text = ' '.join('[[target %s]]' % i for i in range(200))
+    links_manager.delete_links(tiddler)
+
+    commits = []
+    executes = []
+
+    def count_commit(conn):
+        commits.append(conn)
+
+    def count_execute(conn, cursor, statement, parameters, context,
+            executemany):
+        if statement.startswith('INSERT'):
+            executes.append((statement.split('INTO')[1].split()[0],
+                executemany))
+
+    event.listen(linksmanager.ENGINE, 'commit', count_commit)
+    event.listen(linksmanager.ENGINE, 'before_cursor_execute', count_execute)
+    try:
+        links_manager.update_database(tiddler)
+    finally:
+        event.remove(linksmanager.ENGINE, 'commit', count_commit)
+        event.remove(linksmanager.ENGINE, 'before_cursor_execute',
+                count_execute)
+
+    assert len(commits) == 1
+    assert executes == [('link_node', True), ('link_edge', True)]
+    assert len(links_manager.read_frontlinks(tiddler)) == 200
+
+
+def test_bulk_replace_bound_parameters():
+    from sqlalchemy import event
+    from tiddlywebplugins.links import linksmanager
+
+    entries = []
+    for i in range(1200):
+        tiddler = Tiddler('bound %s' % i, 'bounded')
+        tiddler.text = '[[bound %s]]' % (i + 1)
+        entries.append((tiddler, process_tiddler(tiddler, config)))
+
+    bound = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            bound.append(len(parameters))
+
+    event.listen(linksmanager.ENGINE, 'before_cursor_execute', count)
+    try:
+        links_manager.replace_links_many(entries)
+    finally:
+        event.remove(linksmanager.ENGINE, 'before_cursor_execute', count)
+
+    # SQLite may be built to allow no more than 999
+    assert max(bound) < 999
+    assert links_manager.read_backlinks(Tiddler('bound 600', 'bounded')) == [
+            'bounded:bound 599']
+    links_manager.delete_sources([_tiddler_key(tiddler)
+        for tiddler, _ in entries])
+    assert links_manager.read_frontlinks(entries[0][0]) == []
+
+
+def test_refresh_links_parallel():
+    from tiddlywebplugins.links.refresh import refresh_links
+
+    tiddler = Tiddler('refreshed', 'barney')
+    tiddler.text = 'RefreshOne and [[refresh two]]'
+    store.put(tiddler)
+    links_manager.delete_links(tiddler)
+    assert links_manager.read_frontlinks(tiddler) == []
+
+    messages = []
+    count = refresh_links(store, workers=2, batch_size=2,
+            report=messages.append)
+
+    assert count > 2
+    assert len(messages) > 1
+    assert 'tiddlers/sec' in messages[0]
+    assert sorted(links_manager.read_frontlinks(tiddler)) == [
+            'barney:RefreshOne', 'barney:refresh two']
+
+
+def test_refresh_links_incremental():
+    from tiddlywebplugins.links.refresh import refresh_links
+
+    refresh_links(store)
+    messages = []
+    count = refresh_links(store, incremental=True, report=messages.append)
+    assert count == 0
+
+    tiddler = Tiddler('refreshed', 'barney')
+    tiddler.text = 'RefreshThree'
+    store.put(tiddler)
+    links_manager.delete_links(tiddler)
+
+    gone = Tiddler('gone', 'nosuchbag')
+    gone.text = 'GoneLink'
+    links_manager.update_database(gone)
+    assert links_manager.read_frontlinks(gone) == ['nosuchbag:GoneLink']
+
+    count = refresh_links(store, incremental=True, report=messages.append)
+    assert count == 1
+    assert links_manager.read_frontlinks(tiddler) == ['barney:RefreshThree']
+    assert links_manager.read_frontlinks(gone) == []
+    assert 'removed links for 1 missing tiddlers' in messages
+
+
+def test_migrate_links():
+    from tiddlywebplugins.links import linksmanager
+
+    linksmanager.LINK_TABLE.create(bind=linksmanager.ENGINE)
+    linksmanager.ENGINE.execute(linksmanager.LINK_TABLE.insert(), [
+        {'source': u'old:one', 'target': u'old:two'},
+        {'source': u'old:one', 'target': u'old:two'},
+        {'source': u'old:one', 'target': u'@cdent:'}])
+
+    count = links_manager.migrate_links(batch_size=2, drop=True)
+
+    assert count == 3
+    assert sorted(links_manager.read_frontlinks(Tiddler('one', 'old'))) == [
+            '@cdent:', 'old:two']
+    assert links_manager.read_backlinks(Tiddler('two', 'old')) == [
+            'old:one']
+    assert not linksmanager.LINK_TABLE.exists(bind=linksmanager.ENGINE)
+    assert links_manager.migrate_links() == 0
+
+
+def test_resolver_reads_once():
+    from tiddlyweb.store import HOOKS
+    from tiddlywebplugins.links import resolver as resolver_module
+    from tiddlywebplugins.links.resolver import LinkResolver
+
+    resolver_module.CONTAINER_CACHE = None
+    environ = {'tiddlyweb.store': store, 'tiddlyweb.config': config,
+            'tiddlyweb.usersign': {'name': 'GUEST', 'roles': []}}
+    gets = []
+
+    def count_get(store, thing):
+        gets.append(thing.name)
+
+    HOOKS['recipe']['get'].append(count_get)
+    HOOKS['bag']['get'].append(count_get)
+    try:
+        resolver = LinkResolver(environ)
+        for title in ['NotYou', 'Missing', 'NotYou']:
+            tiddler = Tiddler(title,
+                    resolver.bag_for('cdent_public', title) or 'barney')
+            tiddler.recipe = 'cdent_public'
+            assert resolver.readable(tiddler)
+    finally:
+        HOOKS['recipe']['get'].remove(count_get)
+        HOOKS['bag']['get'].remove(count_get)
+
+    assert resolver.bag_for('cdent_public', 'NotYou') == 'cdent_public'
+    assert resolver.bag_for('cdent_public', 'Missing') is None
+    assert sorted(gets) == ['barney', 'cdent_public', 'cdent_public']
+
+
+def test_container_cache_invalidation():
+    from tiddlywebplugins.links.resolver import LinkResolver
+
+    environ = {'tiddlyweb.store': store, 'tiddlyweb.config': config,
+            'tiddlyweb.usersign': {'name': 'GUEST', 'roles': []}}
+    resolver = LinkResolver(environ)
+    assert resolver.bag_for('cdent_public', 'LateComer') is None
+
+    resolver = LinkResolver(environ)
+    assert resolver.bag_for('cdent_public', 'LateComer') is None
+    stats = resolver.cache.stats()
+    assert stats['resolutions']['hits'] >= 1
+
+    tiddler = Tiddler('LateComer', 'cdent_public')
+    tiddler.text = 'here now'
+    store.put(tiddler)
+
+    resolver = LinkResolver(environ)
+    assert resolver.bag_for('cdent_public', 'LateComer') == 'cdent_public'
+
+    bag = store.get(Bag('cdent_public'))
+    bag.policy.read = ['NotGuest']
+    store.put(bag)
+    resolver = LinkResolver(environ)
+    assert not resolver.readable(tiddler)
+
+    bag.policy.read = []
+    store.put(bag)
+    store.delete(tiddler)
+
+
+def test_paged_backlinks():
+    store.put(Bag('paged'))
+    hub = Tiddler('Hub', 'paged')
+    hub.text = 'everyone links here'
+    store.put(hub)
+    for i in range(5):
+        tiddler = Tiddler('spoke%s' % i, 'paged')
+        tiddler.text = 'see [[Hub]]'
+        store.put(tiddler)
+
+    assert links_manager.read_backlinks(hub, limit=2) == [
+            'paged:spoke0', 'paged:spoke1']
+    assert links_manager.read_backlinks(hub, limit=2,
+            after='paged:spoke1') == ['paged:spoke2', 'paged:spoke3']
+    assert links_manager.read_backlinks(hub, after='paged:spoke3') == [
+            'paged:spoke4']
+
+    http = httplib2.Http()
+    url = 'http://0.0.0.0:8080/bags/paged/tiddlers/Hub/backlinks.json?limit=2'
+    titles = []
+    while url:
+        response, content = http.request(url)
+        assert response['status'] == '200', content
+        page = [tiddler['title'] for tiddler in json.loads(content)]
+        assert len(page) <= 2
+        titles.extend(page)
+        url = None
+        if 'link' in response:
+            url = response['link'].split('>')[0].lstrip('<')
+            assert url.endswith('limit=2&after=paged%3Aspoke' + page[-1][-1])
+    assert titles == ['spoke%s' % i for i in range(5)]
+
+
+def test_links_etag():
+    store.put(Bag('tagged'))
+    target = Tiddler('Target', 'tagged')
+    target.text = 'linked to'
+    store.put(target)
+    source = Tiddler('Source', 'tagged')
+    source.text = 'see [[Target]]'
+    store.put(source)
+
+    http = httplib2.Http()
+    url = 'http://0.0.0.0:8080/bags/tagged/tiddlers/Target/backlinks.json'
+    response, content = http.request(url)
+    assert response['status'] == '200', content
+    etag = response['etag']
+    assert 'last-modified' in response
+
+    gets = []
+    original_get = store.storage.tiddler_get
+
+    def counting_get(tiddler):
+        gets.append(tiddler.title)
+        return original_get(tiddler)
+
+    store.storage.tiddler_get = counting_get
+    try:
+        response, content = http.request(url,
+                headers={'If-None-Match': etag})
+        assert response['status'] == '304', content
+        assert gets == []
+
+        # a backlinking tiddler changing changes the backlinks
+        source.tags = ['changed']
+        store.put(source)
+        response, content = http.request(url,
+                headers={'If-None-Match': etag})
+        assert response['status'] == '200', content
+        assert response['etag'] != etag
+    finally:
+        store.storage.tiddler_get = original_get
+
+    # and so does a linked tiddler for frontlinks
+    url = 'http://0.0.0.0:8080/bags/tagged/tiddlers/Source/frontlinks.json'
+    response, content = http.request(url)
+    etag = response['etag']
+    target.tags = ['changed']
+    store.put(target)
+    response, content = http.request(url, headers={'If-None-Match': etag})
+    assert response['status'] == '200', content
+
+
+def test_backlink_counts():
+    store.put(Bag('counted'))
+    for title, text in [('One', 'no links'), ('Two', 'see [[One]]'),
+            ('Three', 'see [[One]] and [[Two]]')]:
+        tiddler = Tiddler(title, 'counted')
+        tiddler.text = text
+        store.put(tiddler)
+
+    counts = links_manager.count_backlinks_many([Tiddler('One', 'counted'),
+        Tiddler('Two', 'counted'), Tiddler('Three', 'counted')])
+    assert counts == {'counted:One': 2, 'counted:Two': 1,
+            'counted:Three': 0}
+
+    http = httplib2.Http()
+    response, content = http.request(
+            'http://0.0.0.0:8080/bags/counted/backlinkcounts')
+    assert response['status'] == '200', content
+    assert json.loads(content) == {'One': 2, 'Two': 1, 'Three': 0}
+
+    response, content = http.request(
+            'http://0.0.0.0:8080/bags/counted/backlinkcounts.json'
+            '?select=title:Two')
+    assert json.loads(content) == {'Two': 1}
+
+    response, content = http.request(
+            'http://0.0.0.0:8080/bags/nosuchbag/backlinkcounts')
+    assert response['status'] == '404', content
+
+
+def test_traversal():
+    store.put(Bag('walked'))
+    for title, text in [('A', '[[B]] [[C]]'), ('B', '[[D]]'),
+            ('C', '[[D]] [[A]]'), ('D', '[[E]]'), ('E', 'the end'),
+            ('Hub', '[[A]] [[X1]] [[X2]] [[X3]]')]:
+        tiddler = Tiddler(title, 'walked')
+        tiddler.text = text
+        store.put(tiddler)
+    start = Tiddler('A', 'walked')
+
+    assert links_manager.read_neighborhood(start, depth=2,
+            direction='front') == [('walked:B', 1), ('walked:C', 1),
+                    ('walked:D', 2)]
+    assert links_manager.read_neighborhood(start, depth=1,
+            direction='back') == [('walked:C', 1), ('walked:Hub', 1)]
+    # Hub and C have too many links to be walked through
+    assert links_manager.read_neighborhood(start, depth=2,
+            fan_out=2) == [('walked:B', 1), ('walked:C', 1),
+                    ('walked:Hub', 1), ('walked:D', 2)]
+    assert len(links_manager.read_neighborhood(start, depth=2, limit=3)) == 3
+    assert links_manager.read_neighborhood(start, depth=2, limit=2) == [
+            ('walked:B', 1), ('walked:C', 1)]
+
+    assert links_manager.read_path(start, Tiddler('E', 'walked')) in (
+            ['walked:A', 'walked:B', 'walked:D', 'walked:E'],
+            ['walked:A', 'walked:C', 'walked:D', 'walked:E'])
+    assert links_manager.read_path(start, Tiddler('E', 'walked'),
+            depth=2) == []
+    assert links_manager.read_path(Tiddler('E', 'walked'), start) == []
+
+    http = httplib2.Http()
+    response, content = http.request('http://0.0.0.0:8080/bags/walked/'
+            'tiddlers/A/neighborhood.json?depth=2&direction=front')
+    assert response['status'] == '200', content
+    assert [tiddler['title'] for tiddler in json.loads(content)] == [
+            'B', 'C', 'D']
+
+    response, content = http.request('http://0.0.0.0:8080/bags/walked/'
+            'tiddlers/C/path/walked/E.json')
+    assert response['status'] == '200', content
+    assert [tiddler['title'] for tiddler in json.loads(content)] == [
+            'C', 'D', 'E']
+
+    response, content = http.request('http://0.0.0.0:8080/bags/walked/'
+            'tiddlers/A/neighborhood.json?fanout=2')
+    assert response['status'] == '200', content
+    assert [tiddler['title'] for tiddler in json.loads(content)] == [
+            'B', 'C', 'Hub', 'D']
+
+    # depth is bounded by links.max_depth
+    response, content = http.request('http://0.0.0.0:8080/bags/walked/'
+            'tiddlers/A/path/walked/E.json?depth=3')
+    assert response['status'] == '200', content
+    assert json.loads(content) == []
+
+    response, content = http.request('http://0.0.0.0:8080/bags/walked/'
+            'tiddlers/A/neighborhood?direction=sideways')
+    assert response['status'] == '400', content
+
+
+@pytest.mark.parametrize('backend', ['sqlite3', 'memory'])
+def test_reports_unsupported(backend):
+    from tiddlywebplugins.links import memory
+
+    store.put(Bag('unsupported'))
+    tiddler = Tiddler('Here', 'unsupported')
+    tiddler.text = '[[There]]'
+    store.put(tiddler)
+
+    config['linkdb_backend'] = backend
+    config['links.sqlite_path'] = 'test_tiddler.sqlite'
+    config['links.memory_path'] = 'test_tiddler.graph'
+    http = httplib2.Http()
+    try:
+        for path in ['orphans', 'wanted', 'tiddlers/Here/neighborhood',
+                'tiddlers/Here/path/unsupported/There']:
+            response, content = http.request(
+                    'http://0.0.0.0:8080/bags/unsupported/%s' % path)
+            assert response['status'] == '404', content
+            assert 'a SQL links database' in content
+    finally:
+        del config['linkdb_backend']
+        del config['links.sqlite_path']
+        del config['links.memory_path']
+        memory.GRAPHS.clear()
+        for filename in ['test_tiddler.sqlite', 'test_tiddler.sqlite-wal',
+                'test_tiddler.sqlite-shm', 'test_tiddler.graph.snapshot',
+                'test_tiddler.graph.log']:
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+
+
+def test_orphans_and_wanted():
+    store.put(Bag('reported'))
+    for title, text in [('Lonely', 'nobody links here, I link [[Gone]]'),
+            ('Liked', 'I am linked'), ('Linker', '[[Liked]] [[Gone]] MissingOne')]:
+        tiddler = Tiddler(title, 'reported')
+        tiddler.text = text
+        store.put(tiddler)
+    binary = Tiddler('Picture', 'reported')
+    binary.type = 'image/png'
+    binary.text = 'bytes Liked'
+    store.put(binary)
+
+    assert links_manager.list_orphans('reported') == ['reported:Linker',
+            'reported:Lonely', 'reported:Picture']
+    assert links_manager.list_wanted('reported') == [('reported:Gone', 2),
+            ('reported:MissingOne', 1)]
+
+    store.delete(Tiddler('Liked', 'reported'))
+    assert links_manager.list_wanted('reported') == [('reported:Gone', 2),
+            ('reported:Liked', 1), ('reported:MissingOne', 1)]
+
+    # a bag whose name differs only in case is another bag
+    links_manager.replace_links(Tiddler('Cased', 'Reported'),
+            [('Absent', None)])
+    assert ('Reported:Absent', 1) not in links_manager.list_wanted('reported')
+    assert links_manager.list_wanted('Reported') == [('Reported:Absent', 1)]
+
+    http = httplib2.Http()
+    response, content = http.request(
+            'http://0.0.0.0:8080/bags/reported/orphans.json')
+    assert response['status'] == '200', content
+    assert [tiddler['title'] for tiddler in json.loads(content)] == [
+            'Linker', 'Lonely', 'Picture']
+
+    response, content = http.request(
+            'http://0.0.0.0:8080/bags/reported/wanted.json')
+    assert response['status'] == '200', content
+    assert [tiddler['title'] for tiddler in json.loads(content)] == [
+            'Gone', 'Liked', 'MissingOne']
+
+
+def test_links_stats():
+    from tiddlywebplugins.links import stats
+
+    for title, text in [('Measured', 'linked to'),
+            ('Measuring', 'see [[Measured]]')]:
+        tiddler = Tiddler(title, 'barney')
+        tiddler.text = text
+        store.put(tiddler)
+
+    http = httplib2.Http()
+    response, content = http.request(
+            'http://0.0.0.0:8080/bags/barney/tiddlers/Measured/backlinks.json')
+    assert response['status'] == '200', content
+
+    response, content = http.request('http://0.0.0.0:8080/links/stats')
+    assert response['status'] == '200', content
+    assert response['content-type'] == 'application/json'
+    report = json.loads(content)
+    for name in ('hook.put', 'parser.process_data', 'db.read_backlinks',
+            'links.host', 'links.read', 'links.collect', 'links.serialize'):
+        timing = report['timings'][name]
+        assert timing['count'] >= 1
+        assert timing['p50_ms'] <= timing['p99_ms'] <= timing['max_ms']
+    assert report['counters']['links.store_gets'] >= 1
+    assert 'hits' in report['caches']['parse']
+
+    config['links.stats_sink'] = 'none'
+    try:
+        response, content = http.request('http://0.0.0.0:8080/links/stats')
+        assert response['status'] == '404'
+        assert stats.get_sink() is None
+    finally:
+        del config['links.stats_sink']
+        stats.configure_stats(config)
+
+
+def test_links_dump():
+    from tiddlywebplugins.links.dump import dump_links, load_links
+
+    store.put(Bag('dumped'))
+    for title, text in [('Alpha', '[[Beta]] and http://example.org/'),
+            ('Beta', '@cdent [[Alpha]]')]:
+        tiddler = Tiddler(title, 'dumped')
+        tiddler.text = text
+        store.put(tiddler)
+
+    http = httplib2.Http()
+    response, content = http.request(
+            'http://0.0.0.0:8080/bags/dumped/links.jsonl')
+    assert response['status'] == '200', content
+    assert response['content-type'] == 'application/x-ndjson'
+    links = [json.loads(line) for line in content.splitlines()]
+    assert sorted((link['source'], link['target'], link['kind'])
+            for link in links) == [
+                    ('dumped:Alpha', 'dumped:Beta', 'tiddler'),
+                    ('dumped:Alpha', 'http://example.org/', 'external'),
+                    ('dumped:Beta', '@cdent:', 'space'),
+                    ('dumped:Beta', 'dumped:Alpha', 'tiddler')]
+
+    response, content = http.request(
+            'http://0.0.0.0:8080/bags/dumped/links.jsonl?kind=space,external')
+    assert response['status'] == '200', content
+    assert sorted(json.loads(line)['target']
+            for line in content.splitlines()) == [
+                    '@cdent:', 'http://example.org/']
+
+    response, content = http.request(
+            'http://0.0.0.0:8080/bags/dumped/links.jsonl?kind=bogus')
+    assert response['status'] == '400', content
+
+    response, content = http.request(
+            'http://0.0.0.0:8080/bags/nosuchbag/links.jsonl')
+    assert response['status'] == '404'
+
+    lines = [line.replace('dumped:', 'loaded:') for line in dump_links(
+        links_manager, 'dumped')]
+    assert load_links(links_manager, lines) == 4
+    assert links_manager.read_backlinks(Tiddler('Alpha', 'loaded')) == [
+            'loaded:Beta']
+    # the sources are known tiddlers, so nothing is wanted
+    assert links_manager.list_wanted('loaded') == []
+
+    with pytest.raises(ValueError):
+        load_links(links_manager, ['{"source": "x:y"}'])
+
+
+def test_frontlinks_read_only_tiddlers():
+    tiddler = Tiddler('outward', 'barney')
+    tiddler.text = ' '.join(['http://example.com/%d' % index
+        for index in range(20)] + ['[[near]]', '[[nearer]]', '@cdent'])
+    store.put(tiddler)
+
+    http = httplib2.Http()
+    response, content = http.request(
+            'http://0.0.0.0:8080/bags/barney/tiddlers/outward/frontlinks.json'
+            '?limit=1')
+    assert response['status'] == '200', content
+    assert [link['title'] for link in json.loads(content)] == ['near']
+    assert 'after=barney%3Anear' in response['link']
+
+    response, content = http.request(
+            'http://0.0.0.0:8080/bags/barney/tiddlers/outward/frontlinks.json'
+            '?limit=1;after=barney%3Anear')
+    assert [link['title'] for link in json.loads(content)] == ['nearer']
+    assert 'link' not in response
+
+
+def test_streamed_links():
+    from tiddlywebplugins.links.collection import LinkTiddlers
+
+    store.put(Bag('streamed'))
+    for title, text in [('Hub', 'the middle'), ('Spoke1', '[[Hub]]'),
+            ('Spoke2', '[[Hub]] [[Spoke1]]'), ('Spoke3', '[[Hub]]')]:
+        tiddler = Tiddler(title, 'streamed')
+        tiddler.text = text
+        store.put(tiddler)
+
+    http = httplib2.Http()
+    base = 'http://0.0.0.0:8080/bags/streamed/tiddlers/Hub/backlinks.json'
+    urls = [base, base + '?select=title:!Spoke2;sort=-title',
+            base + '?limit=2', base.replace('.json', '.txt')]
+    eager = [http.request(url) for url in urls]
+
+    config['links.stream'] = True
+    try:
+        streamed = [http.request(url) for url in urls]
+    finally:
+        del config['links.stream']
+
+    for (eager_response, eager_content), (response, content) in zip(
+            eager, streamed):
+        assert response['status'] == '200', content
+        assert content == eager_content
+        # the version stamp still gives an etag
+        assert response['etag'] == eager_response['etag']
+    assert [tiddler['title'] for tiddler in json.loads(streamed[1][1])] == [
+            'Spoke3', 'Spoke1']
+
+    environ = {'tiddlyweb.config': config, 'tiddlyweb.store': store,
+            'tiddlyweb.usersign': {'name': 'GUEST', 'roles': []}}
+    tiddlers = LinkTiddlers(environ, ['streamed:Spoke1', 'streamed:Gone',
+        'http://example.com/'], 'streamed')
+    tiddlers = iter(tiddlers)
+    first = tiddlers.next()
+    assert first.title == 'Spoke1' and first.text == '[[Hub]]'
+    assert tiddlers.next().title == 'Gone'
+    assert list(tiddlers) == []
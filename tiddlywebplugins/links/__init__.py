@@ -5,36 +5,67 @@ but used as a backlinks database.
 """
 
 import logging
+import re
+import simplejson
+import sys
+
+from hashlib import sha1
+
+from optparse import OptionParser
 
 from httpexceptor import HTTP404, HTTP400
 
-from tiddlyweb.control import determine_bag_from_recipe
+from tiddlyweb.filters import FilterError, recursive_filter
 from tiddlyweb.manage import make_command
-from tiddlyweb.web.util import get_route_value
 from tiddlyweb.model.bag import Bag
-from tiddlyweb.model.policy import PermissionsError
-from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.web.util import (get_route_value, server_host_url,
+        encode_name, get_serialize_type, check_incoming_etag,
+        check_last_modified, http_date_from_timestamp, handle_extension)
 from tiddlyweb.model.tiddler import Tiddler
 from tiddlyweb.model.collections import Tiddlers
 from tiddlyweb.store import StoreError, HOOKS
+from tiddlyweb.util import std_error_message
 from tiddlyweb.web.sendtiddlers import send_tiddlers
 
 from tiddlywebplugins.utils import get_store
 
-from tiddlywebplugins.links.linksmanager import LinksManager
-from tiddlywebplugins.links.parser import is_link
+from tiddlywebplugins.links.backends import get_links_manager
+from tiddlywebplugins.links.base import DIRECTIONS, index_digest, _tiddler_key
+from tiddlywebplugins.links.collection import (LinkTiddlers, link_tiddlers,
+        load_tiddler)
+from tiddlywebplugins.links.dump import (chunk_lines, dump_links, load_links,
+        parse_kinds)
+from tiddlywebplugins.links.indexer import get_indexer
+from tiddlywebplugins.links.parser import (is_parseable, get_parse_cache,
+        process_tiddler)
+from tiddlywebplugins.links.refresh import refresh_links
+from tiddlywebplugins.links.resolver import (bag_change_hook,
+        recipe_change_hook, tiddler_change_hook, get_container_cache)
+from tiddlywebplugins.links.stats import (configure_stats, get_sink, count,
+        timed, timed_output, instrumented, profiled)
 
 
 LOGGER = logging.getLogger(__name__)
 
+MAX_DEPTH = 2
+MAX_FAN_OUT = 100
+TIDDLER_KINDS = ('tiddler',)
+MAX_NEIGHBORS = 500
+
 
 def init(config):
     """
     Add the back and front links handlers.
     """
-    # Establish hooks
-    HOOKS['tiddler']['put'].append(tiddler_put_hook)
-    HOOKS['tiddler']['delete'].append(tiddler_delete_hook)
+    configure_stats(config)
+
+    # Establish hooks, once, however many times init is called
+    _add_hook('tiddler', 'put', tiddler_put_hook)
+    _add_hook('tiddler', 'delete', tiddler_delete_hook)
+    for action in ['put', 'delete']:
+        _add_hook('tiddler', action, tiddler_change_hook)
+        _add_hook('bag', action, bag_change_hook)
+        _add_hook('recipe', action, recipe_change_hook)
 
     if 'selector' in config:
         base = '/bags/{bag_name:segment}/tiddlers/{tiddler_name:segment}'
@@ -42,47 +73,182 @@ def init(config):
                 GET=get_backlinks)
         config['selector'].add(base + '/frontlinks[.{format}]',
                 GET=get_frontlinks)
+        config['selector'].add(base + '/neighborhood[.{format}]',
+                GET=get_neighborhood)
+        config['selector'].add(base + '/path/{target_bag:segment}/'
+                '{target_name:segment}[.{format}]', GET=get_path)
+        config['selector'].add('/bags/{bag_name:segment}/backlinkcounts'
+                '[.{format}]', GET=get_backlink_counts)
+        config['selector'].add('/bags/{bag_name:segment}/orphans[.{format}]',
+                GET=get_orphans)
+        config['selector'].add('/bags/{bag_name:segment}/wanted[.{format}]',
+                GET=get_wanted)
+        config['selector'].add('/bags/{bag_name:segment}/links.jsonl',
+                GET=get_links_dump)
+        config['selector'].add('/links/stats', GET=get_stats)
 
     @make_command()
     def refreshlinksdb(args):
-        """Refresh the back and front links database."""
+        """Refresh the links database.
+        [--incremental] [--workers N] [--batch N]"""
+        parser = OptionParser(prog='refreshlinksdb')
+        parser.add_option('--workers', type='int',
+                help='number of parser processes')
+        parser.add_option('--batch', type='int', dest='batch_size',
+                help='tiddlers written per transaction')
+        parser.add_option('--incremental', action='store_true',
+                default=False, help='only parse new or changed tiddlers')
+        options, _ = parser.parse_args(args)
+
+        store = get_store(config)
+        refresh_links(store, workers=options.workers,
+                batch_size=options.batch_size, report=std_error_message,
+                incremental=options.incremental)
+
+    @make_command()
+    def migratelinksdb(args):
+        """Copy links from the old link table to link_node and link_edge.
+        [--drop]"""
+        parser = OptionParser(prog='migratelinksdb')
+        parser.add_option('--batch', type='int', dest='batch_size',
+                default=500, help='rows copied per transaction')
+        parser.add_option('--drop', action='store_true', default=False,
+                help='drop the old link table when done')
+        options, _ = parser.parse_args(args)
+
+        store = get_store(config)
+        links_manager = get_links_manager(store.environ)
+        migrated = links_manager.migrate_links(
+                batch_size=options.batch_size, drop=options.drop)
+        std_error_message('migrated %d links' % migrated)
+
+    @make_command()
+    def orphantiddlers(args):
+        """List the tiddlers in a bag which no tiddler links to. <bag>"""
+        store = get_store(config)
+        links_manager = get_links_manager(store.environ)
+        try:
+            orphans = links_manager.list_orphans(args[0])
+        except NotImplementedError, exc:
+            std_error_message('%s' % exc)
+            sys.exit(1)
+        for key in orphans:
+            sys.stdout.write('%s\n' % key.split(':', 1)[1].encode('utf-8'))
+
+    @make_command()
+    def wantedtiddlers(args):
+        """List the missing tiddlers in a bag which are linked to, with
+        link counts. <bag>"""
+        store = get_store(config)
+        links_manager = get_links_manager(store.environ)
+        try:
+            wanted = links_manager.list_wanted(args[0])
+        except NotImplementedError, exc:
+            std_error_message('%s' % exc)
+            sys.exit(1)
+        for key, wanted_count in wanted:
+            sys.stdout.write('%s\t%d\n'
+                    % (key.split(':', 1)[1].encode('utf-8'), wanted_count))
+
+    @make_command()
+    def exportlinks(args):
+        """Write the links database, or the links from a bag, as JSON
+        lines. [--output FILE] [--kind KINDS] [bag]"""
+        parser = OptionParser(prog='exportlinks')
+        parser.add_option('--output', help='file to write, default stdout')
+        parser.add_option('--kind', action='append', default=[],
+                help='kinds of link to write: tiddler, space, external')
+        options, args = parser.parse_args(args)
+        kinds = parse_kinds(options.kind)
+
+        store = get_store(config)
+        links_manager = get_links_manager(store.environ)
+        if options.output:
+            output = open(options.output, 'w')
+        else:
+            output = sys.stdout
+        try:
+            for chunk in chunk_lines(dump_links(links_manager,
+                    args[0] if args else None, kinds)):
+                output.write(chunk)
+        finally:
+            if options.output:
+                output.close()
+
+    @make_command()
+    def importlinks(args):
+        """Add links from JSON lines, as written by exportlinks, to the
+        links database. [--clear] [--batch N] [file]"""
+        parser = OptionParser(prog='importlinks')
+        parser.add_option('--batch', type='int', dest='batch_size',
+                default=500, help='links written per transaction')
+        parser.add_option('--clear', action='store_true', default=False,
+                help='remove all stored links first')
+        options, args = parser.parse_args(args)
+
         store = get_store(config)
+        links_manager = get_links_manager(store.environ)
+        if options.clear:
+            links_manager.delete_sources(links_manager.list_sources())
+        if args:
+            lines = open(args[0])
+        else:
+            lines = sys.stdin
+        try:
+            imported = load_links(links_manager, lines,
+                    batch_size=options.batch_size)
+        finally:
+            if args:
+                lines.close()
+        std_error_message('imported %d links' % imported)
+
 
-        links_manager = LinksManager(store.environ)
-        for bag in store.list_bags():
-            LOGGER.debug('updating links for tiddlers in bag: %s', bag.name)
-            for tiddler in store.list_bag_tiddlers(bag):
-                tiddler = store.get(tiddler)  # we must get text
-                links_manager.delete_links(tiddler)
-                if _is_parseable(tiddler):
-                    links_manager.update_database(tiddler)
+def _add_hook(entity, action, hook):
+    if hook not in HOOKS[entity][action]:
+        HOOKS[entity][action].append(hook)
 
 
+@instrumented('hook.put')
 def tiddler_put_hook(store, tiddler):
     """
-    Update the links database with data from this tiddler.
+    Update the links database with data from this tiddler. If its
+    text and type are as last indexed, as when only tags or fields
+    change, it is not parsed again.
     """
-    links_manager = LinksManager(store.environ)
-    links_manager.delete_links(tiddler)
-    if _is_parseable(tiddler):
-        links_manager.update_database(tiddler)
-
-
-def _is_parseable(tiddler):
-    return (not tiddler.type
-            or tiddler.type == 'None'
-            or tiddler.type == 'text/x-markdown'
-            or tiddler.type == 'text/x-tiddlywiki')
+    indexer = get_indexer(store.environ)
+    if indexer:
+        indexer.put(tiddler)
+        return
+
+    links_manager = get_links_manager(store.environ)
+    digest = index_digest(tiddler)
+    if links_manager.skip_unchanged([(tiddler, digest)]):
+        count('hook.put_unchanged')
+        return
+    if is_parseable(tiddler):
+        links = process_tiddler(tiddler,
+                store.environ.get('tiddlyweb.config', {}))
+    else:
+        # no links, but still a tiddler others may link to
+        links = []
+    links_manager.replace_links_many([(tiddler, links, digest)])
 
 
+@instrumented('hook.delete')
 def tiddler_delete_hook(store, tiddler):
     """
     Remove links data associated with deleted tiddler.
     """
-    links_manager = LinksManager(store.environ)
+    indexer = get_indexer(store.environ)
+    if indexer:
+        indexer.delete(tiddler)
+        return
+
+    links_manager = get_links_manager(store.environ)
     links_manager.delete_links(tiddler)
 
 
+@profiled
 def get_backlinks(environ, start_response):
     """
     Return backlinks as a list of tiddlers.
@@ -90,6 +256,7 @@ def get_backlinks(environ, start_response):
     return _get_links(environ, start_response, 'backlinks')
 
 
+@profiled
 def get_frontlinks(environ, start_response):
     """
     Return frontlinks as a list of tiddlers.
@@ -97,6 +264,130 @@ def get_frontlinks(environ, start_response):
     return _get_links(environ, start_response, 'frontlinks')
 
 
+@profiled
+def get_backlink_counts(environ, start_response):
+    """
+    Return a JSON dict of title to the number of backlinks for
+    the tiddlers in a bag, or those of them selected by filters.
+    Only the bag listing is read from the store, unless filters
+    need more.
+    """
+    bag_name = get_route_value(environ, 'bag_name')
+    store = environ['tiddlyweb.store']
+    filters = environ['tiddlyweb.filters']
+
+    bag = _get_bag(environ, bag_name)
+
+    tiddlers = store.list_bag_tiddlers(bag)
+    if filters:
+        try:
+            tiddlers = list(recursive_filter(filters, tiddlers))
+        except FilterError, exc:
+            raise HTTP400('malformed filter: %s' % exc)
+    else:
+        tiddlers = list(tiddlers)
+
+    counts = get_links_manager(environ).count_backlinks_many(tiddlers)
+    output = simplejson.dumps(dict((tiddler.title,
+        counts[_tiddler_key(tiddler)]) for tiddler in tiddlers))
+
+    start_response('200 OK', [('Content-Type', 'application/json'),
+        ('Cache-Control', 'no-cache')])
+    return [output]
+
+
+@profiled
+def get_orphans(environ, start_response):
+    """
+    Return the tiddlers in a bag which no tiddler links to, as a
+    list of tiddlers.
+    """
+    bag_name = get_route_value(environ, 'bag_name')
+    _get_bag(environ, bag_name)
+
+    try:
+        orphans = get_links_manager(environ).list_orphans(bag_name)
+    except NotImplementedError, exc:
+        raise HTTP404('%s' % exc)
+
+    tiddlers = _links_collection(environ, 'orphans in %s' % bag_name,
+            orphans, bag_name)
+    return _send_links(environ, start_response, tiddlers)
+
+
+@profiled
+def get_wanted(environ, start_response):
+    """
+    Return the tiddlers in a bag which are linked to but do not
+    exist, most linked first, as a list of tiddlers.
+    """
+    bag_name = get_route_value(environ, 'bag_name')
+    _get_bag(environ, bag_name)
+
+    try:
+        wanted = get_links_manager(environ).list_wanted(bag_name)
+    except NotImplementedError, exc:
+        raise HTTP404('%s' % exc)
+
+    tiddlers = _links_collection(environ, 'wanted in %s' % bag_name,
+            [key for key, _ in wanted], bag_name)
+    return _send_links(environ, start_response, tiddlers)
+
+
+def get_links_dump(environ, start_response):
+    """
+    Stream the links from the tiddlers in a bag as JSON lines, only
+    those of the kinds given with 'kind' if it is.
+    """
+    bag_name = get_route_value(environ, 'bag_name')
+    _get_bag(environ, bag_name)
+    try:
+        kinds = parse_kinds(environ.get('tiddlyweb.query', {}).get('kind',
+            []))
+    except ValueError, exc:
+        raise HTTP400('%s' % exc)
+
+    output = chunk_lines(dump_links(get_links_manager(environ), bag_name,
+        kinds))
+    start_response('200 OK', [('Content-Type', 'application/x-ndjson'),
+        ('Cache-Control', 'no-cache')])
+    return output
+
+
+def get_stats(environ, start_response):
+    """
+    Return the timings and counters of the stats sink, and those of
+    the parse and container caches, as JSON.
+    """
+    sink = get_sink()
+    if sink is None or not hasattr(sink, 'stats'):
+        raise HTTP404('links stats are not kept')
+    config = environ['tiddlyweb.config']
+
+    stats = sink.stats()
+    stats['caches'] = {}
+    for name, cache in (('parse', get_parse_cache(config)),
+            ('containers', get_container_cache(config))):
+        if cache is not None:
+            stats['caches'][name] = cache.stats()
+
+    start_response('200 OK', [('Content-Type', 'application/json'),
+        ('Cache-Control', 'no-cache')])
+    return [simplejson.dumps(stats)]
+
+
+def _get_bag(environ, bag_name):
+    """
+    Load the named bag, or raise 404, and check it may be read.
+    """
+    try:
+        bag = environ['tiddlyweb.store'].get(Bag(bag_name))
+    except StoreError, exc:
+        raise HTTP404('No such bag: %s, %s' % (bag_name, exc))
+    bag.policy.allows(environ['tiddlyweb.usersign'], 'read')
+    return bag
+
+
 def _get_links(environ, start_response, linktype):
     """
     Form the links as tiddlers and then send them
@@ -106,99 +397,257 @@ def _get_links(environ, start_response, linktype):
     """
     bag_name = get_route_value(environ, 'bag_name')
     tiddler_title = get_route_value(environ, 'tiddler_name')
-    store = environ['tiddlyweb.store']
-    filters = environ['tiddlyweb.filters']
-    collection_title = '%s for %s' % (linktype, tiddler_title)
 
-    link = environ['SCRIPT_NAME']
+    host_tiddler = Tiddler(tiddler_title, bag_name)
+    links_manager = get_links_manager(environ)
+
+    # answer a conditional request before going to the store
+    with timed('links.validate'):
+        headers = _validate_links(environ, links_manager, host_tiddler,
+                linktype)
+
+    with timed('links.host'):
+        host_tiddler = _get_host_tiddler(environ, host_tiddler)
+
+    limit, after = _page(environ)
+
     try:
-        extension = environ['tiddlyweb.extension']
-        link = link.rsplit('.%s' % extension)[0]
-    except KeyError:
-        pass
+        reader = getattr(links_manager, 'read_%s' % linktype)
+    except AttributeError, exc:
+        raise HTTP400('invalid links type: %s' % exc)
+    # only links to tiddlers can be sent as tiddlers, so the others
+    # are left in the database
+    with timed('links.read'):
+        if limit is None:
+            links = reader(host_tiddler, after=after, kinds=TIDDLER_KINDS)
+        else:
+            # read one more than the page to learn if there is a next
+            links = reader(host_tiddler, limit=limit + 1, after=after,
+                    kinds=TIDDLER_KINDS)
+            if len(links) > limit:
+                links = links[:limit]
+                headers.append(('Link', '<%s>; rel="next"'
+                    % _next_page(environ, links[-1])))
 
-    host_tiddler = Tiddler(tiddler_title, bag_name)
+    with timed('links.collect'):
+        tiddlers = _links_collection(environ,
+                '%s for %s' % (linktype, tiddler_title), links, bag_name)
+
+    with timed('links.send'):
+        output = _send_links(environ, start_response, tiddlers, headers)
+    return timed_output('links.serialize', output)
+
+
+@profiled
+def get_neighborhood(environ, start_response):
+    """
+    Return the tiddlers within 'depth' links of a tiddler, nearest
+    first, as a list of tiddlers. 'direction' is front, back or
+    both and 'fanout' stops the walk at tiddlers with more links.
+    """
+    bag_name = get_route_value(environ, 'bag_name')
+    tiddler_title = get_route_value(environ, 'tiddler_name')
+    depth, direction, fan_out = _walk_arguments(environ, 'both')
+    limit = int(environ['tiddlyweb.config'].get('links.max_neighbors',
+        MAX_NEIGHBORS))
+
+    host_tiddler = _get_host_tiddler(environ, Tiddler(tiddler_title,
+        bag_name))
+    try:
+        links = [key for key, _ in get_links_manager(
+            environ).read_neighborhood(host_tiddler, depth=depth,
+                direction=direction, fan_out=fan_out, limit=limit)]
+    except NotImplementedError, exc:
+        raise HTTP404('%s' % exc)
+
+    tiddlers = _links_collection(environ,
+            'neighborhood of %s' % tiddler_title, links, bag_name)
+    return _send_links(environ, start_response, tiddlers)
+
+
+@profiled
+def get_path(environ, start_response):
+    """
+    Return the tiddlers along a shortest path of links from one
+    tiddler to another as a list of tiddlers, empty if there is no
+    path within 'depth' links.
+    """
+    bag_name = get_route_value(environ, 'bag_name')
+    tiddler_title = get_route_value(environ, 'tiddler_name')
+    target_bag = get_route_value(environ, 'target_bag')
+    target_title = handle_extension(environ,
+            get_route_value(environ, 'target_name'))
+    depth, direction, fan_out = _walk_arguments(environ, 'front')
+
+    source = _get_host_tiddler(environ, Tiddler(tiddler_title, bag_name))
+    target = Tiddler(target_title, target_bag)
     try:
-        host_tiddler = store.get(host_tiddler)
+        links = get_links_manager(environ).read_path(source, target,
+                depth=depth, direction=direction, fan_out=fan_out)
+    except NotImplementedError, exc:
+        raise HTTP404('%s' % exc)
+
+    tiddlers = _links_collection(environ, 'path from %s to %s'
+            % (tiddler_title, target_title), links, bag_name)
+    return _send_links(environ, start_response, tiddlers)
+
+
+def _walk_arguments(environ, direction):
+    """
+    Read depth, direction and fanout from the query, bounding depth
+    by links.max_depth and fanout by links.max_fan_out.
+    """
+    config = environ['tiddlyweb.config']
+    query = environ['tiddlyweb.query']
+    max_depth = int(config.get('links.max_depth', MAX_DEPTH))
+    max_fan_out = int(config.get('links.max_fan_out', MAX_FAN_OUT))
+    try:
+        depth = int(query.get('depth', [max_depth])[0])
+        fan_out = int(query.get('fanout', [max_fan_out])[0])
+    except ValueError, exc:
+        raise HTTP400('invalid depth or fanout: %s' % exc)
+    direction = query.get('direction', [direction])[0]
+    if direction not in DIRECTIONS:
+        raise HTTP400('invalid direction: %s' % direction)
+    return (max(min(depth, max_depth), 1), direction,
+            max(min(fan_out, max_fan_out), 0))
+
+
+def _get_host_tiddler(environ, tiddler):
+    """
+    Load the tiddler whose links are asked for, or raise 404.
+    """
+    try:
+        return environ['tiddlyweb.store'].get(tiddler)
     except StoreError, exc:
-        raise HTTP404('No such tiddler: %s:%s, %s' % (host_tiddler.bag,
-            host_tiddler.title, exc))
+        raise HTTP404('No such tiddler: %s:%s, %s' % (tiddler.bag,
+            tiddler.title, exc))
 
-    links_manager = LinksManager(environ)
 
+def _links_collection(environ, title, links, bag_name):
+    """
+    Make a Tiddlers collection of the readable tiddlers named by
+    link keys, to send. Links without a bag are taken to be in
+    bag_name. If links.stream is set the tiddlers are loaded as
+    they are sent, otherwise now.
+    """
+    link = environ['SCRIPT_NAME']
     try:
-        links = getattr(links_manager, 'read_%s' % linktype)(host_tiddler)
-    except AttributeError, exc:
-        raise HTTP400('invalid links type: %s' % exc)
+        extension = environ['tiddlyweb.extension']
+        link = link.rsplit('.%s' % extension)[0]
+    except KeyError:
+        pass
 
-    if filters:
-        tiddlers = Tiddlers(title=collection_title)
+    store = environ['tiddlyweb.store']
+    if environ['tiddlyweb.config'].get('links.stream', False):
+        tiddlers = LinkTiddlers(environ, links, bag_name, title=title)
     else:
-        tiddlers = Tiddlers(title=collection_title, store=store)
+        if environ['tiddlyweb.filters']:
+            tiddlers = Tiddlers(title=title)
+        else:
+            tiddlers = Tiddlers(title=title, store=store)
+        for tiddler in link_tiddlers(environ, links, bag_name):
+            tiddlers.add(load_tiddler(store, tiddler))
     tiddlers.link = link
+    return tiddlers
 
-    # continue over entries in database from previous format
-    for link in links:
-        if is_link(link):  # external link
-            continue
-        else:
-            container, title = link.split(':', 1)
-            if not title:  # plain space link
-                continue
-            elif title:
-                if container != bag_name:
-                    if container.endswith('_public'):
-                        try:
-                            recipe = Recipe(container)
-                            recipe = store.get(recipe)
-                            tiddler = Tiddler(title)
-                            tiddler.recipe = container
-                            bag = determine_bag_from_recipe(recipe, tiddler,
-                                    environ)
-                            tiddler.bag = bag.name
-                        except StoreError, exc:
-                            tiddler = Tiddler(title, bag_name)
-                            tiddler.recipe = container
-                    else:
-                        tiddler = Tiddler(title, container)
-                else:
-                    tiddler = Tiddler(title, bag_name)
-                try:
-                    tiddler = store.get(tiddler)
-                except StoreError:
-                    tiddler.store = store
-        if _is_readable(environ, tiddler):
-            tiddlers.add(tiddler)
 
+def _send_links(environ, start_response, tiddlers, headers=None):
+    """
+    Send tiddlers with send_tiddlers, with headers in place of any of
+    the same name. A collection which is loaded as it is sent cannot
+    give an ETag or Last-Modified, unless filters make one that can,
+    so those are only sent when they are in headers.
+    """
+    if headers is None:
+        headers = []
+    names = set(name.lower() for name, _ in headers)
+    if (isinstance(tiddlers, LinkTiddlers)
+            and not environ['tiddlyweb.filters']):
+        names.update(['etag', 'last-modified'])
+        if not headers:
+            environ.pop('HTTP_IF_NONE_MATCH', None)
+            environ.pop('HTTP_IF_MODIFIED_SINCE', None)
+    if names:
+        start_response = _with_headers(start_response, headers, names)
     return send_tiddlers(environ, start_response, tiddlers=tiddlers)
 
 
-def _is_readable(environ, tiddler):
+def _page(environ):
     """
-    Return true if recipe.policy read allows, and
-    bag.policy read allows, or if neither bag or recipe
-    is set.
+    Return the (limit, after) page of links asked for. after is
+    the key of the last link on the previous page, from the 'after'
+    query parameter. limit comes from a 'limit=N' filter, which can
+    be done in the database when it is the first filter.
     """
-    store = environ['tiddlyweb.store']
-    usersign = environ['tiddlyweb.usersign']
-    if tiddler.recipe:
-        try:
-            recipe = store.get(Recipe(tiddler.recipe))
-        except StoreError:
-            return False
-        try:
-            recipe.policy.allows(usersign, 'read')
-        except PermissionsError:
-            return False
+    after = environ.get('tiddlyweb.query', {}).get('after', [None])[0]
+    limit = None
+    filters = environ.get('tiddlyweb.filters')
+    if filters:
+        name, argument = filters[0][1]
+        if name == 'limit' and ',' not in argument and int(argument) > 0:
+            limit = int(argument)
+    return limit, after
 
-    if tiddler.bag:
-        try:
-            bag = store.get(Bag(tiddler.bag))
-        except StoreError:
-            return False
-        try:
-            bag.policy.allows(usersign, 'read')
-        except PermissionsError:
-            return False
 
-    return True
+def _next_page(environ, after):
+    """
+    Return the URL of the page of links after the key after.
+    """
+    query = [part for part in re.split('[&;]', environ.get('QUERY_STRING', ''))
+            if part and not part.startswith('after=')]
+    query.append('after=%s' % encode_name(after))
+    return '%s%s?%s' % (server_host_url(environ), environ['SCRIPT_NAME'],
+            '&'.join(query))
+
+
+def _validate_links(environ, links_manager, tiddler, linktype):
+    """
+    Do ETag and Last-Modified checks for the links of tiddler
+    against the version stamps of it and the tiddlers it links with
+    in the links database, raising 304 if they match. Return the
+    ETag and Last-Modified headers to send, or an empty list if the
+    links have no stamp.
+    """
+    stamp = links_manager.read_links_version(tiddler,
+            linktype[:-len('links')])
+    if stamp is None:
+        return []
+    version, modified = stamp
+
+    username = environ.get('tiddlyweb.usersign', {}).get('name', '')
+    try:
+        _, mime_type = get_serialize_type(environ, collection=True)
+        mime_type = mime_type.split(';', 1)[0].strip()
+    except TypeError:
+        mime_type = ''
+    key = u'%s:%s:%s:%s' % (linktype, tiddler.bag, tiddler.title, version)
+    etag_string = '"%s:%s"' % (sha1(key.encode('utf-8')).hexdigest(),
+            sha1('%s:%s:%s' % (username.encode('utf-8'), mime_type,
+                environ.get('QUERY_STRING', ''))).hexdigest())
+    last_modified_string = http_date_from_timestamp(modified)
+
+    incoming_etag = check_incoming_etag(environ, etag_string,
+            last_modified=last_modified_string)
+    if not incoming_etag:  # only check last modified when no etag
+        check_last_modified(environ, last_modified_string,
+                etag=etag_string)
+    # the links have changed, which the tiddlers listed
+    # may not show, so send_tiddlers must not answer 304
+    environ.pop('HTTP_IF_NONE_MATCH', None)
+    environ.pop('HTTP_IF_MODIFIED_SINCE', None)
+
+    return [('Etag', etag_string), ('Last-Modified', last_modified_string)]
+
+
+def _with_headers(start_response, headers, names):
+    """
+    Wrap start_response to send headers in place of any of
+    the names given.
+    """
+
+    def links_start_response(status, response_headers, exc_info=None):
+        response_headers = [header for header in response_headers
+                if header[0].lower() not in names] + headers
+        return start_response(status, response_headers, exc_info)
+    return links_start_response
@@ -0,0 +1,60 @@
+"""
+Choose the kind of links database to use.
+
+Backends are named in BACKENDS, either by class or by a
+'module:Class' string so a backend's dependencies are only imported
+when it is used. 'linkdb_backend' in config names the one to use:
+
+* sql (the default): any database SQLAlchemy supports, at the URL in
+  'linkdb_config'.
+* sqlite3: a SQLite file, named by 'links.sqlite_path', used through
+  the standard library alone.
+* memory: an in memory graph with a snapshot and log on disk.
+
+Plugins may add their own with register_backend, or name a
+'module:Class' in config directly.
+"""
+
+DEFAULT_BACKEND = 'sql'
+
+BACKENDS = {
+        'sql': 'tiddlywebplugins.links.linksmanager:LinksManager',
+        'sqlite3': 'tiddlywebplugins.links.sqlite:SQLiteLinksManager',
+        'memory': 'tiddlywebplugins.links.memory:MemoryLinksManager',
+        }
+
+
+def register_backend(name, backend):
+    """
+    Make backend, a LinksBackend class or 'module:Class' string,
+    available as name.
+    """
+    BACKENDS[name] = backend
+
+
+def get_backend(name):
+    """
+    Return the backend class called name, importing it if need be.
+    """
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        if ':' not in name:
+            raise ValueError('unknown links backend: %s' % name)
+        backend = name
+    if isinstance(backend, basestring):
+        module_name, class_name = backend.split(':', 1)
+        module = __import__(module_name, {}, {}, [class_name])
+        backend = getattr(module, class_name)
+        if name in BACKENDS:
+            BACKENDS[name] = backend
+    return backend
+
+
+def get_links_manager(environ):
+    """
+    Return a links manager for the backend named by 'linkdb_backend'
+    in config.
+    """
+    config = environ.get('tiddlyweb.config', {})
+    return get_backend(config.get('linkdb_backend', DEFAULT_BACKEND))(environ)
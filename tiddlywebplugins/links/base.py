@@ -0,0 +1,278 @@
+"""
+What every kind of links database provides.
+
+A backend is a class made with an environ. It must implement
+read_frontlinks, read_backlinks, delete_sources, list_sources,
+replace_links_many and _update_links; delete_links, replace_links,
+update_database and export_links are built on those. The other
+methods are optional and have defaults which do without or say they
+are not supported.
+"""
+
+from hashlib import sha1
+
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.links.parser import process_tiddler, is_link
+
+
+DIRECTIONS = ('front', 'back', 'both')
+LINK_KINDS = ('tiddler', 'space', 'external')
+IMPORT_BATCH_SIZE = 500
+
+
+class LinksBackend(object):
+    """
+    The interface to a links database, with what can be shared
+    between implementations.
+    """
+
+    def __init__(self, environ=None):
+        if environ is None:
+            environ = {}
+        self.environ = environ
+
+    def read_frontlinks(self, tiddler, limit=None, after=None, kinds=None):
+        """
+        Return a list of forward links from this tiddler.
+        If limit or after are given, return at most limit links,
+        in key order, starting after the key after. If kinds is
+        given, return only links of those kinds, as told by
+        link_kind.
+        """
+        raise NotImplementedError
+
+    def read_backlinks(self, tiddler, limit=None, after=None, kinds=None):
+        """
+        Return a list of links to this tiddler.
+        If limit or after are given, return at most limit links,
+        in key order, starting after the key after. If kinds is
+        given, return only links of those kinds, as told by
+        link_kind.
+        """
+        raise NotImplementedError
+
+    def delete_sources(self, sources):
+        """
+        Clean out the links for each of the given source keys.
+        """
+        raise NotImplementedError
+
+    def list_sources(self):
+        """
+        Return the set of source keys which have links stored.
+        """
+        raise NotImplementedError
+
+    def replace_links_many(self, entries):
+        """
+        Replace the links of many tiddlers at once. entries is a
+        sequence of (tiddler, links) or (tiddler, links, digest)
+        tuples, links being the output of the parser and digest that
+        of index_digest.
+        """
+        raise NotImplementedError
+
+    def delete_links(self, tiddler):
+        """
+        Clean out the links for this tiddler.
+        """
+        self.delete_sources([_tiddler_key(tiddler)])
+
+    def replace_links(self, tiddler, links=None):
+        """
+        Make the stored links for this tiddler match those in
+        its text. If links is not given the tiddler is parsed.
+        """
+        if links is None:
+            config = self.environ.get('tiddlyweb.config', {})
+            links = process_tiddler(tiddler, config)
+        self.replace_links_many([(tiddler, links)])
+
+    def update_database(self, tiddler):
+        """
+        Add the links in this tiddler to those stored.
+        """
+        config = self.environ.get('tiddlyweb.config', {})
+        links = process_tiddler(tiddler, config)
+        self._update_links(links, tiddler)
+
+    def _update_links(self, links, tiddler):
+        """
+        Add the (link, space) tuples found in tiddler to its
+        stored links.
+        """
+        raise NotImplementedError
+
+    def count_backlinks_many(self, tiddlers):
+        """
+        Return a dict of tiddler key to the number of links to
+        that tiddler, for each of tiddlers.
+        """
+        return dict((_tiddler_key(tiddler), len(self.read_backlinks(tiddler)))
+                for tiddler in tiddlers)
+
+    def read_index_state(self, tiddlers):
+        """
+        Return a dict of source key to the (revision, digest) last
+        indexed. Without index state every tiddler is new.
+        """
+        return {}
+
+    def write_index_state(self, entries):
+        """
+        Record the revision and digest indexed for each of the
+        (tiddler, digest) pairs in entries, if index state is kept.
+        """
+        pass
+
+    def skip_unchanged(self, entries):
+        """
+        Return the set of source keys, of the (tiddler, digest) pairs
+        in entries, whose text and type are as last indexed, so they
+        need not be parsed or have their links written. Without index
+        state none are.
+        """
+        return set()
+
+    def read_version(self, tiddler):
+        """
+        Return the (version, modified) stamp of the links of this
+        tiddler, or None if stamps are not kept.
+        """
+        return None
+
+    def read_links_version(self, tiddler, direction):
+        """
+        Return a (version, modified) stamp of the links of this
+        tiddler in direction, front or back, and of the tiddlers
+        they list, or None if stamps are not kept.
+        """
+        return None
+
+    def export_links(self, bag_name=None, kinds=None):
+        """
+        Yield every stored (source, target) key pair, or those whose
+        source is in bag_name, grouped by source. If kinds is given,
+        yield only links of those kinds.
+        """
+        for source in sorted(self.list_sources()):
+            bag, title = source.split(':', 1)
+            if bag_name is not None and bag != bag_name:
+                continue
+            for target in self.read_frontlinks(Tiddler(title, bag),
+                    kinds=kinds):
+                yield source, target
+
+    def import_links(self, rows, batch_size=IMPORT_BATCH_SIZE):
+        """
+        Add the (source, target) key pairs in rows to the stored
+        links, without parsing, batch_size at a time. Returns the
+        number of rows read.
+        """
+        raise NotImplementedError('import is not supported by this backend')
+
+    def read_neighborhood(self, tiddler, depth=2, direction='both',
+            fan_out=None, limit=None):
+        raise NotImplementedError('traversal needs a SQL links database')
+
+    def read_path(self, source, target, depth=3, direction='front',
+            fan_out=None):
+        raise NotImplementedError('traversal needs a SQL links database')
+
+    def list_orphans(self, bag_name):
+        raise NotImplementedError('reports need a SQL links database')
+
+    def list_wanted(self, bag_name):
+        raise NotImplementedError('reports need a SQL links database')
+
+    def migrate_links(self, batch_size=None, drop=False):
+        raise NotImplementedError('migration needs a SQL links database')
+
+    def _link_targets(self, links, tiddler):
+        """
+        Turn the (link, space) tuples found in a tiddler into
+        the set of target keys to be stored.
+        """
+        config = self.environ.get('tiddlyweb.config', {})
+        at_means_bag = config.get('links.at_means_bag', False)
+
+        targets = set()
+        for link, space in set(links):
+            if link is None:
+                link = ''
+            if is_link(link):
+                target = link
+            elif space:
+                if link:
+                    if at_means_bag:
+                        target = '%s:%s' % (space, link)
+                    else:
+                        target = '%s_public:%s' % (space, link)
+                else:
+                    target = '@%s:' % space
+            else:
+                target = '%s:%s' % (tiddler.bag, link)
+            targets.add(target)
+        return targets
+
+
+def link_kind(target):
+    """
+    Return the kind of link, one of LINK_KINDS, a target key is:
+    'external' for a URL, 'space' for a whole space and 'tiddler'
+    for a tiddler.
+    """
+    if is_link(target):
+        return 'external'
+    if target.startswith('@') and target.endswith(':'):
+        return 'space'
+    return 'tiddler'
+
+
+def index_digest(tiddler):
+    """
+    Return a digest of the text and type of a tiddler, which
+    together decide its links.
+    """
+    digest = sha1()
+    for value in (tiddler.type or '', tiddler.text or ''):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        digest.update(value)
+        digest.update('\0')
+    return digest.hexdigest()
+
+
+def _of_kinds(keys, kinds):
+    """
+    Return the keys of links of the given kinds, or all of them if
+    kinds is None.
+    """
+    if kinds is None:
+        return keys
+    return [key for key in keys if link_kind(key) in kinds]
+
+
+def _batches(entries, batch_size):
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _revision(tiddler):
+    if tiddler.revision:
+        return unicode(tiddler.revision)
+    return None
+
+
+def _tiddler_key(tiddler):
+    """
+    Generate a source or target key from a tiddler object.
+    """
+    return '%s:%s' % (tiddler.bag, tiddler.title)
@@ -0,0 +1,94 @@
+"""
+A small thread safe cache for values shared between requests.
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """
+    A bounded least recently used cache whose entries expire
+    ttl seconds after they are stored. Keeps counts of hits,
+    misses, evictions and expirations.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the value stored for key. Raise KeyError if there
+        is none or it has expired.
+        """
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            if expires < time.time():
+                self.expirations += 1
+                self.misses += 1
+                raise KeyError(key)
+            self._entries[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Store value for key, evicting the least recently used
+        entries if the cache is full.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        """
+        Remove key from the cache if it is there.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_where(self, test):
+        """
+        Remove every entry for which test(key, value) is true.
+        """
+        with self._lock:
+            for key, (_, value) in self._entries.items():
+                if test(key, value):
+                    del self._entries[key]
+
+    def clear(self):
+        """
+        Empty the cache and reset the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def stats(self):
+        """
+        Return the counters, hit rate and current size as a dict.
+        """
+        lookups = self.hits + self.misses
+        return {'size': len(self._entries), 'max_size': self.size,
+                'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expirations': self.expirations,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+    def __len__(self):
+        return len(self._entries)
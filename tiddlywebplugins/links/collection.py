@@ -0,0 +1,89 @@
+"""
+Collections of the tiddlers named by link keys.
+
+Links are sent with send_tiddlers, as a Tiddlers collection. Usually
+every linked tiddler is loaded and added to the collection before
+sending starts. With 'links.stream' set the collection is a
+LinkTiddlers instead, which holds only the keys and resolves, checks
+and loads each tiddler as the serializer reaches it.
+"""
+
+from tiddlyweb.model.collections import Tiddlers
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import StoreError
+
+from tiddlywebplugins.links.parser import is_link
+from tiddlywebplugins.links.resolver import LinkResolver
+from tiddlywebplugins.links.stats import count
+
+
+class LinkTiddlers(Tiddlers):
+    """
+    A Tiddlers collection of the tiddlers named by link keys,
+    resolved, checked for read permission and loaded one at a time
+    as the collection is iterated. What it holds is not known until
+    then, so its digest and modified time say nothing about it. If
+    store is unset, as serializers which only list titles do, the
+    tiddlers are not loaded at all.
+    """
+
+    def __init__(self, environ, links, bag_name, title=''):
+        Tiddlers.__init__(self, title=title, store=environ['tiddlyweb.store'])
+        self.environ = environ
+        self.links = links
+        self.links_bag = bag_name
+
+    def __iter__(self):
+        store = self.store
+        for tiddler in link_tiddlers(self.environ, self.links,
+                self.links_bag):
+            # serializers which only list titles unset store
+            if store is None:
+                yield tiddler
+            else:
+                yield load_tiddler(store, tiddler)
+
+
+def link_tiddlers(environ, links, bag_name):
+    """
+    Yield an unloaded tiddler for each link key which names a
+    tiddler the user may read. Links without a bag are taken to be
+    in bag_name.
+    """
+    resolver = LinkResolver(environ)
+
+    # continue over entries in database from previous format
+    for link in links:
+        if is_link(link):  # external link
+            continue
+        else:
+            container, title = link.split(':', 1)
+            if not title:  # plain space link
+                continue
+            elif title:
+                if container != bag_name:
+                    if container.endswith('_public'):
+                        found_bag = resolver.bag_for(container, title)
+                        tiddler = Tiddler(title, found_bag or bag_name)
+                        tiddler.recipe = container
+                    else:
+                        tiddler = Tiddler(title, container)
+                else:
+                    tiddler = Tiddler(title, bag_name)
+        # check permissions before loading, so unreadable
+        # tiddlers are never read from the store
+        if resolver.readable(tiddler):
+            yield tiddler
+
+
+def load_tiddler(store, tiddler):
+    """
+    Load tiddler from store. A tiddler which does not exist is sent
+    as it is.
+    """
+    count('links.store_gets')
+    try:
+        return store.get(tiddler)
+    except StoreError:
+        tiddler.store = store
+        return tiddler
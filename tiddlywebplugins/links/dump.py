@@ -0,0 +1,78 @@
+"""
+Export and import links as JSON lines.
+
+Each line is an object with the source and target keys of a link and
+the kind of link it is, as told by link_kind:
+
+  {"source": "bag:Title", "target": "bag:Other", "kind": "tiddler"}
+
+Exports are streamed from the links database, and may be of only
+some kinds of link. Imports are added to
+the links database directly, without reading the store or parsing,
+which makes them the quick way to seed a new links database.
+"""
+
+import simplejson
+
+from tiddlywebplugins.links.base import (IMPORT_BATCH_SIZE, LINK_KINDS,
+        link_kind, _batches)
+
+
+EXPORT_CHUNK_SIZE = 500
+
+
+def dump_links(links_manager, bag_name=None, kinds=None):
+    """
+    Yield a line of JSON, newline included, for each link in the
+    links database, or each link from a tiddler in bag_name. If
+    kinds is given, only links of those kinds are included.
+    """
+    for source, target in links_manager.export_links(bag_name, kinds):
+        yield simplejson.dumps({'source': source, 'target': target,
+            'kind': link_kind(target)}) + '\n'
+
+
+def parse_kinds(values):
+    """
+    Return the list of kinds of link named in values, each one kind
+    or several separated by commas, or None if none are named.
+    Raises ValueError for a kind not in LINK_KINDS.
+    """
+    kinds = []
+    for value in values:
+        for kind in value.split(','):
+            kind = kind.strip()
+            if not kind:
+                continue
+            if kind not in LINK_KINDS:
+                raise ValueError('unknown kind of link: %s' % kind)
+            if kind not in kinds:
+                kinds.append(kind)
+    return kinds or None
+
+
+def chunk_lines(lines, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Join lines into chunks of chunk_size lines, for sending.
+    """
+    for batch in _batches(lines, chunk_size):
+        yield ''.join(batch)
+
+
+def load_links(links_manager, lines, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Add the links in lines of JSON to the links database, batch_size
+    at a time. Returns the number of links read.
+    """
+    return links_manager.import_links(_read_links(lines), batch_size)
+
+
+def _read_links(lines):
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            link = simplejson.loads(line)
+            yield link['source'], link['target']
+        except (ValueError, KeyError, TypeError), exc:
+            raise ValueError('bad link on line %d: %s' % (number, exc))
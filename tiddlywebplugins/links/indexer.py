@@ -0,0 +1,252 @@
+"""
+Deferred indexing of tiddler links.
+
+When 'links.async_indexing' is true in config the put and delete
+hooks hand tiddlers to a LinksIndexer instead of updating the links
+database themselves. The indexer keeps a bounded queue which a
+background thread drains in batches, applying only the latest
+update for each tiddler in a batch.
+"""
+
+import atexit
+import itertools
+import logging
+import threading
+
+from Queue import Queue, Empty, Full
+
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.links.backends import get_links_manager
+from tiddlywebplugins.links.base import index_digest, _tiddler_key
+from tiddlywebplugins.links.parser import process_tiddler, is_parseable
+from tiddlywebplugins.links.stats import count
+
+
+LOGGER = logging.getLogger(__name__)
+
+QUEUE_SIZE = 1000
+QUEUE_BATCH_SIZE = 100
+
+INDEXER = None
+INDEXER_LOCK = threading.Lock()
+
+
+class LinksIndexer(object):
+    """
+    A queue of tiddler updates and a thread which applies them
+    to the links database through a links manager.
+
+    When the queue is full, put and delete wait up to timeout
+    seconds (forever if timeout is None) for space, then apply
+    the update in the calling thread. Each update is numbered as it
+    is queued, and one older than the latest queued for its tiddler
+    is dropped, so an update applied early is not undone by an older
+    one still in the queue.
+    """
+
+    def __init__(self, environ, size=QUEUE_SIZE, batch_size=QUEUE_BATCH_SIZE,
+            timeout=None):
+        self.environ = environ
+        self.queue = Queue(size)
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.indexed = 0
+        self.deleted = 0
+        self.skipped = 0
+        self.coalesced = 0
+        self.overflowed = 0
+        self._thread = None
+        self._sequence = itertools.count()
+        # key to [latest sequence number, updates not yet applied]
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._apply_lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the thread which drains the queue.
+        """
+        if self._thread is None or not self._thread.isAlive():
+            self._thread = threading.Thread(target=self._run,
+                    name='links-indexer')
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Apply everything queued, then stop the thread.
+        """
+        if self._thread is not None and self._thread.isAlive():
+            self.queue.put(None)
+            self._thread.join()
+        self._thread = None
+
+    def flush(self):
+        """
+        Wait until everything queued so far has been applied.
+        """
+        if self._thread is None or not self._thread.isAlive():
+            self.start()
+        self.queue.join()
+
+    def put(self, tiddler):
+        """
+        Queue an update of the links from tiddler.
+        """
+        self._enqueue(('put', tiddler.bag, tiddler.title, tiddler.revision,
+            tiddler.type, tiddler.text))
+
+    def delete(self, tiddler):
+        """
+        Queue removal of the links from tiddler.
+        """
+        self._enqueue(('delete', tiddler.bag, tiddler.title, None, None,
+            None))
+
+    def stats(self):
+        """
+        Return the counters and current queue length as a dict.
+        """
+        return {'queued': self.queue.qsize(), 'indexed': self.indexed,
+                'deleted': self.deleted, 'skipped': self.skipped,
+                'coalesced': self.coalesced,
+                'overflowed': self.overflowed}
+
+    def _enqueue(self, entry):
+        key = (entry[1], entry[2])
+        with self._lock:
+            sequence = self._sequence.next()
+            pending = self._pending.setdefault(key, [sequence, 0])
+            pending[0] = sequence
+            pending[1] += 1
+        entry = (sequence,) + entry
+        try:
+            self.queue.put(entry, True, self.timeout)
+        except Full:
+            self.overflowed += 1
+            self._apply([entry])
+
+    def _run(self):
+        while True:
+            entry = self.queue.get()
+            batch = [entry]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            stopping = None in batch
+            try:
+                self._apply([entry for entry in batch if entry is not None])
+            except Exception:
+                LOGGER.exception('unable to apply %d links updates',
+                        len(batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if stopping:
+                return
+
+    def _apply(self, entries):
+        """
+        Apply the latest queued update for each tiddler in entries,
+        unless a later one has been queued since, skipping those
+        whose text and type are as last indexed. Only one thread
+        applies updates at a time.
+        """
+        with self._apply_lock:
+            try:
+                self._apply_latest(entries)
+            finally:
+                with self._lock:
+                    for entry in entries:
+                        key = (entry[2], entry[3])
+                        pending = self._pending[key]
+                        pending[1] -= 1
+                        if not pending[1]:
+                            del self._pending[key]
+
+    def _apply_latest(self, entries):
+        latest = {}
+        with self._lock:
+            for entry in entries:
+                key = (entry[2], entry[3])
+                if entry[0] < self._pending[key][0]:
+                    self.coalesced += 1
+                else:
+                    latest[key] = entry
+
+        config = self.environ.get('tiddlyweb.config', {})
+        puts = []
+        deletes = []
+        for _, action, bag, title, revision, tiddler_type, text in (
+                latest.itervalues()):
+            tiddler = Tiddler(title, bag)
+            if action == 'delete':
+                deletes.append(_tiddler_key(tiddler))
+                continue
+            tiddler.revision = revision
+            tiddler.type = tiddler_type
+            tiddler.text = text
+            puts.append((tiddler, index_digest(tiddler)))
+
+        links_manager = get_links_manager(self.environ)
+        unchanged = links_manager.skip_unchanged(puts) if puts else set()
+        if unchanged:
+            self.skipped += len(unchanged)
+            count('hook.put_unchanged', len(unchanged))
+        updates = []
+        for tiddler, digest in puts:
+            if _tiddler_key(tiddler) in unchanged:
+                continue
+            if is_parseable(tiddler):
+                links = process_tiddler(tiddler, config)
+            else:
+                links = []
+            updates.append((tiddler, links, digest))
+
+        if deletes:
+            links_manager.delete_sources(deletes)
+            self.deleted += len(deletes)
+        if updates:
+            links_manager.replace_links_many(updates)
+            self.indexed += len(updates)
+
+
+def get_indexer(environ):
+    """
+    Return the running process wide LinksIndexer if async indexing
+    is turned on in config, otherwise None.
+    """
+    global INDEXER
+    config = environ.get('tiddlyweb.config', {})
+    if not config.get('links.async_indexing', False):
+        return None
+    if INDEXER is None:
+        INDEXER_LOCK.acquire()
+        try:
+            if INDEXER is None:
+                indexer = LinksIndexer(environ,
+                        size=int(config.get('links.queue_size', QUEUE_SIZE)),
+                        batch_size=int(config.get('links.queue_batch_size',
+                            QUEUE_BATCH_SIZE)),
+                        timeout=config.get('links.queue_timeout'))
+                indexer.start()
+                INDEXER = indexer
+        finally:
+            INDEXER_LOCK.release()
+    return INDEXER
+
+
+def stop_indexer():
+    """
+    Drain and stop the process wide LinksIndexer, if there is one.
+    """
+    global INDEXER
+    if INDEXER is not None:
+        INDEXER.stop()
+        INDEXER = None
+
+
+atexit.register(stop_indexer)
@@ -1,56 +1,228 @@
 """
 Module to contain the LinksManager class.
+
+The engine is made once per process, on first use. A process which
+finds an engine made before it was forked makes its own, leaving
+the connections of the old one to the parent. The tables are then
+made if the version marker in link_schema says they are not there.
 """
 
-import warnings
-try:
-    import MySQLdb
-    MYSQL_PRESENT = True
-except ImportError:
-    MYSQL_PRESENT = False
+import os
 
+from sqlalchemy import event, inspect
 from sqlalchemy.engine import create_engine
-from sqlalchemy.orm import mapper, sessionmaker, scoped_session
-from sqlalchemy.schema import Table, Column, MetaData
-from sqlalchemy.types import Unicode, Integer
+from sqlalchemy.sql import (and_, bindparam, exists, func, select, null,
+        union_all)
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.schema import Table, Column, MetaData, Index
+from sqlalchemy.types import Unicode, Integer, String
+
+from tiddlyweb.model.tiddler import current_timestring
 
-from tiddlywebplugins.links.parser import process_tiddler, is_link
+from tiddlywebplugins.links.base import (LinksBackend, index_digest,
+        link_kind, _batches, _revision, _tiddler_key)
+from tiddlywebplugins.links.sqlite import busy_timeout, sqlite_pragmas
+from tiddlywebplugins.links.stats import instrumented
 
 DB_DEFAULT = 'sqlite:///links.db'
 
+POOL_DEFAULTS = {
+        'pool_recycle': 3600,
+        'pool_size': 20,
+        'max_overflow': -1,
+        'pool_timeout': 2,
+        }
+
 METADATA = MetaData()
+LEGACY_METADATA = MetaData()
 SESSION = scoped_session(sessionmaker())
 
-LINK_TABLE = Table('link', METADATA,
+# Each source or target key is stored once, as a node.
+NODE_TABLE = Table('link_node', METADATA,
+        Column('id', Integer, nullable=False, primary_key=True,
+            autoincrement=True),
+        Column('key', Unicode(333), nullable=False, unique=True),
+        mysql_charset='utf8')
+
+# A link is a pair of node ids and the kind of link it is, as told
+# by link_kind. The primary key serves lookups by source, the target
+# index lookups by target and the kind index lookups by source of
+# only some kinds.
+EDGE_TABLE = Table('link_edge', METADATA,
+        Column('source_id', Integer, nullable=False, primary_key=True,
+            autoincrement=False),
+        Column('target_id', Integer, nullable=False, primary_key=True,
+            autoincrement=False),
+        Column('kind', String(8), nullable=False, server_default='tiddler'),
+        mysql_charset='utf8')
+Index('link_edge_target', EDGE_TABLE.c.target_id, EDGE_TABLE.c.source_id)
+KIND_INDEX = Index('link_edge_kind', EDGE_TABLE.c.source_id,
+        EDGE_TABLE.c.kind)
+
+SOURCE_NODE = NODE_TABLE.alias('source_node')
+TARGET_NODE = NODE_TABLE.alias('target_node')
+EDGES = EDGE_TABLE.join(SOURCE_NODE,
+        EDGE_TABLE.c.source_id == SOURCE_NODE.c.id).join(TARGET_NODE,
+                EDGE_TABLE.c.target_id == TARGET_NODE.c.id)
+
+# The single table schema used before link_node and link_edge.
+# It is only read, by migrate_links.
+LINK_TABLE = Table('link', LEGACY_METADATA,
         Column('id', Integer, nullable=False, primary_key=True,
             autoincrement=True),
         Column('source', Unicode(333), nullable=False, index=True),
         Column('target', Unicode(333), nullable=False, index=True),
         mysql_charset='utf8')
 
+# What was last indexed for each source: the tiddler revision and a
+# digest of its text and type.
+STATE_TABLE = Table('link_state', METADATA,
+        Column('source', Unicode(333), nullable=False, primary_key=True),
+        Column('revision', Unicode(64)),
+        Column('digest', String(40), nullable=False),
+        mysql_charset='utf8')
 
-class SLink(object):
-    """
-    Holder object for mapping the Link. Kind of redundant
-    but nice for the __repr__.
-    """
-
-    def __init__(self, source, target, link_id=None):
-        object.__init__(self)
-        self.source = source
-        self.target = target
-        self.id = link_id
+# Every tiddler indexed, whether or not it has links, so that
+# reports can tell which link targets exist without asking the store.
+TIDDLER_TABLE = Table('link_tiddler', METADATA,
+        Column('key', Unicode(333), nullable=False, primary_key=True),
+        Column('bag', Unicode(128), nullable=False, index=True),
+        Column('title', Unicode(256), nullable=False),
+        mysql_charset='utf8')
 
-    def __repr__(self):
-        return '<SLink(%s->%s)>' % (self.source, self.target)
+# A counter and timestamp for each key, bumped whenever the tiddler
+# is stored or deleted or its front or back links change.
+VERSION_TABLE = Table('link_version', METADATA,
+        Column('key', Unicode(333), nullable=False, primary_key=True),
+        Column('version', Integer, nullable=False),
+        Column('modified', String(14), nullable=False),
+        mysql_charset='utf8')
 
-mapper(SLink, LINK_TABLE)
+# The version of the schema the database was last brought up to, so
+# that a new process can tell with one query that there is nothing
+# to create.
+SCHEMA_TABLE = Table('link_schema', METADATA,
+        Column('version', Integer, nullable=False),
+        mysql_charset='utf8')
+SCHEMA_VERSION = 2
+
+INSERT_NODE = NODE_TABLE.insert().prefix_with('OR IGNORE',
+        dialect='sqlite').prefix_with('IGNORE', dialect='mysql')
+INSERT_EDGE = EDGE_TABLE.insert().prefix_with('OR IGNORE',
+        dialect='sqlite').prefix_with('IGNORE', dialect='mysql')
+DELETE_EDGE = EDGE_TABLE.delete().where(and_(
+    EDGE_TABLE.c.source_id == bindparam('source_id'),
+    EDGE_TABLE.c.target_id == bindparam('target_id')))
+INSERT_TIDDLER = TIDDLER_TABLE.insert().prefix_with('OR IGNORE',
+        dialect='sqlite').prefix_with('IGNORE', dialect='mysql')
+INSERT_VERSION = VERSION_TABLE.insert().prefix_with('OR IGNORE',
+        dialect='sqlite').prefix_with('IGNORE', dialect='mysql')
+
+# The directions in which links can be followed, as (from, to)
+# pairs of edge columns.
+DIRECTION_COLUMNS = {
+        'front': [(EDGE_TABLE.c.source_id, EDGE_TABLE.c.target_id)],
+        'back': [(EDGE_TABLE.c.target_id, EDGE_TABLE.c.source_id)],
+        'both': [(EDGE_TABLE.c.source_id, EDGE_TABLE.c.target_id),
+            (EDGE_TABLE.c.target_id, EDGE_TABLE.c.source_id)]}
+
+# Batches of sources are read and deleted with IN clauses of at most
+# this many keys, within the SQLite limit on bound parameters.
+SOURCE_BATCH_SIZE = 500
 
 ENGINE = None
+ENGINE_PID = None
 MAPPED = False
+# engines made before a fork, kept so their connections, which belong
+# to the parent, are never closed from the child
+INHERITED_ENGINES = []
+
+
+def make_engine(db_config, config):
+    """
+    Make the engine for the database at db_config. SQLite
+    connections get the pragmas of sqlite_pragmas. MySQL pools are
+    sized by 'links.pool_size', 'links.max_overflow',
+    'links.pool_recycle' and 'links.pool_timeout'.
+    """
+    if db_config.startswith('sqlite'):
+        engine = create_engine(db_config,
+                connect_args={'timeout': busy_timeout(config) / 1000.0})
+        pragmas = sqlite_pragmas(config)
+
+        def on_connect(connection, record):
+            cursor = connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(pragma)
+            cursor.close()
+
+        event.listen(engine, 'connect', on_connect)
+    elif 'mysql' in db_config:
+        engine = create_engine(db_config, **dict((name,
+            int(config.get('links.%s' % name, default)))
+            for name, default in POOL_DEFAULTS.items()))
+        try:
+            from tiddlywebplugins.mysql3 import on_checkout
+            event.listen(engine, 'checkout', on_checkout)
+        except ImportError:
+            pass
+    else:
+        engine = create_engine(db_config)
+    return engine
 
 
-class LinksManager(object):
+def ensure_schema(engine):
+    """
+    Create the tables, unless the version marker in link_schema
+    says the database already has this version of the schema or a
+    later one. Returns True if the tables were created or checked.
+    """
+    try:
+        version = engine.execute(select([SCHEMA_TABLE.c.version])).scalar()
+    except DBAPIError:  # no marker table yet
+        version = None
+    if version is not None and version >= SCHEMA_VERSION:
+        return False
+    METADATA.create_all(engine)
+    connection = engine.connect()
+    try:
+        with connection.begin():
+            if 'kind' not in [column['name'] for column
+                    in inspect(connection).get_columns('link_edge')]:
+                _add_kinds(connection)
+            connection.execute(SCHEMA_TABLE.delete())
+            connection.execute(SCHEMA_TABLE.insert(),
+                    {'version': SCHEMA_VERSION})
+    finally:
+        connection.close()
+    return True
+
+
+def _add_kinds(connection):
+    """
+    Add the kind column, made by schema version 2, to a link_edge
+    table made before it, and fill it in.
+    """
+    connection.execute("ALTER TABLE link_edge "
+            "ADD COLUMN kind VARCHAR(8) NOT NULL DEFAULT 'tiddler'")
+    KIND_INDEX.create(bind=connection)
+    kinds = {}
+    for node_id, key in connection.execute(select([NODE_TABLE.c.id,
+            NODE_TABLE.c.key]).where(NODE_TABLE.c.id.in_(
+                select([EDGE_TABLE.c.target_id])))):
+        kind = link_kind(key)
+        if kind != 'tiddler':
+            kinds.setdefault(kind, []).append(node_id)
+    for kind, node_ids in kinds.iteritems():
+        for start in range(0, len(node_ids), SOURCE_BATCH_SIZE):
+            connection.execute(EDGE_TABLE.update().where(
+                EDGE_TABLE.c.target_id.in_(
+                    node_ids[start:start + SOURCE_BATCH_SIZE])).values(
+                        kind=kind))
+
+
+class LinksManager(LinksBackend):
     """
     A container class for the functionality for managing a
     front and backlinks database. The primary purpose is to
@@ -63,35 +235,26 @@ class LinksManager(object):
         Establish an environ for this instance.
         """
 
-        global ENGINE, MAPPED
+        global ENGINE, ENGINE_PID, MAPPED
+
+        LinksBackend.__init__(self, environ)
 
-        if environ is None:
-            environ = {}
-        self.environ = environ
+        if ENGINE and ENGINE_PID != os.getpid():
+            INHERITED_ENGINES.append(ENGINE)
+            SESSION.registry.clear()
+            ENGINE = None
 
         if not ENGINE:
-            db_config = self._db_config()
-            if 'mysql' in db_config:
-                ENGINE = create_engine(db_config,
-                        pool_recycle=3600,
-                        pool_size=20,
-                        max_overflow=-1,
-                        pool_timeout=2)
-                try:
-                    from tiddlywebplugins.mysql3 import on_checkout
-                    from sqlalchemy import event
-                    event.listen(ENGINE, 'checkout', on_checkout)
-                except ImportError:
-                    pass
-            else:
-                ENGINE = create_engine(db_config)
+            ENGINE = make_engine(self._db_config(),
+                    self.environ.get('tiddlyweb.config', {}))
+            ENGINE_PID = os.getpid()
             METADATA.bind = ENGINE
             SESSION.configure(bind=ENGINE)
 
         self.session = SESSION()
 
         if not MAPPED:
-            METADATA.create_all(ENGINE)
+            ensure_schema(ENGINE)
             MAPPED = True
 
     def _db_config(self):
@@ -102,100 +265,672 @@ class LinksManager(object):
         return self.environ.get('tiddlyweb.config', {}).get(
                 'linkdb_config', DB_DEFAULT)
 
-    def update_database(self, tiddler):
+    @instrumented('db.read_frontlinks')
+    def read_frontlinks(self, tiddler, limit=None, after=None, kinds=None):
         """
-        Update the front and back links databases with the provided
-        tiddler.
+        Return a list of forward links from this tiddler.
+        If limit or after are given, return at most limit links,
+        in key order, starting after the key after. If kinds is
+        given, return only links of those kinds.
         """
-        links = process_tiddler(tiddler)
-        self._update_links(links, tiddler)
+        source = _tiddler_key(tiddler)
 
-    def read_frontlinks(self, tiddler):
+        return self._read_keys(select([TARGET_NODE.c.key]).select_from(
+            EDGES).where(SOURCE_NODE.c.key == source), TARGET_NODE.c.key,
+            limit, after, kinds)
+
+    @instrumented('db.read_backlinks')
+    def read_backlinks(self, tiddler, limit=None, after=None, kinds=None):
         """
-        Return a list of forward links from this tiddler.
+        Return a list of links to this tiddler.
+        If limit or after are given, return at most limit links,
+        in key order, starting after the key after. If kinds is
+        given, return only links of those kinds.
         """
-        source = _tiddler_key(tiddler)
+        target = _tiddler_key(tiddler)
 
+        return self._read_keys(select([SOURCE_NODE.c.key]).select_from(
+            EDGES).where(TARGET_NODE.c.key == target), SOURCE_NODE.c.key,
+            limit, after, kinds)
+
+    def _read_keys(self, query, column=None, limit=None, after=None,
+            kinds=None):
+        """
+        Run a query for one column of keys and return them as a list,
+        paging through column if limit or after are given, and
+        keeping to links of kinds if it is given.
+        """
+        if kinds is not None:
+            query = query.where(EDGE_TABLE.c.kind.in_(kinds))
+        if limit is not None or after is not None:
+            query = query.order_by(column)
+            if after is not None:
+                query = query.where(column > after)
+            if limit is not None:
+                query = query.limit(limit)
         try:
-            links = self.session.query(SLink.target).filter(
-                    SLink.source == source).group_by(SLink.target).all()
+            keys = [row[0] for row in self.session.execute(query)]
             self.session.close()
         except:
             self.session.rollback()
             raise
-        return [link[0] for link in links]
+        return keys
 
-    def read_backlinks(self, tiddler):
+    @instrumented('db.count_backlinks_many')
+    def count_backlinks_many(self, tiddlers):
         """
-        Return a list of links to this tiddler.
+        Return a dict of tiddler key to the number of links to
+        that tiddler, for each of tiddlers, counted in the database
+        with one grouped query per batch of keys.
         """
-        target = _tiddler_key(tiddler)
+        targets = [_tiddler_key(tiddler) for tiddler in tiddlers]
+        counts = dict((target, 0) for target in targets)
+        try:
+            for batch in _batches(targets, SOURCE_BATCH_SIZE):
+                counts.update(self.session.execute(
+                    select([TARGET_NODE.c.key, func.count()]).select_from(
+                        EDGES).where(TARGET_NODE.c.key.in_(batch)).group_by(
+                            TARGET_NODE.c.key)).fetchall())
+            self.session.close()
+        except:
+            self.session.rollback()
+            raise
+        return counts
 
+    @instrumented('db.read_neighborhood')
+    def read_neighborhood(self, tiddler, depth=2, direction='both',
+            fan_out=None, limit=None):
+        """
+        Return a list of (key, distance) for the keys within depth
+        links of this tiddler, nearest first, following links in
+        direction 'front', 'back' or 'both'. Keys with more than
+        fan_out links in that direction are not followed further.
+        At most limit keys are returned.
+        """
+        start = _tiddler_key(tiddler)
         try:
-            links = self.session.query(SLink.source).filter(
-                    SLink.target == target).group_by(SLink.source).all()
+            node_ids = self._node_ids([start])
+            levels = []
+            if start in node_ids:
+                levels, _ = self._walk(node_ids[start], depth, direction,
+                        fan_out, limit=limit)
+            keys = self._node_keys([node_id for level in levels
+                for node_id in level])
             self.session.close()
         except:
             self.session.rollback()
             raise
-        return [link[0] for link in links]
+        neighbors = []
+        for distance, level in enumerate(levels):
+            neighbors.extend(sorted((keys[node_id], distance + 1)
+                for node_id in level))
+        return neighbors[:limit]
+
+    @instrumented('db.read_path')
+    def read_path(self, source, target, depth=3, direction='front',
+            fan_out=None):
+        """
+        Return the keys along a shortest path of at most depth links
+        from the tiddler source to the tiddler target, both included,
+        or an empty list if there is none.
+        """
+        start = _tiddler_key(source)
+        end = _tiddler_key(target)
+        if start == end:
+            return [start]
+        try:
+            node_ids = self._node_ids([start, end])
+            parents = {}
+            if start in node_ids and end in node_ids:
+                _, parents = self._walk(node_ids[start], depth, direction,
+                        fan_out, end_id=node_ids[end])
+            path = []
+            node_id = node_ids.get(end)
+            if node_id in parents:
+                while node_id is not None:
+                    path.append(node_id)
+                    node_id = parents[node_id]
+                path.reverse()
+            keys = self._node_keys(path)
+            self.session.close()
+        except:
+            self.session.rollback()
+            raise
+        return [keys[node_id] for node_id in path]
 
-    def delete_links(self, tiddler):
+    def _walk(self, start_id, depth, direction, fan_out, end_id=None,
+            limit=None):
         """
-        Clean out the links for this tiddler.
+        Walk out from the node start_id a level at a time, for at
+        most depth levels. Return a list of the node ids first
+        reached at each level, and a dict of node id to the id it was
+        first reached from, which is on a shortest path to it. Nodes
+        already reached are not stepped to again, and a node other
+        than the start is only stepped from if it has at most fan_out
+        links in the direction followed. The walk stops early once
+        end_id, or limit nodes, have been reached.
         """
-        source = _tiddler_key(tiddler)
+        try:
+            columns = DIRECTION_COLUMNS[direction]
+        except KeyError:
+            raise ValueError('unknown link direction: %s' % direction)
+        parents = {start_id: None}
+        levels = []
+        frontier = [start_id]
+        reached = 0
+        while frontier and len(levels) < depth:
+            if levels and fan_out is not None:
+                frontier = self._within_fan_out(frontier, columns, fan_out)
+            level = []
+            for near, far in columns:
+                for batch in _batches(frontier, SOURCE_BATCH_SIZE):
+                    for node_id, next_id in self.session.execute(
+                            select([near, far]).where(near.in_(batch))):
+                        if next_id not in parents:
+                            parents[next_id] = node_id
+                            level.append(next_id)
+            levels.append(level)
+            reached += len(level)
+            if end_id in parents or (limit is not None and reached >= limit):
+                break
+            frontier = level
+        return levels, parents
+
+    def _within_fan_out(self, node_ids, columns, fan_out):
+        """
+        Return those of node_ids with at most fan_out links in the
+        directions of columns, counted on each direction's index.
+        """
+        degrees = dict((node_id, 0) for node_id in node_ids)
+        for near, _ in columns:
+            for batch in _batches(node_ids, SOURCE_BATCH_SIZE):
+                for node_id, degree in self.session.execute(
+                        select([near, func.count()]).where(
+                            near.in_(batch)).group_by(near)):
+                    degrees[node_id] += degree
+        return [node_id for node_id in node_ids
+                if degrees[node_id] <= fan_out]
+
+    @instrumented('db.list_orphans')
+    def list_orphans(self, bag_name):
+        """
+        Return the sorted keys of the tiddlers in the named bag
+        which no tiddler links to.
+        """
+        linked = exists().where(EDGE_TABLE.c.target_id == NODE_TABLE.c.id)
+        return self._read_keys(select([TIDDLER_TABLE.c.key]).select_from(
+            TIDDLER_TABLE.outerjoin(NODE_TABLE,
+                NODE_TABLE.c.key == TIDDLER_TABLE.c.key)).where(and_(
+                    TIDDLER_TABLE.c.bag == bag_name,
+                    ~linked)).order_by(TIDDLER_TABLE.c.key))
+
+    @instrumented('db.list_wanted')
+    def list_wanted(self, bag_name):
+        """
+        Return (key, count) for each tiddler in the named bag which
+        is linked to but does not exist, count being the number of
+        links to it, most wanted first.
+        """
+        prefix = bag_name + ':'
+        count = func.count()
+        query = select([NODE_TABLE.c.key, count]).select_from(
+                EDGE_TABLE.join(NODE_TABLE,
+                    EDGE_TABLE.c.target_id == NODE_TABLE.c.id).outerjoin(
+                        TIDDLER_TABLE,
+                        TIDDLER_TABLE.c.key == NODE_TABLE.c.key)).where(and_(
+                            NODE_TABLE.c.key.startswith(prefix,
+                                autoescape=True),
+                            TIDDLER_TABLE.c.key == None)).group_by(
+                                NODE_TABLE.c.key).order_by(count.desc(),
+                                    NODE_TABLE.c.key)
+        try:
+            # LIKE may ignore case
+            wanted = [tuple(row) for row in self.session.execute(query)
+                    if row[0].startswith(prefix)]
+            self.session.close()
+        except:
+            self.session.rollback()
+            raise
+        return wanted
+
+    @instrumented('db.read_version')
+    def read_version(self, tiddler):
+        """
+        Return the (version, modified) stamp of the links of this
+        tiddler, or None if they have not been stamped.
+        """
+        try:
+            stamp = self.session.execute(select([VERSION_TABLE.c.version,
+                VERSION_TABLE.c.modified]).where(
+                    VERSION_TABLE.c.key == _tiddler_key(tiddler))).first()
+            self.session.close()
+        except:
+            self.session.rollback()
+            raise
+        if stamp is None:
+            return None
+        return tuple(stamp)
 
+    @instrumented('db.read_links_version')
+    def read_links_version(self, tiddler, direction):
+        """
+        Return a (version, modified) stamp of the links of this
+        tiddler in direction, front or back, which changes when they
+        or any tiddler they list change, or None if the tiddler has
+        not been stamped. It is made from the tiddler's own stamp and
+        one aggregate of the stamps of the keys it links with.
+        """
+        stamp = self.read_version(tiddler)
+        if stamp is None:
+            return None
+        version, modified = stamp
+        if direction == 'front':
+            host, linked = SOURCE_NODE, TARGET_NODE
+        else:
+            host, linked = TARGET_NODE, SOURCE_NODE
         try:
-            old_links = self.session.query(SLink).filter(
-                    SLink.source == source)
-            old_links.delete()
+            count, total, latest = self.session.execute(select([
+                func.count(), func.sum(VERSION_TABLE.c.version),
+                func.max(VERSION_TABLE.c.modified)]).where(
+                    VERSION_TABLE.c.key.in_(select([linked.c.key])
+                        .select_from(EDGES).where(
+                            host.c.key == _tiddler_key(tiddler))))).first()
+            self.session.close()
+        except:
+            self.session.rollback()
+            raise
+        return ('%s.%s.%s' % (version, count, total or 0),
+                max(modified, latest or modified))
+
+    @instrumented('db.delete_sources')
+    def delete_sources(self, sources):
+        """
+        Clean out the links and index state for each of the given
+        source keys, and forget the tiddlers they stand for.
+        """
+        sources = list(sources)
+        keys = set(sources)
+        try:
+            for batch in _batches(sources, SOURCE_BATCH_SIZE):
+                # the backlinks of the targets change too
+                keys.update(row[0] for row in self.session.execute(
+                    select([TARGET_NODE.c.key]).select_from(EDGES).where(
+                        SOURCE_NODE.c.key.in_(batch))))
+                self.session.execute(EDGE_TABLE.delete().where(
+                    EDGE_TABLE.c.source_id.in_(select([NODE_TABLE.c.id]).where(
+                        NODE_TABLE.c.key.in_(batch)))))
+                self.session.execute(STATE_TABLE.delete().where(
+                    STATE_TABLE.c.source.in_(batch)))
+                self.session.execute(TIDDLER_TABLE.delete().where(
+                    TIDDLER_TABLE.c.key.in_(batch)))
+            self._touch(keys)
             self.session.commit()
         except:
             self.session.rollback()
             raise
 
+    @instrumented('db.list_sources')
+    def list_sources(self):
+        """
+        Return the set of source keys which have links, index
+        state or a known tiddler stored.
+        """
+        try:
+            sources = set(row[0] for row in self.session.execute(
+                select([SOURCE_NODE.c.key]).distinct().select_from(
+                    EDGE_TABLE.join(SOURCE_NODE,
+                        EDGE_TABLE.c.source_id == SOURCE_NODE.c.id))))
+            sources.update(row[0] for row in self.session.execute(
+                select([STATE_TABLE.c.source])))
+            sources.update(row[0] for row in self.session.execute(
+                select([TIDDLER_TABLE.c.key])))
+            self.session.close()
+        except:
+            self.session.rollback()
+            raise
+        return sources
+
+    @instrumented('db.read_index_state')
+    def read_index_state(self, tiddlers):
+        """
+        Return a dict of source key to the (revision, digest) last
+        indexed, for those of tiddlers which have been indexed.
+        """
+        sources = [_tiddler_key(tiddler) for tiddler in tiddlers]
+        states = {}
+        try:
+            for batch in _batches(sources, SOURCE_BATCH_SIZE):
+                for source, revision, digest in self.session.execute(
+                        select([STATE_TABLE.c.source, STATE_TABLE.c.revision,
+                            STATE_TABLE.c.digest]).where(
+                                STATE_TABLE.c.source.in_(batch))):
+                    states[source] = (revision, digest)
+            self.session.close()
+        except:
+            self.session.rollback()
+            raise
+        return states
+
+    @instrumented('db.write_index_state')
+    def write_index_state(self, entries):
+        """
+        Record the revision and digest indexed for each of the
+        (tiddler, digest) pairs in entries, without touching links.
+        """
+        states = dict((_tiddler_key(tiddler), (_revision(tiddler), digest))
+                for tiddler, digest in entries)
+        if not states:
+            return
+        try:
+            self._write_states(states)
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+
+    @instrumented('db.skip_unchanged')
+    def skip_unchanged(self, entries):
+        """
+        Return the set of source keys, of the (tiddler, digest) pairs
+        in entries, whose stored digest matches, so they need not be
+        parsed or have their links written. Their version stamps are
+        still bumped, as replace_links_many would, since other fields
+        may have changed.
+        """
+        digests = dict((_tiddler_key(tiddler), digest)
+                for tiddler, digest in entries)
+        sources = digests.keys()
+        unchanged = set()
+        try:
+            for start in range(0, len(sources), SOURCE_BATCH_SIZE):
+                for source, digest in self.session.execute(
+                        select([STATE_TABLE.c.source, STATE_TABLE.c.digest])
+                        .where(STATE_TABLE.c.source.in_(
+                            sources[start:start + SOURCE_BATCH_SIZE]))):
+                    if digests[source] == digest:
+                        unchanged.add(source)
+            if unchanged:
+                self._touch(unchanged)
+                self.session.commit()
+            else:
+                self.session.close()
+        except:
+            self.session.rollback()
+            raise
+        return unchanged
+
+    @instrumented('db.replace_links_many')
+    def replace_links_many(self, entries):
+        """
+        Replace the links of many tiddlers at once. entries is a
+        sequence of (tiddler, links) or (tiddler, links, digest)
+        tuples, links being the output of the parser and digest that
+        of index_digest, which is computed if not given. The stored
+        links and index state are read with one query, and changes
+        are sent as batches in a single transaction, along with new
+        version stamps for the tiddlers and for the targets of links
+        added or removed. Tiddlers not seen before are recorded as
+        known.
+        """
+        wanted = {}
+        states = {}
+        tiddlers = {}
+        for entry in entries:
+            tiddler, links = entry[:2]
+            if len(entry) > 2:
+                digest = entry[2]
+            else:
+                digest = index_digest(tiddler)
+            source = _tiddler_key(tiddler)
+            wanted[source] = self._link_targets(links, tiddler)
+            states[source] = (_revision(tiddler), digest)
+            tiddlers[source] = tiddler
+        if not wanted:
+            return
+
+        try:
+            stored = dict((source, set()) for source in wanted)
+            stored_digests = {}
+            known = set()
+            sources = wanted.keys()
+            # rows are links (source, target, None), index states
+            # (source, None, digest) and known tiddlers (source,
+            # None, None); each batch is bound three times
+            for batch in _batches(sources, SOURCE_BATCH_SIZE // 3):
+                query = union_all(
+                        select([SOURCE_NODE.c.key.label('source'),
+                            TARGET_NODE.c.key.label('target'),
+                            null().label('digest')]).select_from(
+                                EDGES).where(SOURCE_NODE.c.key.in_(batch)),
+                        select([STATE_TABLE.c.source, null(),
+                            STATE_TABLE.c.digest]).where(
+                                STATE_TABLE.c.source.in_(batch)),
+                        select([TIDDLER_TABLE.c.key, null().label('target'),
+                            null().label('digest')]).where(
+                            TIDDLER_TABLE.c.key.in_(batch)))
+                for source, target, digest in self.session.execute(query):
+                    if target is not None:
+                        stored[source].add(target)
+                    elif digest is not None:
+                        stored_digests[source] = digest
+                    else:
+                        known.add(source)
+            removed = []
+            added = []
+            for source, targets in wanted.iteritems():
+                removed.extend((source, target)
+                        for target in stored[source] - targets)
+                added.extend((source, target)
+                        for target in targets - stored[source])
+            # index state only changes when the text or type does
+            changed = dict((source, state) for source, state
+                    in states.iteritems()
+                    if stored_digests.get(source) != state[1])
+            # a tiddler whose links are unchanged is still stamped,
+            # as the stamps of its neighbours' links cover it
+            self._touch(set(sources).union(target
+                for _, target in removed + added))
+            if removed:
+                self.session.execute(DELETE_EDGE, self._edges(removed))
+            if added:
+                self._insert_links(added)
+            if changed:
+                self._write_states(changed)
+            unknown = [tiddlers[source] for source in sources
+                    if source not in known]
+            if unknown:
+                self.session.execute(INSERT_TIDDLER, [{
+                    'key': _tiddler_key(tiddler), 'bag': tiddler.bag,
+                    'title': tiddler.title} for tiddler in unknown])
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+
+    def _touch(self, keys):
+        """
+        Bump the version stamps of keys in the current transaction.
+        """
+        modified = current_timestring()
+        for batch in _batches(keys, SOURCE_BATCH_SIZE):
+            self.session.execute(INSERT_VERSION, [{'key': key, 'version': 0,
+                'modified': modified} for key in batch])
+            self.session.execute(VERSION_TABLE.update().where(
+                VERSION_TABLE.c.key.in_(batch)).values(
+                    version=VERSION_TABLE.c.version + 1, modified=modified))
+
+    def _write_states(self, states):
+        """
+        Replace the index state rows for the sources in states, a
+        dict of source to (revision, digest), in the current
+        transaction.
+        """
+        for batch in _batches(states.keys(), SOURCE_BATCH_SIZE):
+            self.session.execute(STATE_TABLE.delete().where(
+                STATE_TABLE.c.source.in_(batch)))
+        self.session.execute(STATE_TABLE.insert(),
+                [{'source': source, 'revision': revision, 'digest': digest}
+                    for source, (revision, digest) in states.iteritems()])
+
+    @instrumented('db.update_links')
     def _update_links(self, links, tiddler):
         """
         Update the links database.
         """
         source = _tiddler_key(tiddler)
 
-        config = self.environ.get('tiddlyweb.config', {})
-        at_means_bag = config.get('links.at_means_bag', False)
+        try:
+            self._insert_links([(source, target) for target
+                in self._link_targets(links, tiddler)])
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
 
-        if MYSQL_PRESENT:
-            warnings.simplefilter('error', MySQLdb.Warning)
+    @instrumented('db.migrate_links')
+    def migrate_links(self, batch_size=SOURCE_BATCH_SIZE, drop=False):
+        """
+        Copy links from the old single table schema into link_node
+        and link_edge, batch_size rows per transaction, optionally
+        dropping the old table afterwards. Returns the number of
+        rows copied.
+        """
+        if not LINK_TABLE.exists(bind=ENGINE):
+            return 0
 
+        count = 0
+        last_id = 0
         try:
-            for link, space in set(links):
-                if link is None:
-                    link = ''
-                if is_link(link):
-                    target = link
-                elif space:
-                    if link:
-                        if at_means_bag:
-                            target = '%s:%s' % (space, link)
-                        else:
-                            target = '%s_public:%s' % (space, link)
-                    else:
-                        target = '@%s:' % space
-                else:
-                    target = '%s:%s' % (tiddler.bag, link)
-                new_link = SLink(source, target)
-                self.session.add(new_link)
+            while True:
+                rows = self.session.execute(select([LINK_TABLE.c.id,
+                    LINK_TABLE.c.source, LINK_TABLE.c.target]).where(
+                        LINK_TABLE.c.id > last_id).order_by(
+                            LINK_TABLE.c.id).limit(batch_size)).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                self._insert_links(set((source, target)
+                    for _, source, target in rows))
                 self.session.commit()
-        except MySQLdb.Warning:
+                count += len(rows)
+            self.session.close()
+        except:
             self.session.rollback()
-            pass
+            raise
+
+        if drop:
+            LINK_TABLE.drop(bind=ENGINE)
+        return count
+
+    def export_links(self, bag_name=None, kinds=None):
+        """
+        Yield every stored (source, target) key pair, or those whose
+        source is in bag_name, grouped by source. If kinds is given,
+        yield only links of those kinds. Rows are read through a
+        connection of their own with a server side cursor, where the
+        database has them, so memory use does not grow with the
+        number of links.
+        """
+        query = select([SOURCE_NODE.c.key, TARGET_NODE.c.key]).select_from(
+                EDGES).order_by(EDGE_TABLE.c.source_id,
+                        EDGE_TABLE.c.target_id)
+        if kinds is not None:
+            query = query.where(EDGE_TABLE.c.kind.in_(kinds))
+        prefix = ''
+        if bag_name is not None:
+            prefix = bag_name + ':'
+            query = query.where(SOURCE_NODE.c.key.startswith(prefix,
+                autoescape=True))
+        connection = ENGINE.connect()
+        try:
+            for source, target in connection.execution_options(
+                    stream_results=True).execute(query):
+                # LIKE may ignore case
+                if source.startswith(prefix):
+                    yield source, target
+        finally:
+            connection.close()
+
+    @instrumented('db.import_links')
+    def import_links(self, rows, batch_size=SOURCE_BATCH_SIZE):
+        """
+        Add the (source, target) key pairs in rows to the stored
+        links, without parsing, batch_size rows per transaction.
+        Sources are recorded as known tiddlers and the version
+        stamps of the keys are bumped. Returns the number of rows
+        read.
+        """
+        count = 0
+        try:
+            for batch in _batches(rows, batch_size):
+                sources = set(source for source, _ in batch)
+                # only the links of these keys change, not the
+                # tiddlers, so their neighbours keep their stamps
+                self._touch(sources.union(target for _, target in batch))
+                self._insert_links(batch)
+                known = []
+                for source in sources:
+                    bag, title = source.split(':', 1)
+                    known.append({'key': source, 'bag': bag, 'title': title})
+                self.session.execute(INSERT_TIDDLER, known)
+                self.session.commit()
+                count += len(batch)
         except:
             self.session.rollback()
             raise
+        return count
 
+    def _insert_links(self, links):
+        """
+        Insert (source, target) key pairs as one batch in the current
+        transaction. Pairs which are already stored are ignored where
+        the database can say so.
+        """
+        if links:
+            self.session.execute(INSERT_EDGE, self._edges(links, True))
 
-def _tiddler_key(tiddler):
-    """
-    Generate a source or target key from a tiddler object.
-    """
-    return '%s:%s' % (tiddler.bag, tiddler.title)
+    def _edges(self, links, create=False):
+        """
+        Turn (source, target) key pairs into parameters for the edge
+        statements, creating nodes for new keys if create is true.
+        """
+        keys = set()
+        for source, target in links:
+            keys.add(source)
+            keys.add(target)
+        node_ids = self._node_ids(keys, create)
+        return [{'source_id': node_ids[source], 'target_id': node_ids[target],
+            'kind': link_kind(target)} for source, target in links
+            if source in node_ids and target in node_ids]
+
+    def _node_keys(self, node_ids):
+        """
+        Return a dict of node id to key for node_ids, in the current
+        transaction.
+        """
+        keys = {}
+        for batch in _batches(node_ids, SOURCE_BATCH_SIZE):
+            keys.update(self.session.execute(
+                select([NODE_TABLE.c.id, NODE_TABLE.c.key]).where(
+                    NODE_TABLE.c.id.in_(batch))).fetchall())
+        return keys
+
+    def _node_ids(self, keys, create=False):
+        """
+        Return a dict of key to node id for keys, in the current
+        transaction. Keys without a node are left out unless create
+        is true, in which case a node is made for them.
+        """
+        keys = list(keys)
+        node_ids = {}
+        for start in range(0, len(keys), SOURCE_BATCH_SIZE):
+            node_ids.update(self.session.execute(
+                select([NODE_TABLE.c.key, NODE_TABLE.c.id]).where(
+                    NODE_TABLE.c.key.in_(
+                        keys[start:start + SOURCE_BATCH_SIZE]))).fetchall())
+        missing = [key for key in keys if key not in node_ids]
+        if create and missing:
+            self.session.execute(INSERT_NODE,
+                    [{'key': key} for key in missing])
+            node_ids.update(self._node_ids(missing))
+        return node_ids
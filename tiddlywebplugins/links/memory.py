@@ -0,0 +1,485 @@
+"""
+A links database held in memory.
+
+The graph is kept in two files. The snapshot holds every key once,
+sorted, and the links as compressed sparse rows of key ids: an
+offsets array and a targets array for front links, and the same
+for back links. It is memory mapped, not read, so a process can
+answer from it as soon as it starts. Changes are appended to a log
+as whole replacement rows, replayed over the snapshot, and folded
+into a new snapshot once the log is long enough.
+
+Several processes may share the files: each catches up with the
+log before reading, and writes and compactions take a lock on the
+log.
+"""
+
+import fcntl
+import mmap
+import os
+import simplejson
+import struct
+import threading
+
+from bisect import bisect_left
+
+from tiddlywebplugins.links.base import (LinksBackend, IMPORT_BATCH_SIZE,
+        link_kind, _batches, _of_kinds, _tiddler_key)
+from tiddlywebplugins.links.stats import instrumented
+
+
+MEMORY_PATH = 'links.graph'
+COMPACT_AFTER = 10000
+
+MAGIC = 'TWLINKS\x01'
+HEADER = struct.Struct('<8sqq')
+OFFSET = struct.Struct('<q')
+OFFSET_PAIR = struct.Struct('<qq')
+ID_SIZE = 4
+
+GRAPHS = {}
+GRAPHS_LOCK = threading.Lock()
+
+
+class Snapshot(object):
+    """
+    A read only, memory mapped snapshot of the link graph.
+    """
+
+    def __init__(self, path):
+        self.nodes = 0
+        self.edges = 0
+        self.identity = None
+        self._map = None
+        self._keys = self._front = self._front_ids = 0
+        self._back = self._back_ids = self._blob = 0
+        try:
+            snapshot_file = open(path, 'rb')
+        except IOError:
+            return
+        try:
+            stat = os.fstat(snapshot_file.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime, stat.st_size)
+            if stat.st_size:
+                self._map = mmap.mmap(snapshot_file.fileno(), 0,
+                        access=mmap.ACCESS_READ)
+        finally:
+            snapshot_file.close()
+        if self._map is None:
+            return
+
+        magic, self.nodes, self.edges = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a links snapshot' % path)
+        offsets_size = (self.nodes + 1) * OFFSET.size
+        edges_size = self.edges * ID_SIZE
+        self._keys = HEADER.size
+        self._front = self._keys + offsets_size
+        self._front_ids = self._front + offsets_size
+        self._back = self._front_ids + edges_size
+        self._back_ids = self._back + offsets_size
+        self._blob = self._back_ids + edges_size
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def key(self, node_id):
+        """
+        Return the key with id node_id.
+        """
+        start, end = OFFSET_PAIR.unpack_from(self._map,
+                self._keys + node_id * OFFSET.size)
+        return self._map[self._blob + start:self._blob + end].decode('utf-8')
+
+    def find(self, key):
+        """
+        Return the id of key, or None if it is not in the snapshot.
+        """
+        encoded = key.encode('utf-8')
+        low, high = 0, self.nodes
+        while low < high:
+            middle = (low + high) // 2
+            start, end = OFFSET_PAIR.unpack_from(self._map,
+                    self._keys + middle * OFFSET.size)
+            candidate = self._map[self._blob + start:self._blob + end]
+            if candidate < encoded:
+                low = middle + 1
+            elif candidate > encoded:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def frontlinks(self, key):
+        """
+        Return the keys key links to, in key order.
+        """
+        return self._row(self._front, self._front_ids, key)
+
+    def backlinks(self, key):
+        """
+        Return the keys which link to key, in key order.
+        """
+        return self._row(self._back, self._back_ids, key)
+
+    def rows(self):
+        """
+        Yield (key, set of target keys) for every key with links.
+        """
+        for node_id in xrange(self.nodes):
+            targets = self._ids(self._front, self._front_ids, node_id)
+            if targets:
+                yield self.key(node_id), set(self.key(target)
+                        for target in targets)
+
+    def _row(self, offsets, ids, key):
+        if not self.nodes:
+            return []
+        node_id = self.find(key)
+        if node_id is None:
+            return []
+        return [self.key(other) for other in self._ids(offsets, ids, node_id)]
+
+    def _ids(self, offsets, ids, node_id):
+        start, end = OFFSET_PAIR.unpack_from(self._map,
+                offsets + node_id * OFFSET.size)
+        return struct.unpack_from('<%di' % (end - start), self._map,
+                ids + start * ID_SIZE)
+
+
+def write_snapshot(path, rows):
+    """
+    Write a snapshot of rows, a dict of key to set of target keys,
+    to path, replacing whatever is there only once it is complete.
+    """
+    keys = set(rows)
+    for targets in rows.itervalues():
+        keys.update(targets)
+    encoded = sorted(key.encode('utf-8') for key in keys)
+    ids = dict((key.decode('utf-8'), node_id)
+            for node_id, key in enumerate(encoded))
+
+    front = [[] for _ in encoded]
+    back = [[] for _ in encoded]
+    for source, targets in rows.iteritems():
+        source_id = ids[source]
+        for target in targets:
+            front[source_id].append(ids[target])
+            back[ids[target]].append(source_id)
+
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    snapshot_file = open(temporary, 'wb')
+    try:
+        edges = sum(len(row) for row in front)
+        snapshot_file.write(HEADER.pack(MAGIC, len(encoded), edges))
+        _write_offsets(snapshot_file, [len(key) for key in encoded])
+        for index in (front, back):
+            _write_offsets(snapshot_file, [len(row) for row in index])
+            for row in index:
+                row.sort()
+                snapshot_file.write(struct.pack('<%di' % len(row), *row))
+        snapshot_file.write(''.join(encoded))
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    finally:
+        snapshot_file.close()
+    os.rename(temporary, path)
+
+
+def _write_offsets(snapshot_file, lengths):
+    offset = 0
+    offsets = [0]
+    for length in lengths:
+        offset += length
+        offsets.append(offset)
+    snapshot_file.write(struct.pack('<%dq' % len(offsets), *offsets))
+
+
+class LinkGraph(object):
+    """
+    The link graph as seen by this process: the snapshot, and over
+    it the rows replaced or deleted in the log since it was written.
+    """
+
+    def __init__(self, path, compact_after=COMPACT_AFTER):
+        self.snapshot_path = path + '.snapshot'
+        self.log_path = path + '.log'
+        self.compact_after = compact_after
+        self._lock = threading.RLock()
+        self._snapshot = None
+        self._load()
+
+    def frontlinks(self, key):
+        """
+        Return the keys key links to, in key order.
+        """
+        with self._lock:
+            self._catch_up()
+            if key in self._rows:
+                return sorted(self._rows[key])
+            return self._snapshot.frontlinks(key)
+
+    def backlinks(self, key):
+        """
+        Return the keys which link to key, in key order.
+        """
+        with self._lock:
+            self._catch_up()
+            sources = [source for source in self._snapshot.backlinks(key)
+                    if source not in self._rows]
+            sources.extend(self._reverse.get(key, ()))
+            return sorted(sources)
+
+    def sources(self):
+        """
+        Return the set of keys which have links.
+        """
+        with self._lock:
+            self._catch_up()
+            return set(source for source, _ in self._all_rows())
+
+    def rows(self):
+        """
+        Return (key, set of target keys) for every key with links,
+        in key order.
+        """
+        with self._lock:
+            self._catch_up()
+            return sorted(self._all_rows())
+
+    def replace(self, rows):
+        """
+        Make the links of each key in rows, a dict of key to set of
+        target keys, be those given. An empty set deletes the links.
+        """
+        with self._lock:
+            log_file = self._lock_log()
+            try:
+                self._catch_up()
+                changed = [(source, targets) for source, targets
+                        in rows.iteritems()
+                        if set(targets) != set(self._current(source))]
+                if not changed:
+                    return
+                log_file.seek(0, os.SEEK_END)
+                log_file.write(''.join(simplejson.dumps([source,
+                    sorted(targets)]) + '\n' for source, targets in changed))
+                log_file.flush()
+                for source, targets in changed:
+                    self._apply(source, targets)
+                self._log_offset = log_file.tell()
+                self._log_entries += len(changed)
+                if self._log_entries >= self.compact_after:
+                    self._compact()
+            finally:
+                log_file.close()
+
+    def delete(self, sources):
+        """
+        Remove the links of each of sources.
+        """
+        self.replace(dict((source, ()) for source in sources))
+
+    def compact(self):
+        """
+        Fold the log into a new snapshot.
+        """
+        with self._lock:
+            log_file = self._lock_log()
+            try:
+                self._catch_up()
+                self._compact()
+            finally:
+                log_file.close()
+
+    def _compact(self):
+        write_snapshot(self.snapshot_path, dict(self._all_rows()))
+        open(self.log_path, 'w').close()
+        self._load()
+
+    def _all_rows(self):
+        for source, targets in self._snapshot.rows():
+            if source not in self._rows:
+                yield source, targets
+        for source, targets in self._rows.iteritems():
+            if targets:
+                yield source, targets
+
+    def _current(self, source):
+        if source in self._rows:
+            return self._rows[source]
+        return self._snapshot.frontlinks(source)
+
+    def _apply(self, source, targets):
+        for target in self._rows.get(source, ()):
+            self._reverse[target].discard(source)
+        self._rows[source] = frozenset(targets)
+        for target in targets:
+            self._reverse.setdefault(target, set()).add(source)
+
+    def _load(self):
+        if self._snapshot is not None:
+            self._snapshot.close()
+        self._snapshot = Snapshot(self.snapshot_path)
+        self._rows = {}
+        self._reverse = {}
+        self._log_offset = 0
+        self._log_entries = 0
+        self._catch_up()
+
+    def _catch_up(self):
+        """
+        Reload if another process has written a new snapshot, then
+        apply the log entries not yet seen.
+        """
+        try:
+            stat = os.stat(self.snapshot_path)
+            identity = (stat.st_ino, stat.st_mtime, stat.st_size)
+        except OSError:
+            identity = None
+        if identity != self._snapshot.identity:
+            self._load()
+            return
+        try:
+            size = os.stat(self.log_path).st_size
+        except OSError:
+            return
+        if size < self._log_offset:  # compacted elsewhere
+            self._load()
+            return
+        if size == self._log_offset:
+            return
+        log_file = open(self.log_path, 'rb')
+        try:
+            log_file.seek(self._log_offset)
+            data = log_file.read(size - self._log_offset)
+        finally:
+            log_file.close()
+        # only whole lines, the last may still be being written
+        data = data[:data.rfind('\n') + 1]
+        for line in data.splitlines():
+            source, targets = simplejson.loads(line)
+            self._apply(source, targets)
+            self._log_entries += 1
+        self._log_offset += len(data)
+
+    def _lock_log(self):
+        log_file = open(self.log_path, 'a+b')
+        fcntl.flock(log_file.fileno(), fcntl.LOCK_EX)
+        return log_file
+
+
+def get_graph(config):
+    """
+    Return the process wide LinkGraph for the files named by
+    links.memory_path.
+    """
+    path = config.get('links.memory_path', MEMORY_PATH)
+    with GRAPHS_LOCK:
+        if path not in GRAPHS:
+            GRAPHS[path] = LinkGraph(path, int(config.get(
+                'links.memory_compact_after', COMPACT_AFTER)))
+        return GRAPHS[path]
+
+
+class MemoryLinksManager(LinksBackend):
+    """
+    A links backend which keeps the links in a LinkGraph instead of
+    a SQL database. Index state, version stamps and the known
+    tiddlers are not kept, and traversals and reports are not
+    supported.
+    """
+
+    def __init__(self, environ=None):
+        LinksBackend.__init__(self, environ)
+        self.graph = get_graph(self.environ.get('tiddlyweb.config', {}))
+
+    @instrumented('db.read_frontlinks')
+    def read_frontlinks(self, tiddler, limit=None, after=None, kinds=None):
+        """
+        Return a list of forward links from this tiddler.
+        """
+        return _page(_of_kinds(self.graph.frontlinks(_tiddler_key(tiddler)),
+            kinds), limit, after)
+
+    @instrumented('db.read_backlinks')
+    def read_backlinks(self, tiddler, limit=None, after=None, kinds=None):
+        """
+        Return a list of links to this tiddler.
+        """
+        key = _tiddler_key(tiddler)
+        if kinds is not None and link_kind(key) not in kinds:
+            return []
+        return _page(self.graph.backlinks(key), limit, after)
+
+    @instrumented('db.delete_sources')
+    def delete_sources(self, sources):
+        """
+        Clean out the links for each of the given source keys.
+        """
+        self.graph.delete(sources)
+
+    @instrumented('db.list_sources')
+    def list_sources(self):
+        """
+        Return the set of source keys which have links.
+        """
+        return self.graph.sources()
+
+    @instrumented('db.replace_links_many')
+    def replace_links_many(self, entries):
+        """
+        Replace the links of many tiddlers at once, with one write
+        to the log.
+        """
+        self.graph.replace(dict((_tiddler_key(entry[0]),
+            self._link_targets(entry[1], entry[0])) for entry in entries))
+
+    def export_links(self, bag_name=None, kinds=None):
+        """
+        Yield every stored (source, target) key pair, or those whose
+        source is in bag_name, in key order. If kinds is given, yield
+        only links of those kinds.
+        """
+        prefix = None if bag_name is None else bag_name + ':'
+        for source, targets in self.graph.rows():
+            if prefix is None or source.startswith(prefix):
+                for target in _of_kinds(sorted(targets), kinds):
+                    yield source, target
+
+    @instrumented('db.import_links')
+    def import_links(self, rows, batch_size=IMPORT_BATCH_SIZE):
+        """
+        Add the (source, target) key pairs in rows to the stored
+        links, with one write to the log for each batch_size rows.
+        Returns the number of rows read.
+        """
+        count = 0
+        for batch in _batches(rows, batch_size):
+            wanted = {}
+            for source, target in batch:
+                if source not in wanted:
+                    wanted[source] = set(self.graph.frontlinks(source))
+                wanted[source].add(target)
+            self.graph.replace(wanted)
+            count += len(batch)
+        return count
+
+    @instrumented('db.update_links')
+    def _update_links(self, links, tiddler):
+        source = _tiddler_key(tiddler)
+        targets = set(self.graph.frontlinks(source))
+        targets.update(self._link_targets(links, tiddler))
+        self.graph.replace({source: targets})
+
+
+def _page(keys, limit, after):
+    if after is not None:
+        keys = keys[bisect_left(keys, after):]
+        if keys and keys[0] == after:
+            keys = keys[1:]
+    if limit is not None:
+        keys = keys[:limit]
+    return keys
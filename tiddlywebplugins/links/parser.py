@@ -1,39 +1,79 @@
 
 import re
 import sys
+import threading
 
-from pyparsing import (Literal, Word, alphanums, Regex, Optional, SkipTo,
-        Or, LineStart, LineEnd)
+from collections import OrderedDict
+from hashlib import sha1
+
+from tiddlywebplugins.links.stats import instrumented
 
 ### Establish Parser Rules
 URL_PATTERN = r"(?:file|http|https|mailto|ftp|irc|news|data):[^\s'\"]+(?:/|\b)"
+WIKIWORD_PATTERN = r'[A-Z][a-z]+(?:[A-Z][a-z]*)+'
+
+# The pyparsing grammar is only the reference engine, so pyparsing is
+# imported and the grammar built on first use, not at import.
+GRAMMAR = None
+
+
+def grammar():
+    """
+    Return the pyparsing grammar of what we care about in the
+    content: links, or wikiwords, or bare space names.
+    """
+    global GRAMMAR
+    if GRAMMAR is not None:
+        return GRAMMAR
+
+    from pyparsing import (Literal, Word, alphanums, Regex, Optional,
+            SkipTo, Or, LineStart, LineEnd)
+
+    unspaced_target = Word(alphanums, alphanums + '-')
+    spaced_target = (Literal('[[').suppress() + SkipTo(']]')
+            + Literal(']]').suppress())
 
-UNSPACED_TARGET = Word(alphanums, alphanums + '-')
-SPACED_TARGET = (Literal('[[').suppress() + SkipTo(']]')
-        + Literal(']]').suppress())
+    space = (Literal('@').suppress() + Or([unspaced_target,
+        spaced_target]))('space')
 
-SPACE = (Literal('@').suppress() + Or([UNSPACED_TARGET,
-    SPACED_TARGET]))('space')
+    wikiword = (Regex(WIKIWORD_PATTERN)('link')
+            + Optional(space.leaveWhitespace()))
 
-WIKIWORD = (Regex(r'[A-Z][a-z]+(?:[A-Z][a-z]*)+')('link')
-        + Optional(SPACE.leaveWhitespace()))
+    link = (Literal("[[").suppress() + SkipTo(']]')('link')
+            + Literal("]]").suppress() + Optional(space.leaveWhitespace()))
 
-LINK = (Literal("[[").suppress() + SkipTo(']]')('link')
-        + Literal("]]").suppress() + Optional(SPACE.leaveWhitespace()))
+    markdown_transclusion = (LineStart().suppress()
+            + Literal('{{').suppress() + SkipTo('}}')('link')
+            + Literal('}}').suppress() + Optional(space.leaveWhitespace())
+            + LineEnd().suppress())
 
-MARKDOWN_TRANSCLUSION = (LineStart().suppress() + Literal('{{').suppress()
-        + SkipTo('}}')('link') + Literal('}}').suppress()
-        + Optional(SPACE.leaveWhitespace())
-        + LineEnd().suppress())
+    nonwikispace = Word(alphanums, alphanums)('link') + space.leaveWhitespace()
 
-NONWIKISPACE = Word(alphanums, alphanums)('link') + SPACE.leaveWhitespace()
+    http = Regex(URL_PATTERN)('link')
 
-HTTP = Regex(URL_PATTERN)('link')
+    GRAMMAR = Or([link, markdown_transclusion, wikiword, http, space,
+        nonwikispace])
+    return GRAMMAR
 
-# What we care about in the content are links, or wikiwords, or bare
-# space names.
-CONTENT = Or([LINK, MARKDOWN_TRANSCLUSION, WIKIWORD, HTTP, SPACE,
-    NONWIKISPACE])
+
+### Establish Scanner Rules
+# The scanner reproduces what grammar().scanString finds, without
+# trying every alternative at every character. TRIGGER finds the
+# next position where some alternative might match, then each
+# alternative is checked at that position and the longest wins,
+# as with Or.
+WHITESPACE = ' \n\t\r'
+URL_RE = re.compile(URL_PATTERN)
+WIKIWORD_RE = re.compile(WIKIWORD_PATTERN)
+UNSPACED_RE = re.compile(r'[A-Za-z0-9][A-Za-z0-9\-]*')
+NONWIKI_RE = re.compile(r'[A-Za-z0-9]+')
+NONWIKI_START_RE = re.compile(r'[A-Za-z0-9]+@')
+# The nonwikispace alternative is only triggered at the start of a run of
+# alphanumerics: whether it matches depends only on what follows
+# the run. A scan resuming mid-run is checked separately.
+TRIGGER_RE = re.compile(r'\[\[|\{\{|@|[A-Z][a-z]+[A-Z]'
+        r'|(?:file|http|https|mailto|ftp|irc|news|data):'
+        r'|(?<![A-Za-z0-9])[A-Za-z0-9]+@')
 
 
 def process_in():
@@ -43,25 +83,190 @@ def process_in():
     return process_data(sys.stdin.read())
 
 
-def process_tiddler(tiddler):
+def process_tiddler(tiddler, config=None):
     """
-    Send tiddler text to be processed.
+    Send tiddler text to be processed, using the engine and
+    parse cache set in config.
     """
-    return process_data(tiddler.text)
+    if config is None:
+        config = {}
+    engine = config.get('links.parser_engine')
+    cache = get_parse_cache(config)
+    if cache is None:
+        return process_data(tiddler.text, engine)
+
+    key = cache.key(tiddler.text, tiddler.type,
+            config.get('links.at_means_bag', False), engine)
+    links = cache.get(key)
+    if links is None:
+        links = process_data(tiddler.text, engine)
+        cache.put(key, links)
+    return list(links)
 
 
-def process_data(data):
+@instrumented('parser.process_data')
+def process_data(data, engine=None):
     """
-    Take the text in data and scan for links.
+    Take the text in data and scan for links, using the named
+    engine. The default is the scanner, 'pyparsing' is the
+    reference implementation.
+    """
+    try:
+        return ENGINES[engine or DEFAULT_ENGINE](data)
+    except KeyError:
+        raise ValueError('unknown links parser engine: %s' % engine)
+
+
+def pyparsing_data(data):
+    """
+    Scan for links with the pyparsing grammar.
     """
     links = []
 
-    for token in CONTENT.scanString(data):
+    for token in grammar().scanString(data):
         links.append(record_link(token))
 
     return links
 
 
+def scan_data(data):
+    """
+    Scan for links with the hand written scanner.
+    """
+    links = []
+    if not data:
+        return links
+
+    # pyparsing expands tabs before scanning, which shows in
+    # link text
+    if '\t' in data:
+        data = data.expandtabs()
+
+    length = len(data)
+    loc = 0
+    while loc < length:
+        match = None
+        if NONWIKI_START_RE.match(data, loc):
+            match = _match_at(data, loc)
+        if not match:
+            trigger = TRIGGER_RE.search(data, loc)
+            while trigger:
+                start = trigger.start()
+                match = _match_at(data, start)
+                if match:
+                    break
+                trigger = TRIGGER_RE.search(data, start + 1)
+            else:
+                break
+        loc, link, space = match
+        links.append(_target_space(link, space))
+
+    return links
+
+
+def _match_at(data, loc):
+    """
+    Return the end, link and space of the longest alternative
+    matching at loc, or None. Ties go to the earliest alternative
+    in the grammar.
+    """
+    best = None
+    for alternative in (_link_at, _transclusion_at, _wikiword_at, _http_at,
+            _space_only_at, _nonwikispace_at):
+        match = alternative(data, loc)
+        if match and (best is None or match[0] > best[0]):
+            best = match
+    return best
+
+
+def _skip_whitespace(data, loc, whitespace=WHITESPACE):
+    length = len(data)
+    while loc < length and data[loc] in whitespace:
+        loc += 1
+    return loc
+
+
+def _space_at(data, loc):
+    """
+    Match @space or @[[space]] at loc, returning end and space.
+    """
+    if data[loc:loc + 1] != '@':
+        return None
+    match = UNSPACED_RE.match(data, loc + 1)
+    if match:
+        return match.end(), match.group()
+    if data.startswith('[[', loc + 1):
+        close = data.find(']]', loc + 3)
+        if close >= 0:
+            return close + 2, data[loc + 3:close]
+    return None
+
+
+def _with_space(data, end, link):
+    space = _space_at(data, end)
+    if space:
+        return space[0], link, space[1]
+    return end, link, None
+
+
+def _link_at(data, loc):
+    if not data.startswith('[[', loc):
+        return None
+    start = _skip_whitespace(data, loc + 2)
+    close = data.find(']]', start)
+    if close < 0:
+        return None
+    return _with_space(data, close + 2, data[start:close])
+
+
+def _transclusion_at(data, loc):
+    if loc and data[loc - 1] != '\n':
+        return None
+    if not data.startswith('{{', loc):
+        return None
+    start = _skip_whitespace(data, loc + 2)
+    close = data.find('}}', start)
+    if close < 0:
+        return None
+    end, link, space = _with_space(data, close + 2, data[start:close])
+    end = _skip_whitespace(data, end, ' \t\r')
+    if end == len(data):
+        return end + 1, link, space
+    elif data[end] == '\n':
+        return end + 1, link, space
+    return None
+
+
+def _wikiword_at(data, loc):
+    match = WIKIWORD_RE.match(data, loc)
+    if match:
+        return _with_space(data, match.end(), match.group())
+    return None
+
+
+def _http_at(data, loc):
+    match = URL_RE.match(data, loc)
+    if match:
+        return match.end(), match.group(), None
+    return None
+
+
+def _space_only_at(data, loc):
+    space = _space_at(data, loc)
+    if space:
+        return space[0], None, space[1]
+    return None
+
+
+def _nonwikispace_at(data, loc):
+    match = NONWIKI_RE.match(data, loc)
+    if match:
+        space = _space_at(data, match.end())
+        if space:
+            return space[0], match.group(), space[1]
+    return None
+
+
 def record_link(link):
     """
     Process a link token into a target and space tuple.
@@ -69,13 +274,123 @@ def record_link(link):
     token, _, _ = link
     link = token.get('link')
     space = token.get('space', [None])
+    return _target_space(link, space[0])
+
+
+def _target_space(link, space):
+    """
+    Turn raw link text and space into a target and space tuple.
+    """
     if link and '|' in link:
         _, target = link.split('|', 1)
     elif link:
         target = link
     else:
         target = None
-    return (target, space[0])
+    return (target, space)
+
+
+class ParseCache(object):
+    """
+    A bounded least recently used cache of parsed links, keyed
+    by a digest of the text and the settings that went with it.
+    Keeps counts of hits, misses and evictions. It is shared by
+    request threads and the indexer, so changes are made under a
+    lock.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, text, tiddler_type, at_means_bag, engine):
+        """
+        Make a cache key for text parsed in this context.
+        """
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        digest = sha1(text or '').hexdigest()
+        return (digest, tiddler_type, bool(at_means_bag), engine)
+
+    def get(self, key):
+        """
+        Return the links stored for key, or None.
+        """
+        with self._lock:
+            try:
+                links = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries[key] = links
+            self.hits += 1
+            return links
+
+    def put(self, key, links):
+        """
+        Store links for key, evicting the oldest entries if the
+        cache is full.
+        """
+        links = tuple(links)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = links
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Empty the cache and reset the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """
+        Return the counters and current size as a dict.
+        """
+        with self._lock:
+            return {'size': len(self._entries), 'max_size': self.size,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+PARSE_CACHE = None
+
+
+def get_parse_cache(config):
+    """
+    Return the process wide parse cache sized from
+    links.parse_cache_size in config, or None if that is 0.
+    """
+    global PARSE_CACHE
+    size = int(config.get('links.parse_cache_size', PARSE_CACHE_SIZE))
+    if size <= 0:
+        return None
+    if PARSE_CACHE is None:
+        PARSE_CACHE = ParseCache(size)
+    elif PARSE_CACHE.size != size:
+        PARSE_CACHE.size = size
+    return PARSE_CACHE
+
+
+def is_parseable(tiddler):
+    """
+    True if the tiddler's type is one whose text we scan for links.
+    """
+    return (not tiddler.type
+            or tiddler.type == 'None'
+            or tiddler.type == 'text/x-markdown'
+            or tiddler.type == 'text/x-tiddlywiki')
 
 
 def is_link(target):
@@ -85,5 +400,13 @@ def is_link(target):
     return re.match(URL_PATTERN, target)
 
 
+ENGINES = {
+    'scanner': scan_data,
+    'pyparsing': pyparsing_data,
+}
+DEFAULT_ENGINE = 'scanner'
+PARSE_CACHE_SIZE = 1000
+
+
 if __name__ == '__main__':
     print process_in()
@@ -0,0 +1,180 @@
+"""
+Rebuild the links database from the contents of the store.
+
+The rebuild is a pipeline: the store is read in batches of
+tiddlers, the batches are parsed by a pool of worker processes, and
+the parsed batches are written to the links database by a single
+writer, one transaction per batch. With one worker everything
+happens in this process.
+
+An incremental refresh compares the revision and digest recorded in
+the links database for each tiddler with what is in the store, and
+only parses tiddlers which are new or have changed. Either way, links
+for tiddlers which are no longer in the store are removed.
+"""
+
+import logging
+import time
+
+from collections import deque
+from multiprocessing import Pool
+
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.links.backends import get_links_manager
+from tiddlywebplugins.links.base import index_digest, _batches, _tiddler_key
+from tiddlywebplugins.links.parser import process_data, is_parseable
+
+
+LOGGER = logging.getLogger(__name__)
+
+REFRESH_WORKERS = 1
+REFRESH_BATCH_SIZE = 100
+
+
+def refresh_links(store, workers=None, batch_size=None, report=None,
+        incremental=False):
+    """
+    Refresh the links for every tiddler in store, parsing across
+    workers processes and writing batch_size tiddlers per
+    transaction. If incremental is true only new or changed tiddlers
+    are parsed. report, if given, is called with a progress message
+    after each batch is written. Returns the number of tiddlers
+    refreshed.
+    """
+    config = store.environ.get('tiddlyweb.config', {})
+    if workers is None:
+        workers = int(config.get('links.refresh_workers', REFRESH_WORKERS))
+    if batch_size is None:
+        batch_size = int(config.get('links.refresh_batch_size',
+            REFRESH_BATCH_SIZE))
+    engine = config.get('links.parser_engine')
+
+    links_manager = get_links_manager(store.environ)
+    progress = _Progress(report)
+    seen = set()
+    batches = _batches(_load_entries(store, links_manager, batch_size,
+        incremental, seen, progress), batch_size)
+
+    if workers <= 1:
+        for batch in batches:
+            _write_batch(links_manager, parse_entries(batch, engine),
+                    progress)
+    else:
+        pool = Pool(workers)
+        try:
+            pending = deque()
+            for batch in batches:
+                pending.append(pool.apply_async(parse_entries,
+                    (batch, engine)))
+                # keep the workers busy while bounding the parsed
+                # batches held in memory
+                if len(pending) >= workers * 2:
+                    _write_batch(links_manager, pending.popleft().get(),
+                            progress)
+            while pending:
+                _write_batch(links_manager, pending.popleft().get(),
+                        progress)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    stale = links_manager.list_sources() - seen
+    if stale:
+        links_manager.delete_sources(stale)
+        if report:
+            report('removed links for %d missing tiddlers' % len(stale))
+    return progress.count
+
+
+def parse_entries(entries, engine=None):
+    """
+    Parse a batch of (bag, title, revision, digest, text) entries,
+    returning (bag, title, revision, digest, links) for each. text
+    is None for tiddlers which are not parseable, which get no links.
+    """
+    parsed = []
+    for bag, title, revision, digest, text in entries:
+        if text is None:
+            links = []
+        else:
+            links = process_data(text, engine)
+        parsed.append((bag, title, revision, digest, links))
+    return parsed
+
+
+def _load_entries(store, links_manager, batch_size, incremental, seen,
+        progress):
+    """
+    Yield (bag, title, revision, digest, text) for every tiddler in
+    the store which needs indexing, adding the key of every tiddler
+    to seen.
+    """
+    for bag in store.list_bags():
+        LOGGER.debug('updating links for tiddlers in bag: %s', bag.name)
+        for listed in _batches(store.list_bag_tiddlers(bag), batch_size):
+            if incremental:
+                states = links_manager.read_index_state(listed)
+            else:
+                states = {}
+            moved = []
+            for tiddler in listed:
+                key = _tiddler_key(tiddler)
+                seen.add(key)
+                state = states.get(key)
+                if (state and tiddler.revision
+                        and unicode(tiddler.revision) == state[0]):
+                    progress.skip()
+                    continue
+                tiddler = store.get(tiddler)  # we must get text
+                digest = index_digest(tiddler)
+                if state and state[1] == digest:
+                    # same text at a new revision
+                    moved.append((tiddler, digest))
+                    progress.skip()
+                    continue
+                if is_parseable(tiddler):
+                    text = tiddler.text
+                else:
+                    text = None
+                yield (tiddler.bag, tiddler.title, tiddler.revision, digest,
+                        text)
+            if moved:
+                links_manager.write_index_state(moved)
+
+
+def _write_batch(links_manager, parsed, progress):
+    entries = []
+    for bag, title, revision, digest, links in parsed:
+        tiddler = Tiddler(title, bag)
+        tiddler.revision = revision
+        entries.append((tiddler, links, digest))
+    links_manager.replace_links_many(entries)
+    progress.update(len(parsed))
+
+
+class _Progress(object):
+    """
+    Count tiddlers written and skipped and report throughput.
+    """
+
+    def __init__(self, report):
+        self.report = report
+        self.count = 0
+        self.skipped = 0
+        self.start = time.time()
+
+    def skip(self):
+        self.skipped += 1
+
+    def update(self, count):
+        self.count += count
+        if self.report:
+            elapsed = time.time() - self.start
+            total = self.count + self.skipped
+            rate = total / elapsed if elapsed else 0.0
+            self.report('refreshed %d tiddlers, %d unchanged, '
+                    '%.1f tiddlers/sec' % (self.count, self.skipped, rate))
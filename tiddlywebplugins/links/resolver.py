@@ -0,0 +1,290 @@
+"""
+Resolve the containers that link targets live in.
+
+A LinkResolver lasts for one request. Each recipe and bag is read
+from the store once, each read policy is checked once, and the bags
+of a recipe are listed once, however many links point into them.
+
+Recipes, bags, recipe contents and recipe to bag resolutions are
+also kept between requests in a process wide ContainerCache, bounded
+by 'links.container_cache_size' entries per kind and
+'links.container_cache_ttl' seconds. Store hooks drop entries when
+the bags, recipes or tiddlers behind them change in this process;
+the TTL bounds how long changes made by other processes go unseen.
+"""
+
+from tiddlyweb.control import (determine_bag_from_recipe, filter_tiddlers,
+        recipe_template)
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.policy import PermissionsError
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import StoreError
+
+from tiddlywebplugins.links.cache import TTLCache
+from tiddlywebplugins.links.stats import count
+
+
+CONTAINER_CACHE_SIZE = 1000
+CONTAINER_CACHE_TTL = 60
+
+CONTAINER_CACHE = None
+
+
+class ContainerCache(object):
+    """
+    Process wide caches of recipes and bags (keyed by class name
+    and name), of recipe contents (keyed by recipe name and recipe
+    template) and of recipe to bag resolutions (keyed by recipe
+    name, recipe template and tiddler title).
+    """
+
+    def __init__(self, size, ttl):
+        self.entities = TTLCache(size, ttl)
+        self.recipe_bags = TTLCache(size, ttl)
+        self.resolutions = TTLCache(size, ttl)
+
+    def bag_changed(self, bag_name):
+        """
+        Forget the bag and everything worked out from its contents.
+        """
+        self.entities.discard(('Bag', bag_name))
+        self.recipe_bags.discard_where(
+                lambda key, bags: _lists_bag(bags, bag_name))
+        self.resolutions.clear()
+
+    def recipe_changed(self, recipe_name):
+        """
+        Forget the recipe and everything worked out from it.
+        """
+        self.entities.discard(('Recipe', recipe_name))
+        self.recipe_bags.discard_where(
+                lambda key, bags: key[0] == recipe_name)
+        self.resolutions.discard_where(
+                lambda key, bag_name: key[0] == recipe_name)
+
+    def tiddler_changed(self, bag_name, title):
+        """
+        Forget recipe contents that include the bag and resolutions
+        of the title.
+        """
+        self.recipe_bags.discard_where(
+                lambda key, bags: _lists_bag(bags, bag_name))
+        self.resolutions.discard_where(
+                lambda key, found_bag: key[2] == title)
+
+    def stats(self):
+        """
+        Return the counters of each cache as a dict.
+        """
+        return {'entities': self.entities.stats(),
+                'recipe_bags': self.recipe_bags.stats(),
+                'resolutions': self.resolutions.stats()}
+
+
+def _lists_bag(bags, bag_name):
+    for candidate, _ in bags:
+        if candidate == bag_name:
+            return True
+    return False
+
+
+def get_container_cache(config):
+    """
+    Return the process wide ContainerCache, or None if
+    links.container_cache_size is 0.
+    """
+    global CONTAINER_CACHE
+    size = int(config.get('links.container_cache_size',
+        CONTAINER_CACHE_SIZE))
+    if size <= 0:
+        return None
+    if CONTAINER_CACHE is None:
+        CONTAINER_CACHE = ContainerCache(size,
+                float(config.get('links.container_cache_ttl',
+                    CONTAINER_CACHE_TTL)))
+    return CONTAINER_CACHE
+
+
+def bag_change_hook(store, bag):
+    """
+    Store hook for bag put and delete.
+    """
+    if CONTAINER_CACHE is not None:
+        CONTAINER_CACHE.bag_changed(bag.name)
+
+
+def recipe_change_hook(store, recipe):
+    """
+    Store hook for recipe put and delete.
+    """
+    if CONTAINER_CACHE is not None:
+        CONTAINER_CACHE.recipe_changed(recipe.name)
+
+
+def tiddler_change_hook(store, tiddler):
+    """
+    Store hook for tiddler put and delete.
+    """
+    if CONTAINER_CACHE is not None:
+        CONTAINER_CACHE.tiddler_changed(tiddler.bag, tiddler.title)
+
+
+class LinkResolver(object):
+    """
+    Cache recipes, bags, read permissions and recipe contents for
+    the duration of a request, backed by the process wide
+    ContainerCache.
+    """
+
+    def __init__(self, environ):
+        self.environ = environ
+        self.store = environ['tiddlyweb.store']
+        self.usersign = environ['tiddlyweb.usersign']
+        self.cache = get_container_cache(environ.get('tiddlyweb.config', {}))
+        self.template = recipe_template(environ)
+        self._template_key = tuple(sorted(self.template.items()))
+        self._entities = {}
+        self._readable = {}
+        self._recipe_bags = {}
+
+    def recipe(self, name):
+        """
+        Return the named recipe, or None if it does not exist.
+        """
+        return self._get(Recipe(name))
+
+    def bag(self, name):
+        """
+        Return the named bag, or None if it does not exist.
+        """
+        return self._get(Bag(name))
+
+    def readable(self, tiddler):
+        """
+        Return true if recipe.policy read allows, and
+        bag.policy read allows, or if neither bag or recipe
+        is set.
+        """
+        if tiddler.recipe and not self._allows(Recipe(tiddler.recipe)):
+            return False
+        if tiddler.bag and not self._allows(Bag(tiddler.bag)):
+            return False
+        return True
+
+    def bag_for(self, recipe_name, title):
+        """
+        Return the name of the bag in which the tiddler with title
+        is found through the named recipe, or None, as
+        determine_bag_from_recipe would.
+        """
+        key = (recipe_name, self._template_key, title)
+        if self.cache:
+            try:
+                return self.cache.resolutions.get(key)
+            except KeyError:
+                pass
+
+        recipe = self.recipe(recipe_name)
+        bag_name = None
+        if recipe is None:
+            pass
+        elif self.environ.get('tiddlyweb.config', {}).get('indexer'):
+            # an index answers for one tiddler more cheaply than
+            # listing every bag in the recipe
+            try:
+                bag_name = determine_bag_from_recipe(recipe, Tiddler(title),
+                        self.environ).name
+            except StoreError:
+                pass
+        else:
+            for candidate, titles in self._bags_in_recipe(recipe):
+                if titles is None:  # missing bag
+                    break
+                if title in titles:
+                    bag_name = candidate
+                    break
+
+        if self.cache:
+            self.cache.resolutions.put(key, bag_name)
+        return bag_name
+
+    def _bags_in_recipe(self, recipe):
+        """
+        Return (bag name, set of titles) for each bag in the recipe,
+        last first, with the titles filtered as the recipe says.
+        The titles are None for a bag which does not exist.
+        """
+        key = (recipe.name, self._template_key)
+        try:
+            return self._recipe_bags[key]
+        except KeyError:
+            pass
+        if self.cache:
+            try:
+                bags = self.cache.recipe_bags.get(key)
+                self._recipe_bags[key] = bags
+                return bags
+            except KeyError:
+                pass
+
+        bags = []
+        for bag_name, filter_string in reversed(
+                recipe.get_recipe(self.template)):
+            if not isinstance(bag_name, basestring):
+                bag_name = bag_name.name
+            bag = self.bag(bag_name)
+            if bag is None:
+                bags.append((bag_name, None))
+                break
+            titles = frozenset(tiddler.title for tiddler in filter_tiddlers(
+                self.store.list_bag_tiddlers(bag), filter_string,
+                self.environ))
+            bags.append((bag_name, titles))
+
+        self._recipe_bags[key] = bags
+        if self.cache:
+            self.cache.recipe_bags.put(key, bags)
+        return bags
+
+    def _allows(self, entity):
+        key = (entity.__class__.__name__, entity.name)
+        try:
+            return self._readable[key]
+        except KeyError:
+            pass
+        entity = self._get(entity)
+        allowed = False
+        if entity is not None:
+            count('resolver.policy_checks')
+            try:
+                entity.policy.allows(self.usersign, 'read')
+                allowed = True
+            except PermissionsError:
+                pass
+        self._readable[key] = allowed
+        return allowed
+
+    def _get(self, entity):
+        key = (entity.__class__.__name__, entity.name)
+        try:
+            return self._entities[key]
+        except KeyError:
+            pass
+        if self.cache:
+            try:
+                found = self.cache.entities.get(key)
+                self._entities[key] = found
+                return found
+            except KeyError:
+                pass
+
+        count('resolver.store_gets')
+        try:
+            found = self.store.get(entity)
+        except StoreError:
+            found = None
+        self._entities[key] = found
+        if self.cache:
+            self.cache.entities.put(key, found)
+        return found
@@ -0,0 +1,316 @@
+"""
+A links backend for SQLite which uses the sqlite3 module directly.
+
+It keeps the link_node and link_edge tables of the SQL backend, in
+a file of its own named by 'links.sqlite_path'. Every statement is a
+fixed string, so each connection compiles it once and reuses it. A
+connection is made for each thread and made again after a fork. A
+link_edge table made before links had a kind is given one, filled
+in, when first connected to.
+
+Connections, here and in the sql backend when it is on SQLite, are
+set up by sqlite_pragmas: write ahead logging so readers do not wait
+for writers, a busy timeout so writers wait for each other instead
+of failing, and synchronous and cache_size as configured.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+
+from tiddlywebplugins.links.base import (LinksBackend, IMPORT_BATCH_SIZE,
+        link_kind, _batches, _tiddler_key)
+from tiddlywebplugins.links.stats import instrumented
+
+
+SQLITE_PATH = 'links.sqlite'
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_SYNCHRONOUS = 'NORMAL'
+SQLITE_BUSY_TIMEOUT = 30000
+# Keys are counted with IN clauses of at most this many, within the
+# SQLite limit on bound parameters.
+KEY_BATCH_SIZE = 500
+
+SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS link_node ('
+            'id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE)',
+        'CREATE TABLE IF NOT EXISTS link_edge ('
+            'source_id INTEGER NOT NULL, target_id INTEGER NOT NULL, '
+            "kind TEXT NOT NULL DEFAULT 'tiddler', "
+            'PRIMARY KEY (source_id, target_id))',
+        ]
+INDEXES = [
+        'CREATE INDEX IF NOT EXISTS link_edge_target '
+            'ON link_edge (target_id, source_id)',
+        'CREATE INDEX IF NOT EXISTS link_edge_kind '
+            'ON link_edge (source_id, kind)',
+        ]
+ADD_KIND = ("ALTER TABLE link_edge "
+        "ADD COLUMN kind TEXT NOT NULL DEFAULT 'tiddler'")
+TARGETS = ('SELECT id, key FROM link_node '
+        'WHERE id IN (SELECT target_id FROM link_edge)')
+UPDATE_KIND = 'UPDATE link_edge SET kind = ? WHERE target_id = ?'
+
+EDGES = ('FROM link_edge '
+        'JOIN link_node AS source ON source.id = link_edge.source_id '
+        'JOIN link_node AS target ON target.id = link_edge.target_id ')
+FRONTLINKS = 'SELECT target.key ' + EDGES + 'WHERE source.key = ? '
+BACKLINKS = 'SELECT source.key ' + EDGES + 'WHERE target.key = ? '
+FRONTLINKS_AFTER = FRONTLINKS + 'AND target.key > ? '
+BACKLINKS_AFTER = BACKLINKS + 'AND source.key > ? '
+COUNT_BACKLINKS = ('SELECT target.key, count(*) ' + EDGES
+        + 'WHERE target.key IN (%s) GROUP BY target.key')
+EXPORT = 'SELECT source.key, target.key ' + EDGES + 'WHERE 1 '
+EXPORT_BAG = "AND source.key LIKE ? ESCAPE '\\' "
+EXPORT_ORDER = 'ORDER BY link_edge.source_id, link_edge.target_id'
+KINDS = 'AND link_edge.kind IN (%s) '
+LIST_SOURCES = ('SELECT DISTINCT source.key FROM link_edge '
+        'JOIN link_node AS source ON source.id = link_edge.source_id')
+INSERT_NODE = 'INSERT OR IGNORE INTO link_node (key) VALUES (?)'
+INSERT_EDGE = ('INSERT OR IGNORE INTO link_edge '
+        '(source_id, target_id, kind) '
+        'SELECT source.id, target.id, ? FROM link_node AS source, '
+        'link_node AS target WHERE source.key = ? AND target.key = ?')
+DELETE_EDGE = ('DELETE FROM link_edge '
+        'WHERE source_id = (SELECT id FROM link_node WHERE key = ?) '
+        'AND target_id = (SELECT id FROM link_node WHERE key = ?)')
+DELETE_SOURCE = ('DELETE FROM link_edge '
+        'WHERE source_id = (SELECT id FROM link_node WHERE key = ?)')
+
+CONNECTIONS = threading.local()
+
+
+class SQLiteLinksManager(LinksBackend):
+    """
+    A links backend keeping link_node and link_edge in a SQLite
+    file through the sqlite3 module.
+    """
+
+    def __init__(self, environ=None):
+        LinksBackend.__init__(self, environ)
+        self.config = self.environ.get('tiddlyweb.config', {})
+        self.path = self.config.get('links.sqlite_path', SQLITE_PATH)
+        self.connection = _connect(self.path, self.config)
+
+    @instrumented('db.read_frontlinks')
+    def read_frontlinks(self, tiddler, limit=None, after=None, kinds=None):
+        """
+        Return a list of forward links from this tiddler, in key
+        order.
+        """
+        return self._read_keys(FRONTLINKS, FRONTLINKS_AFTER, 'target',
+                _tiddler_key(tiddler), limit, after, kinds)
+
+    @instrumented('db.read_backlinks')
+    def read_backlinks(self, tiddler, limit=None, after=None, kinds=None):
+        """
+        Return a list of links to this tiddler, in key order.
+        """
+        return self._read_keys(BACKLINKS, BACKLINKS_AFTER, 'source',
+                _tiddler_key(tiddler), limit, after, kinds)
+
+    def _read_keys(self, query, query_after, table, key, limit, after,
+            kinds):
+        parameters = [key]
+        if after is not None:
+            query = query_after
+            parameters.append(after)
+        if kinds is not None:
+            query += _kinds_clause(kinds)
+            parameters.extend(kinds)
+        query += 'ORDER BY %s.key' % table
+        if limit is not None:
+            query += ' LIMIT ?'
+            parameters.append(limit)
+        return [row[0] for row in self.connection.execute(query, parameters)]
+
+    @instrumented('db.count_backlinks_many')
+    def count_backlinks_many(self, tiddlers):
+        """
+        Return a dict of tiddler key to the number of links to
+        that tiddler, for each of tiddlers, with one grouped query
+        per batch of keys.
+        """
+        counts = {}
+        for batch in _batches(set(_tiddler_key(tiddler)
+                for tiddler in tiddlers), KEY_BATCH_SIZE):
+            counts.update((key, 0) for key in batch)
+            counts.update(self.connection.execute(COUNT_BACKLINKS
+                % ', '.join('?' * len(batch)), batch))
+        return counts
+
+    @instrumented('db.delete_sources')
+    def delete_sources(self, sources):
+        """
+        Clean out the links for each of the given source keys.
+        """
+        with self.connection:
+            self.connection.executemany(DELETE_SOURCE,
+                    [(source,) for source in sources])
+
+    @instrumented('db.list_sources')
+    def list_sources(self):
+        """
+        Return the set of source keys which have links stored.
+        """
+        return set(row[0] for row in self.connection.execute(LIST_SOURCES))
+
+    @instrumented('db.replace_links_many')
+    def replace_links_many(self, entries):
+        """
+        Replace the links of many tiddlers at once, deleting only
+        the links which have gone and adding only the new ones, in
+        one transaction.
+        """
+        removed = []
+        added = []
+        with self.connection:
+            for entry in entries:
+                tiddler, links = entry[:2]
+                source = _tiddler_key(tiddler)
+                targets = self._link_targets(links, tiddler)
+                stored = set(row[0] for row in self.connection.execute(
+                    FRONTLINKS, (source,)))
+                removed.extend((source, target)
+                        for target in stored - targets)
+                added.extend((source, target)
+                        for target in targets - stored)
+            if removed:
+                self.connection.executemany(DELETE_EDGE, removed)
+            if added:
+                self._insert_links(added)
+
+    @instrumented('db.update_links')
+    def _update_links(self, links, tiddler):
+        source = _tiddler_key(tiddler)
+        with self.connection:
+            self._insert_links([(source, target)
+                for target in self._link_targets(links, tiddler)])
+
+    def export_links(self, bag_name=None, kinds=None):
+        """
+        Yield every stored (source, target) key pair, or those whose
+        source is in bag_name, grouped by source, from a connection
+        of their own. If kinds is given, yield only links of those
+        kinds.
+        """
+        connection = sqlite3.connect(self.path,
+                timeout=busy_timeout(self.config) / 1000.0)
+        try:
+            query = EXPORT
+            parameters = []
+            prefix = ''
+            if bag_name is not None:
+                prefix = bag_name + ':'
+                query += EXPORT_BAG
+                parameters.append(
+                        re.sub(r'([\\%_])', r'\\\1', prefix) + '%')
+            if kinds is not None:
+                query += _kinds_clause(kinds)
+                parameters.extend(kinds)
+            rows = connection.execute(query + EXPORT_ORDER, parameters)
+            for source, target in rows:
+                # LIKE ignores case
+                if source.startswith(prefix):
+                    yield source, target
+        finally:
+            connection.close()
+
+    @instrumented('db.import_links')
+    def import_links(self, rows, batch_size=IMPORT_BATCH_SIZE):
+        """
+        Add the (source, target) key pairs in rows to the stored
+        links, without parsing, batch_size rows per transaction.
+        Returns the number of rows read.
+        """
+        count = 0
+        for batch in _batches(rows, batch_size):
+            with self.connection:
+                self._insert_links(batch)
+            count += len(batch)
+        return count
+
+    def _insert_links(self, links):
+        keys = set()
+        for source, target in links:
+            keys.add((source,))
+            keys.add((target,))
+        self.connection.executemany(INSERT_NODE, keys)
+        self.connection.executemany(INSERT_EDGE, [(link_kind(target),
+            source, target) for source, target in links])
+
+
+def sqlite_pragmas(config):
+    """
+    Return the PRAGMA statements to run on each new SQLite
+    connection, from 'links.sqlite_journal_mode' (WAL),
+    'links.sqlite_synchronous' (NORMAL), 'links.sqlite_busy_timeout'
+    (30000 milliseconds) and 'links.sqlite_cache_size' (SQLite's own
+    default unless set).
+    """
+    pragmas = [
+            'PRAGMA busy_timeout = %d' % busy_timeout(config),
+            'PRAGMA journal_mode = %s' % config.get(
+                'links.sqlite_journal_mode', SQLITE_JOURNAL_MODE),
+            'PRAGMA synchronous = %s' % config.get(
+                'links.sqlite_synchronous', SQLITE_SYNCHRONOUS),
+            ]
+    cache_size = config.get('links.sqlite_cache_size')
+    if cache_size is not None:
+        pragmas.append('PRAGMA cache_size = %d' % int(cache_size))
+    return pragmas
+
+
+def busy_timeout(config):
+    """
+    Return how long, in milliseconds, to wait for a locked database.
+    """
+    return int(config.get('links.sqlite_busy_timeout', SQLITE_BUSY_TIMEOUT))
+
+
+def _kinds_clause(kinds):
+    return KINDS % ', '.join('?' * len(kinds))
+
+
+def _connect(path, config):
+    """
+    Return the connection to path for this thread and process,
+    making it and the tables if need be.
+    """
+    connections = getattr(CONNECTIONS, 'connections', None)
+    if connections is None or CONNECTIONS.pid != os.getpid():
+        connections = CONNECTIONS.connections = {}
+        CONNECTIONS.pid = os.getpid()
+    try:
+        return connections[path]
+    except KeyError:
+        pass
+    connection = sqlite3.connect(path, timeout=busy_timeout(config) / 1000.0)
+    for pragma in sqlite_pragmas(config):
+        connection.execute(pragma)
+    with connection:
+        for statement in SCHEMA:
+            connection.execute(statement)
+        columns = [row[1] for row in connection.execute(
+            'PRAGMA table_info(link_edge)')]
+        if 'kind' not in columns:
+            _add_kinds(connection)
+        for statement in INDEXES:
+            connection.execute(statement)
+    connections[path] = connection
+    return connection
+
+
+def _add_kinds(connection):
+    """
+    Add the kind column to a link_edge table made before it, and
+    fill it in.
+    """
+    connection.execute(ADD_KIND)
+    kinds = []
+    for node_id, key in connection.execute(TARGETS).fetchall():
+        kind = link_kind(key)
+        if kind != 'tiddler':
+            kinds.append((kind, node_id))
+    connection.executemany(UPDATE_KIND, kinds)
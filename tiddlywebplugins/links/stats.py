@@ -0,0 +1,286 @@
+"""
+Timings and counters for the hot paths of the links plugin.
+
+Code marks what is to be measured with timed, a context manager, the
+instrumented decorator, or count. Measurements go to the process
+wide sink named by 'links.stats_sink':
+
+* memory (the default): counters, and for each timing its count,
+  total and the most recent 'links.stats_samples' (1000) durations,
+  from which /links/stats reports percentiles.
+* logging: each measurement is logged at debug level.
+* none: nothing is measured, and timed costs a global lookup.
+
+Other sinks can be named as 'module:Class'. They are made with the
+config and have record(name, seconds) and count(name, amount)
+methods, and a stats() method if they can be reported on.
+
+If 'links.profile_slow' is set to a number of seconds, each links
+request is run under cProfile and the profile of any taking longer
+is dumped to 'links.profile_dir' (the current directory).
+"""
+
+import cProfile
+import logging
+import os
+import re
+import threading
+import time
+
+from collections import deque
+from functools import wraps
+
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_SINK = 'memory'
+STATS_SAMPLES = 1000
+
+SINKS = {
+        'memory': 'tiddlywebplugins.links.stats:MemorySink',
+        'logging': 'tiddlywebplugins.links.stats:LoggingSink',
+        }
+
+SINK = None
+SINK_NAME = None
+
+
+class MemorySink(object):
+    """
+    Keep counters and recent timings in memory, for reporting.
+    """
+
+    def __init__(self, config):
+        self.samples = int(config.get('links.stats_samples', STATS_SAMPLES))
+        self._timings = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            try:
+                timing = self._timings[name]
+            except KeyError:
+                timing = self._timings[name] = _Timing(self.samples)
+            timing.add(seconds)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def stats(self):
+        """
+        Return the counters and a summary of each timing as a dict.
+        """
+        with self._lock:
+            return {'counters': dict(self._counters),
+                    'timings': dict((name, timing.summary())
+                        for name, timing in self._timings.iteritems())}
+
+    def reset(self):
+        with self._lock:
+            self._timings.clear()
+            self._counters.clear()
+
+
+class _Timing(object):
+
+    def __init__(self, samples):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=samples)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.recent.append(seconds)
+
+    def summary(self):
+        recent = sorted(self.recent)
+        summary = {'count': self.count,
+                'total_ms': self.total * 1000,
+                'mean_ms': self.total / self.count * 1000,
+                'max_ms': self.max * 1000}
+        for percent in (50, 90, 99):
+            index = int(round(percent / 100.0 * (len(recent) - 1)))
+            summary['p%d_ms' % percent] = recent[index] * 1000
+        return summary
+
+
+class LoggingSink(object):
+    """
+    Log each measurement at debug level.
+    """
+
+    def __init__(self, config):
+        pass
+
+    def record(self, name, seconds):
+        LOGGER.debug('%s took %.3fms', name, seconds * 1000)
+
+    def count(self, name, amount=1):
+        LOGGER.debug('%s counted %d', name, amount)
+
+
+def configure_stats(config):
+    """
+    Make the process wide sink named in config the one measurements
+    go to, keeping the current one if it has the same name.
+    """
+    global SINK, SINK_NAME
+    name = config.get('links.stats_sink', DEFAULT_SINK) or 'none'
+    if name == SINK_NAME:
+        return SINK
+    if name == 'none':
+        sink = None
+    else:
+        try:
+            spec = SINKS[name]
+        except KeyError:
+            if ':' not in name:
+                raise ValueError('unknown links stats sink: %s' % name)
+            spec = name
+        module_name, class_name = spec.split(':', 1)
+        module = __import__(module_name, {}, {}, [class_name])
+        sink = getattr(module, class_name)(config)
+    SINK, SINK_NAME = sink, name
+    return SINK
+
+
+def get_sink():
+    """
+    Return the sink measurements go to, or None.
+    """
+    return SINK
+
+
+def count(name, amount=1):
+    """
+    Add amount to the counter called name.
+    """
+    if SINK is not None:
+        SINK.count(name, amount)
+
+
+def timed(name):
+    """
+    Return a context manager which records how long its block takes
+    as the timing called name.
+    """
+    if SINK is None:
+        return NOT_TIMED
+    return _Timer(SINK, name)
+
+
+class _Timer(object):
+
+    def __init__(self, sink, name):
+        self.sink = sink
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.sink.record(self.name, time.time() - self.start)
+
+
+class _NotTimed(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+NOT_TIMED = _NotTimed()
+
+
+def instrumented(name):
+    """
+    Decorate a function to record how long each call takes as the
+    timing called name.
+    """
+    def decorate(function):
+        @wraps(function)
+        def instrumented_function(*args, **kwargs):
+            sink = SINK
+            if sink is None:
+                return function(*args, **kwargs)
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                sink.record(name, time.time() - start)
+        return instrumented_function
+    return decorate
+
+
+def timed_output(name, output):
+    """
+    Wrap a WSGI response iterable to record the time spent making
+    its chunks, as they are sent, as the timing called name.
+    """
+    if SINK is None:
+        return output
+    return _timed_output(SINK, name, output)
+
+
+def _timed_output(sink, name, output):
+    elapsed = 0.0
+    try:
+        chunks = iter(output)
+        while True:
+            start = time.time()
+            try:
+                chunk = chunks.next()
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.time() - start
+            yield chunk
+    finally:
+        if hasattr(output, 'close'):
+            output.close()
+        sink.record(name, elapsed)
+
+
+def profiled(handler):
+    """
+    Decorate a WSGI handler to profile each request, sending and
+    all, when 'links.profile_slow' is set, and dump the profile of
+    those which are slow.
+    """
+    @wraps(handler)
+    def profiled_handler(environ, start_response):
+        config = environ.get('tiddlyweb.config', {})
+        slow = config.get('links.profile_slow')
+        if slow is None:
+            return handler(environ, start_response)
+        profile = cProfile.Profile()
+        start = time.time()
+        profile.enable()
+        try:
+            return list(handler(environ, start_response))
+        finally:
+            profile.disable()
+            elapsed = time.time() - start
+            if elapsed > float(slow):
+                _dump_profile(profile, config, environ, elapsed)
+    return profiled_handler
+
+
+def _dump_profile(profile, config, environ, elapsed):
+    path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+    filename = os.path.join(config.get('links.profile_dir', '.'),
+            'links-%d-%d-%s.prof' % (time.time() * 1000, os.getpid(),
+                re.sub(r'[^\w.-]+', '_', path).strip('_')[:100]))
+    profile.dump_stats(filename)
+    count('links.profiled')
+    LOGGER.warning('links request %s took %.3fs, profile in %s', path,
+            elapsed, filename)